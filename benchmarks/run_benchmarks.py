@@ -0,0 +1,358 @@
+"""
+Benchmarks of the hot paths of the time-delay pipeline, on the bundled data (data/photometry.db,
+data/initial_guess.json) and on synthetic mocks:
+
+    load_curves          CurveLoader.get_pycs3_curves (query, curves and outlier masks, no cache)
+    detect_outliers      detect_outliers on the curves of the lens
+    spl_ks<kn>           pycs3_utils.spl, for each knotstep of the initial guess of the lens
+    spl1_mock            one spl1 optimisation (opt_rough + opt_fine, as in the default configs) of a single mock
+    multidraw            pycs3.sim.draw.multidraw of one pickle of mocks
+    covariance_4c        errors with dynamic sigma clipping and covariance of 4c, on --n-mocks synthetic mocks
+    remap                remap_delays_and_covariance, on a synthetic quad
+
+Each benchmark runs once to warm up, then --repeats times. The results are written as JSON, with the description of
+the machine and the git commit, so that runs can be compared across commits:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    (update PyCS3, change the code...)
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json --threshold 1.2
+
+The comparison is on the median times, and exits with status 1 if one of them got slower than threshold x baseline.
+Use --current to compare two existing result files without running anything.
+"""
+import argparse as ap
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from importlib import import_module
+from importlib.metadata import version, PackageNotFoundError
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+repo_path = Path(__file__).resolve().parents[1]
+sys.path.append(str(repo_path))
+sys.path.append(str(repo_path / 'pycs3_scripts'))
+
+import pycs3.sim.draw
+import pycs3.spl.topopt
+
+from utils.curve_loading import CurveLoader
+from utils.label_swapping import remap_delays_and_covariance
+from utils import outlier_detection
+from utils.outlier_detection import detect_outliers
+from utils.pycs3_utils import spl
+
+covariance_matrices = import_module('4c_covariance_matrices')
+
+RESULTS_FORMAT = 1
+
+# name -> function(context) returning the callable to time, and a dict of the parameters of the benchmark
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_path, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_path,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(dirty)
+
+
+def package_version(name):
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+def machine_metadata():
+    commit, dirty = git_commit()
+    return {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': package_version('scipy'),
+        'pandas': pd.__version__,
+        'pycs3': package_version('pycs3'),
+        'git_commit': commit,
+        'git_dirty': dirty,
+    }
+
+
+def load_context(dataset, work_dir, n_mocks, seed):
+    """
+    What the benchmarks share: the curves of the lens shifted to the initial guess and the synthetic mocks.
+    """
+    lensname, dataname = dataset.split('_', 1)
+    with open(repo_path / 'data' / 'initial_guess.json', 'r') as f:
+        guess = json.load(f)[dataset]
+    # the bundled database is tracked, the loader reads it as it is (see curve_loading._can_index)
+    db_path = repo_path / 'data' / 'photometry.db'
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        lcs, _ = CurveLoader(db_path).get_pycs3_curves(lensname)
+    for lc in lcs:
+        lc.shifttime(guess['curves'][lc.object]['timeshift'])
+        lc.shiftmag(guess['curves'][lc.object]['magshift'])
+
+    return SimpleNamespace(lensname=lensname, dataname=dataname, db_path=db_path, work_dir=work_dir, lcs=lcs,
+                           knotsteps=guess['knotstouse'], tsrand=guess['tsrand'], n_mocks=n_mocks,
+                           rng=np.random.default_rng(seed), seed=seed)
+
+
+@benchmark('load_curves')
+def bench_load_curves(context):
+    loader = CurveLoader(context.db_path)
+
+    def run():
+        # the outlier masks are memoized by the process, time them as well
+        outlier_detection._mask_cache.clear()
+        loader.get_pycs3_curves(context.lensname)
+    return run, {'lens': context.lensname}
+
+
+@benchmark('detect_outliers')
+def bench_detect_outliers(context):
+    lcs = [lc.copy() for lc in context.lcs]
+    return lambda: detect_outliers(lcs), {'lens': context.lensname, 'n_points': sum(len(lc) for lc in lcs)}
+
+
+def bench_spl(knotstep):
+    def setup(context):
+        lcs = [lc.copy() for lc in context.lcs]
+        return lambda: spl(lcs, knotstep=knotstep), {'lens': context.lensname, 'knotstep': knotstep}
+    return setup
+
+
+def fitted_curves(context):
+    lcs = [lc.copy() for lc in context.lcs]
+    spline = spl(lcs, knotstep=context.knotsteps[0])
+    pycs3.sim.draw.saveresiduals(lcs, spline)
+    return lcs, spline
+
+
+@benchmark('spl1_mock')
+def bench_spl1_mock(context):
+    lcs, spline = fitted_curves(context)
+    np.random.seed(context.seed)
+    mock = pycs3.sim.draw.draw(lcs, spline, shotnoise='magerrs', keeptweakedml=False, keepshifts=False,
+                               inprint_fake_shifts=np.random.uniform(-context.tsrand, context.tsrand, len(lcs)))
+    knotstep = context.knotsteps[0]
+
+    def run():
+        # a fresh copy each time, with the initial conditions of pycs3.sim.run.multirun
+        mocklcs = [lc.copy() for lc in mock]
+        pycs3.sim.draw.transfershifts(mocklcs, lcs)
+        for lc in mocklcs:
+            lc.shifttime(np.random.uniform(low=-context.tsrand, high=context.tsrand))
+        pycs3.spl.topopt.opt_rough(mocklcs, nit=1, knotstep=knotstep)
+        pycs3.spl.topopt.opt_fine(mocklcs, nit=1, knotstep=knotstep, verbose=False)
+    return run, {'lens': context.lensname, 'knotstep': knotstep}
+
+
+@benchmark('multidraw')
+def bench_multidraw(context):
+    lcs, spline = fitted_curves(context)
+    destpath = str(context.work_dir / 'multidraw') + '/'
+    n = 20
+
+    def run():
+        shutil.rmtree(destpath, ignore_errors=True)
+        os.makedirs(destpath)
+        pycs3.sim.draw.multidraw(lcs, spline, n=n, npkl=1, simset='bench', truetsr=context.tsrand,
+                                 shotnoise='magerrs', verbose=False, destpath=destpath)
+    return run, {'lens': context.lensname, 'n': n, 'npkl': 1}
+
+
+def synthetic_delays(context, n_images=4):
+    """
+    Measured and true shifts of n_mocks synthetic mocks, with heavy tails so that the clipping has work to do.
+    """
+    truetsarray = context.rng.uniform(-context.tsrand, context.tsrand, (context.n_mocks, n_images))
+    errors = context.rng.normal(0, 2.0, (context.n_mocks, n_images))
+    outliers = context.rng.random((context.n_mocks, n_images)) < 0.02
+    errors[outliers] = context.rng.standard_cauchy(np.sum(outliers)) * 10.0
+    return truetsarray + errors, truetsarray
+
+
+@benchmark('covariance_4c')
+def bench_covariance(context):
+    lensed_images = ['A', 'B', 'C', 'D']
+    labels = ['AB', 'AC', 'AD', 'BC', 'BD', 'CD']
+    tsarray, truetsarray = synthetic_delays(context, len(lensed_images))
+    results = SimpleNamespace(tsarray=tsarray, truetsarray=truetsarray)
+
+    def run():
+        errors, _ = covariance_matrices.compute_errors(labels, lensed_images, results)
+        pd.DataFrame({label: error for label, error in zip(labels, errors)}).cov()
+    return run, {'n_mocks': context.n_mocks, 'n_labels': len(labels)}
+
+
+@benchmark('remap')
+def bench_remap(context):
+    labels = ['AB', 'AC', 'AD', 'BC', 'BD', 'CD']
+    delays_df = pd.DataFrame(context.rng.normal(0, 20, (len(labels), 1)), index=labels, columns=['delay'])
+    a = context.rng.normal(0, 1, (len(labels), len(labels)))
+    cov_df = pd.DataFrame(a @ a.T, index=labels, columns=labels)
+    remap_dict = {'A': 'B', 'B': 'C', 'C': 'A'}
+    return lambda: remap_delays_and_covariance(delays_df, cov_df, remap_dict), {'remap': remap_dict}
+
+
+def time_benchmark(run, repeats):
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()  # warm up
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(dataset, repeats, n_mocks, seed, select=None):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='td_benchmarks_') as work_dir:
+        context = load_context(dataset, Path(work_dir), n_mocks, seed)
+        benchmarks = dict(BENCHMARKS)
+        for knotstep in context.knotsteps:
+            benchmarks[f'spl_ks{knotstep}'] = bench_spl(knotstep)
+        for name, setup in benchmarks.items():
+            if select is not None and not re.search(select, name):
+                continue
+            np.random.seed(seed)
+            with contextlib.redirect_stdout(io.StringIO()):
+                run, params = setup(context)
+            times = time_benchmark(run, repeats)
+            results[name] = {'params': params, 'times': times, 'min': min(times), 'median': float(np.median(times)),
+                             'mean': float(np.mean(times))}
+            print(f"{name:<16} median {results[name]['median']:9.4f} s   min {results[name]['min']:9.4f} s")
+    return results
+
+
+def compare(current, baseline, threshold):
+    """
+    Prints the ratios of the median times to the baseline, returns the names of the benchmarks that regressed.
+    """
+    for key in ('hostname', 'cpu_count', 'python', 'pycs3'):
+        if current['machine'].get(key) != baseline['machine'].get(key):
+            print(f"Warning: {key} differs from the baseline ({current['machine'].get(key)} vs "
+                  f"{baseline['machine'].get(key)}), the times may not be comparable.")
+    print(f"\n{'benchmark':<16} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    regressions = []
+    for name, result in current['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            print(f"{name:<16} {'-':>10} {result['median']:>10.4f}")
+            continue
+        reference = baseline['benchmarks'][name]['median']
+        ratio = result['median'] / reference if reference > 0 else np.inf
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<16} {reference:>10.4f} {result['median']:>10.4f} {ratio:>7.2f}{flag}")
+    return regressions
+
+
+def main(dataset, output=None, repeats=5, n_mocks=20000, seed=1, select=None, baseline=None, current=None,
+         threshold=1.2):
+    if current is not None:
+        with open(current, 'r') as f:
+            report = json.load(f)
+    else:
+        report = {
+            'format': RESULTS_FORMAT,
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'machine': machine_metadata(),
+            'settings': {'dataset': dataset, 'repeats': repeats, 'n_mocks': n_mocks, 'seed': seed},
+            'benchmarks': run_benchmarks(dataset, repeats, n_mocks, seed, select=select),
+        }
+        if output is None:
+            commit = report['machine']['git_commit'] or 'nocommit'
+            output = repo_path / 'benchmarks' / 'results' / f"{commit[:10]}_{report['machine']['hostname']}.json"
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Results written to {output}")
+
+    if baseline is None:
+        return True
+    with open(baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) slower than {threshold} x baseline: {', '.join(regressions)}")
+        return False
+    print(f"\nNo benchmark slower than {threshold} x baseline.")
+    return True
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(prog="python {}".format(os.path.basename(__file__)),
+                               description="Time the hot paths of the pipeline, and compare with a previous run.",
+                               formatter_class=ap.RawTextHelpFormatter)
+    help_dataset = "data set of data/initial_guess.json to benchmark on, as lensname_dataname"
+    help_output = "JSON file of the results. Default: benchmarks/results/<commit>_<hostname>.json"
+    help_repeats = "number of timed runs of each benchmark, after one warm-up run"
+    help_n_mocks = "number of synthetic mocks of the 4c benchmark"
+    help_seed = "seed of the synthetic data and of the mocks"
+    help_select = "only run the benchmarks whose name matches this regular expression"
+    help_compare = "baseline JSON file to compare the median times with"
+    help_current = "compare this existing JSON file with the baseline instead of running the benchmarks"
+    help_threshold = "a benchmark regressed if its median time is above threshold x baseline"
+    parser.add_argument('--dataset', dest='dataset', type=str, default='DESJ0029-3814_WFI',
+                        metavar='', action='store',
+                        help=help_dataset)
+    parser.add_argument('--output', dest='output', type=str, default=None,
+                        metavar='', action='store',
+                        help=help_output)
+    parser.add_argument('--repeats', dest='repeats', type=int, default=5,
+                        metavar='', action='store',
+                        help=help_repeats)
+    parser.add_argument('--n-mocks', dest='n_mocks', type=int, default=20000,
+                        metavar='', action='store',
+                        help=help_n_mocks)
+    parser.add_argument('--seed', dest='seed', type=int, default=1,
+                        metavar='', action='store',
+                        help=help_seed)
+    parser.add_argument('--select', dest='select', type=str, default=None,
+                        metavar='', action='store',
+                        help=help_select)
+    parser.add_argument('--compare', dest='baseline', type=str, default=None,
+                        metavar='', action='store',
+                        help=help_compare)
+    parser.add_argument('--current', dest='current', type=str, default=None,
+                        metavar='', action='store',
+                        help=help_current)
+    parser.add_argument('--threshold', dest='threshold', type=float, default=1.2,
+                        metavar='', action='store',
+                        help=help_threshold)
+    args = parser.parse_args()
+    success = main(args.dataset, output=args.output, repeats=args.repeats, n_mocks=args.n_mocks, seed=args.seed,
+                   select=args.select, baseline=args.baseline, current=args.current, threshold=args.threshold)
+    sys.exit(0 if success else 1)
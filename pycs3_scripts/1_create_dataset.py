@@ -6,7 +6,6 @@ import argparse as ap
 import logging
 import os
 import sys
-from shutil import copyfile
 from pathlib import Path
 
 here = Path(__file__).parent
@@ -15,23 +14,15 @@ loggerformat = '%(levelname)s: %(message)s'
 logging.basicConfig(format=loggerformat, level=logging.INFO)
 
 
-def replace_line(filename, linetobereplaced, newline):
-    with open(filename, 'r') as file:
-        lines = file.readlines()
-
-    replaced = False
+def replace_line(lines, linetobereplaced, newline):
+    """
+    Replaces, in the lines of a config file being rendered, the first line equal to linetobereplaced (stripped).
+    """
     for i, line in enumerate(lines):
         if line.strip() == linetobereplaced:
             lines[i] = newline + '\n'
-            replaced = True
-            break
-
-    if replaced:
-        with open(filename, 'w') as file:
-            file.writelines(lines)
-    else:
-        raise RuntimeError("No replacement was made!!! pattern:", linetobereplaced,
-                           "file:", filename )
+            return
+    raise RuntimeError("No replacement was made!!! pattern:", linetobereplaced)
 
 
 def generate_string_pairs(strings):
@@ -88,38 +79,35 @@ def create_dataset(dataname, lclabels, MLlist, knotlist, timeshifts_ini, tsrand,
     }
 
     # using this little helper:
-    def write_config(cfile, paths):
-        cfile.write("# Automatically generated paths:\n")
+    def config_paths(paths):
+        lines = ["# Automatically generated paths:\n"]
         for key, path in paths.items():
 
             end = '/' if not '.pkl' in str(path) else ''
-            cfile.write(f"{key} = '{path}{end}'\n")
+            lines.append(f"{key} = '{path}{end}'\n")
+        return lines
 
+    # the config is rendered in memory, and written once at the end.
     # classic scenarios:
     n_curve = len(lclabels)
     if 2 <= n_curve <= 4:
-        copyfile(here / 'default_configs' / f"config_default_{['double', 'triple', 'quads'][n_curve - 2]}.py",
-                 configfile)
-        with configfile.open('a') as cfile:
-            write_config(cfile, linestowrite)
-        print("Default config file created! You might want to change the default parameters.")
+        template = here / 'default_configs' / f"config_default_{['double', 'triple', 'quads'][n_curve - 2]}.py"
+        lines = template.read_text().splitlines(keepends=True) + config_paths(linestowrite)
     else:  # not classic
         print("Warning: do you have a quad, a triple or a double?")
         print("Make sure you update lcs_label in the config file! I'll copy the double template for this time!")
-        new_config_path = config_directory / f"config_{dataname}.py"
-        copyfile("config_default_double.py", new_config_path)
-        with new_config_path.open('a') as cfile:
-            write_config(cfile, linestowrite)
+        template = here / 'default_configs' / "config_default_double.py"
+        configfile.write_text(template.read_text() + ''.join(config_paths(linestowrite)))
         print("Please change the default parameters according to your object and rerun this script.")
         sys.exit()
 
     # NOW TWEAKING THE CONFIG FILES
     # start with the names
     tdlabels = generate_string_pairs(lclabels)
-    replace_line(configfile,
+    replace_line(lines,
                  "#PLACEHOLDERLCLABELS",
                  f"lcs_label = {lclabels}")
-    replace_line(configfile,
+    replace_line(lines,
                  "#PLACEHOLDERDELAYLABELS",
                  f"delay_labels = {tdlabels}")
     # now our initial guess, already embedded in the timeshift of the LCs
@@ -129,38 +117,41 @@ def create_dataset(dataname, lclabels, MLlist, knotlist, timeshifts_ini, tsrand,
         truetsr = max(0.2 * maxtd, 10.0)
     else:
         truetsr = tsrand
-    replace_line(configfile,
+    replace_line(lines,
                  "truetsr = 10.0  # Range of true time delay shifts when drawing the mock curves",
                  f"truetsr = {truetsr:.02f}")
     replace_line(
-       configfile,
+       lines,
        "tsrand = 10.0  # Random shift of initial condition for each simulated lc in [initcond-tsrand, initcond+tsrand]",
        f"tsrand = {truetsr:.02f}"
     )
     if TEST:
-        replace_line(configfile,
+        replace_line(lines,
                      "ncopy = 20 #number of copy per pickle",
                      "ncopy=2")
-        replace_line(configfile,
+        replace_line(lines,
                      "ncopypkls = 25 #number of pickle",
                      "ncopypkls=3")
-        replace_line(configfile,
+        replace_line(lines,
                      "nsimpkls = 40 #number of pickle",
                      "nsimpkls=5")
-        replace_line(configfile,
+        replace_line(lines,
                      "nsim = 20 #number of copy per pickle",
                      "nsim=5")
 
     # use the right ML and knot steps:
     # MLlist, knotlist
-    replace_line(configfile,
+    replace_line(lines,
                  "nmlspl = [0,1,2,3]  #nb_knot - 1, used only if forcen == True, 0, means no microlensing",
                  f"nmlspl = {MLlist}")
 
-    replace_line(configfile,
+    replace_line(lines,
                  "knotstep = [15,25,35,45] #give a list of the parameter you want",
                  f"knotstep = {knotlist}")
 
-    replace_line(configfile,
+    replace_line(lines,
                  "#PLACEHOLDERTIMESHIFTS",
                  f"timeshifts = {timeshifts_ini}")
+
+    configfile.write_text(''.join(lines))
+    print("Default config file created! You might want to change the default parameters.")
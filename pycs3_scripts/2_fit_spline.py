@@ -1,12 +1,13 @@
 """
 This script fit spline and regression difference to the data. This original fit will be used to create the generative noise model.
 You can tune the spline and regrediff parameters from the config file.
+The grid cells (knotstep x microlensing) are fitted in parallel, the figures are rendered once all the fits are done.
+A grid cell whose inputs did not change since its last fit (see manifest.py) is not fitted again, use --force to refit it.
 """
 import argparse as ap
-import importlib
+import copy
 import logging
 import os
-import sys
 
 import numpy as np
 
@@ -15,19 +16,127 @@ import pycs3.gen.mrg
 import pycs3.gen.stat
 import pycs3.gen.util
 import pycs3.pipe.pipe_utils as ut
+from multiprocess import Pool, cpu_count
+
+from instrumentation import annotate, stage_span, task_span
+from manifest import Manifest
+from plot_queue import PlotQueue
+import run_config
+from shared_curves import SharedCurves, attach, detach
 
 loggerformat='%(levelname)s: %(message)s'
 logging.basicConfig(format=loggerformat,level=logging.INFO)
 
 
-def main(lensname, dataname, work_dir='./'):
-    sys.path.append(work_dir + "config/")
-    print(sys.path)
-    config = importlib.import_module("config_" + lensname + "_" + dataname)
+# degrees of freedom of the microlensing models, on top of those of the spline
+DOFS_ML = {
+    'quadratic': 0,
+    'linear': 0,
+    'None': 0,
+    'cubic': 0,
+    'spline_3': 1,
+    'spline_3_fixed_knot': 1,
+    'spline_4': 2,
+    'spline_5': 3,
+    'spline_6': 4,
+    'spline_7': 5,
+    'spline_8': 6,
+    'spline_9': 7,
+    'spline_10': 8,
+    'spline_11': 9,
+    'spline_12': 10,
+    'spline_13': 11,
+    'spline_14': 12
+}
+
+
+def initopt_path(config, i, j, dataname, kn, string_ML, ml):
+    return config.lens_directory + f"{config.combkw[i, j]}/initopt_{dataname}_ks{kn}_{string_ML}{ml}.pkl"
+
+
+def fit_cell(i, j, kn, ml, string_ML, lensname, dataname, work_dir, curves, timeshifts):
+    """
+    Fits the spline and microlensing of grid cell (i, j), starting from the time shifts given, and writes the pickle.
+    curves: the base curves, published in shared memory by main.
+    """
+    config = run_config.load(lensname, dataname, work_dir)
+    annotate(combkw=config.combkw[i, j])
+    print("knot param:", kn)
+    print(("ML param", 'no', j, ml))
+    lcs = copy.deepcopy(attach(curves))
+    detach(curves)
+    if config.magshift is None :
+        magsft = [-np.median(lc.getmags()) for lc in lcs]
+    else :
+        magsft = config.magshift
+    pycs3.gen.lc_func.applyshifts(lcs, timeshifts, magsft) #remove median and set the time shift to the initial guess
+    if ml != 0:
+        config.attachml(lcs, ml)  # add microlensing
+
+    spline = config.spl1(lcs, kn=kn)
+    pycs3.gen.mrg.colourise(lcs)
+    rls = pycs3.gen.stat.subtract(lcs, spline)
+    if type(ml) is list:
+        assert len(ml) == len(rls), 'mismatch between the provided list of MLs and curves (number of)'
+    elif type(ml) is str:
+        ml = len(rls) * [ml]  # same ml for every curve
+    else:
+        raise AssertionError('The provided ml is not what is should be:', ml, '. Should be str (e.g. "linear") or list (e.g. ["linear", "quadratic" ...])')
+    dofs = sum([pycs3.gen.stat.compute_dof_spline([rl], kn, DOFS_ML[mltype]) for rl, mltype in zip(rls, ml)])
+    chi2 = pycs3.gen.stat.compute_chi2(rls, kn, dofs)
+
+    # and write data, again
+    os.makedirs(config.lens_directory + config.combkw[i, j], exist_ok=True)
+    pycs3.gen.util.writepickle((lcs, spline), initopt_path(config, i, j, dataname, kn, string_ML, ml))
+
+    delay_pair, delay_name = ut.getdelays(lcs)
+    return {'timeshifts': [lc.timeshift for lc in lcs], 'chi2': chi2, 'dof': dofs,
+            'delay_pair': delay_pair, 'delay_name': delay_name, 'ml': ml}
+
+
+def fit_cell_aux(args):
+    with task_span('fit'):
+        return (args[0], args[1]), fit_cell(*args)
+
+
+def cell_manifest(config, i, j, ml, timeshifts):
+    manifest = Manifest(config.lens_directory + config.combkw[i, j], '2')
+    manifest.add_file('data', config.data)
+    manifest.add_config(config, ['mltype', 'forcen', 'magshift', 'spl1', 'attachml'])
+    manifest.add_value('knotstep', config.knotstep[i])
+    manifest.add_value('ml', ml)
+    manifest.add_value('timeshifts', timeshifts)
+    return manifest
+
+
+def queue_cell_plots(queue, config, i, j, kn, ml, string_ML, dataname, figure_directory):
+    """
+    Queues the figures of a fitted grid cell, from its pickle.
+    """
+    lcs, spline = pycs3.gen.util.readpickle(initopt_path(config, i, j, dataname, kn, string_ML, ml), verbose=False)
+    rls = pycs3.gen.stat.subtract(lcs, spline)
+    queue.add(figure_directory + f"spline_fit_ks{kn}_{string_ML}{ml}.png", pycs3.gen.lc_func.display,
+              lcs, [spline], showlegend=True, showdelays=True)
+    queue.add(figure_directory + f"residual_fit_ks{kn}_{string_ML}{ml}.png", pycs3.gen.stat.plotresiduals, [rls])
+
+
+def run_pool(func, job_args, processes):
+    processes = max(min(processes, len(job_args)), 1)
+    if processes == 1:
+        return [func(args) for args in job_args]
+    with Pool(processes) as p:
+        return p.map(func, job_args, chunksize=1)
+
+
+def main(lensname, dataname, work_dir='./', max_core=None, warm_start=False, plots=True, force=False):
+    config = run_config.load(lensname, dataname, work_dir)
+    if max_core is not None:
+        config.max_core = max_core
+    processes = cpu_count() if config.max_core is None else config.max_core
 
     figure_directory = config.figure_directory + "spline_and_residuals_plots/"
     if not os.path.isdir(figure_directory):
-        os.mkdir(figure_directory)
+        os.makedirs(figure_directory, exist_ok=True)
 
     for i, lc in enumerate(config.lcs_label):
         print("I will aplly a initial shift of : %2.4f days for %s" % (
@@ -46,70 +155,47 @@ def main(lensname, dataname, work_dir='./'):
         string_ML = "deg"
     else:
         raise RuntimeError("I don't know your microlensing type. Choose 'polyml' or 'spml'.")
-    chi2 = np.zeros((len(config.knotstep), len(ml_param)))
-    dof = np.zeros((len(config.knotstep), len(ml_param)))
     print(string_ML, ml_param)
 
-    for i, kn in enumerate(config.knotstep):
-        for j, ml in enumerate(ml_param):
-            print("knot param:", kn)
-            print(("ML param", 'no', j, ml))
-            lcs = pycs3.gen.util.readpickle(config.data)
-            if config.magshift is None :
-                magsft = [-np.median(lc.getmags()) for lc in lcs]
-            else :
-                magsft = config.magshift
-            pycs3.gen.lc_func.applyshifts(lcs, config.timeshifts, magsft) #remove median and set the time shift to the initial guess
-            if ml != 0:
-                config.attachml(lcs, ml)  # add microlensing
-
-            for lc in lcs:
-                print(lc.timeshift)
-            spline = config.spl1(lcs, kn=kn)
-            pycs3.gen.mrg.colourise(lcs)
-            rls = pycs3.gen.stat.subtract(lcs, spline)
-            dofsml = {
-                'quadratic':0,
-                'linear': 0,
-                'None': 0,
-                'cubic': 0,
-                'spline_3':1,
-                'spline_3_fixed_knot':1,
-                'spline_4':2,
-                'spline_5':3,
-                'spline_6':4,
-                'spline_7':5,
-                'spline_8':6,
-                'spline_9':7,
-                'spline_10':8,
-                'spline_11':9,
-                'spline_12':10,
-                'spline_13':11,
-                'spline_14':12
-                }
-            if type(ml) is list:
-                assert len(ml) == len(rls), 'mismatch between the provided list of MLs and curves (number of)'
-            elif type(ml) is str:
-                ml = len(rls) * [ml]  # same ml for every curve
-            else:
-                raise AssertionError('The provided ml is not what is should be:', ml, '. Should be str (e.g. "linear") or list (e.g. ["linear", "quadratic" ...])')
-            dofs = sum([ pycs3.gen.stat.compute_dof_spline([rl], kn, dofsml[mltype]) for rl, mltype in zip(rls, ml)])
-            chi2[i, j] = pycs3.gen.stat.compute_chi2(rls, kn, dofs)
-            dof[i, j] = dofs
-
-            if config.display:
-                pycs3.gen.lc_func.display(lcs, [spline], showlegend=True, showdelays=True, filename="screen")
-                pycs3.gen.stat.plotresiduals([rls])
-            else:
-                pycs3.gen.lc_func.display(lcs, [spline], showlegend=True, showdelays=True,
-                                          filename=figure_directory +  f"spline_fit_ks{kn}_{string_ML}{ml}.png")
-                pycs3.gen.stat.plotresiduals([rls], filename=figure_directory + f"residual_fit_ks{kn}_{string_ML}{ml}.png")
+    # the base curves are read once and shared with the workers
+    base_lcs = pycs3.gen.util.readpickle(config.data)
+    fits = {}
+    with SharedCurves(base_lcs) as shared:
+        def fit(cells, starts):
+            """
+            Fits the cells, starting from the time shifts starts[(i, j)], except those that are up to date.
+            """
+            manifests = {(i, j): cell_manifest(config, i, j, ml_param[j], starts[(i, j)]) for (i, j) in cells}
+            todo = []
+            for (i, j) in cells:
+                if not force and manifests[(i, j)].up_to_date():
+                    print("%s is up to date, I keep its fit." % config.combkw[i, j])
+                    fits[(i, j)] = manifests[(i, j)].result()
+                else:
+                    todo.append((i, j, config.knotstep[i], ml_param[j], string_ML, lensname, dataname, work_dir,
+                                 shared.descriptor, starts[(i, j)]))
+            for (i, j), result in run_pool(fit_cell_aux, todo, processes):
+                fits[(i, j)] = result
+                manifests[(i, j)].write([initopt_path(config, i, j, dataname, config.knotstep[i], string_ML,
+                                                      result['ml'])], result=result)
 
-            # and write data, again
-            if not os.path.isdir(config.lens_directory + config.combkw[i, j]):
-                os.mkdir(config.lens_directory + config.combkw[i, j])
+        cells = [(i, j) for i in range(len(config.knotstep)) for j in range(len(ml_param))]
+        if warm_start:
+            # first the cells with the first ml model, then the others start from the shifts of
+            # the first one with the same knotstep.
+            first = [(i, j) for (i, j) in cells if j == 0]
+            fit(first, {(i, j): config.timeshifts for (i, j) in first})
+            fit([(i, j) for (i, j) in cells if j != 0], {(i, j): fits[(i, 0)]['timeshifts'] for (i, j) in cells})
+        else:
+            fit(cells, {(i, j): config.timeshifts for (i, j) in cells})
 
-            pycs3.gen.util.writepickle((lcs, spline), config.lens_directory + f"{config.combkw[i, j]}/initopt_{dataname}_ks{kn}_{string_ML}{ml}.pkl")
+    # the figures, once all the fits are done
+    queue = PlotQueue(figure_directory, processes=processes, enabled=plots or config.display, display=config.display)
+    if queue.enabled:
+        for (i, j) in sorted(fits):
+            queue_cell_plots(queue, config, i, j, config.knotstep[i], fits[(i, j)]['ml'], string_ML, dataname,
+                             figure_directory)
+    queue.render()
 
     # Write the report :
     print("Report will be writen in " + config.lens_directory + 'report/report_fitting.txt')
@@ -121,20 +207,12 @@ def main(lensname, dataname, work_dir='./'):
     for i, kn in enumerate(config.knotstep):
         f.write('knotstep : %i' % kn + '\n')
         f.write('\n')
-        for j, ml in enumerate(ml_param):
-
-            # same as before, could be that we applied a different ML on each curve.
-            if type(ml) is list:
-                assert len(ml) == len(rls), 'mismatch between the provided list of MLs and curves (number of)'
-            elif type(ml) is str:
-                ml = len(rls) * [ml]  # same ml for every curve
-            else:
-                raise AssertionError('The provided ml is not what is should be:', ml, '. Should be str (e.g. "linear") or list (e.g. ["linear", "quadratic" ...])')            
-
-            lcs, spline = pycs3.gen.util.readpickle(config.lens_directory + f"{config.combkw[i, j]}/initopt_{dataname}_ks{kn}_{string_ML}{ml}.pkl", verbose=False)
-            delay_pair, delay_name = ut.getdelays(lcs)
-            f.write(f"Micro-lensing {string_ML} = {ml}" + "     Delays are " + str(delay_pair) + " for pairs " +
-                    str(delay_name) + '. Chi2 Red : %2.5f ' % chi2[i, j] + ' DoF : %i \n' % dof[i, j])
+        for j in range(len(ml_param)):
+            fit = fits[(i, j)]
+            delay_name = fit['delay_name']
+            f.write(f"Micro-lensing {string_ML} = {fit['ml']}" + "     Delays are " + str(fit['delay_pair']) +
+                    " for pairs " + str(delay_name) + '. Chi2 Red : %2.5f ' % fit['chi2'] +
+                    ' DoF : %i \n' % fit['dof'])
 
         f.write('\n')
 
@@ -158,6 +236,10 @@ if __name__ == '__main__':
     help_lensname = "name of the lens to process"
     help_dataname = "name of the data set to process (Euler, SMARTS, ... )"
     help_work_dir = "name of the working directory"
+    help_max_core = "number of cores to use, overrides max_core of the config"
+    help_warm_start = "fit the first ml model of each knotstep first, and start the others from its time shifts"
+    help_no_plots = "do not render the figures"
+    help_force = "fit all the grid cells, even those whose inputs did not change since their last fit"
     parser.add_argument(dest='lensname', type=str,
                         metavar='lens_name', action='store',
                         help=help_lensname)
@@ -167,5 +249,16 @@ if __name__ == '__main__':
     parser.add_argument('--dir', dest='work_dir', type=str,
                         metavar='', action='store', default='./',
                         help=help_work_dir)
+    parser.add_argument('--max-core', dest='max_core', type=int, default=None,
+                        metavar='', action='store',
+                        help=help_max_core)
+    parser.add_argument('--warm-start', dest='warm_start', action='store_true',
+                        help=help_warm_start)
+    parser.add_argument('--no-plots', dest='no_plots', action='store_true',
+                        help=help_no_plots)
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help=help_force)
     args = parser.parse_args()
-    main(args.lensname, args.dataname, work_dir=args.work_dir)
+    with stage_span('2', args.lensname, args.dataname, work_dir=args.work_dir):
+        main(args.lensname, args.dataname, work_dir=args.work_dir, max_core=args.max_core,
+             warm_start=args.warm_start, plots=not args.no_plots, force=args.force)
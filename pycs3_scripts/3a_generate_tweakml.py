@@ -1,38 +1,127 @@
 """
 This script will find the generative noise model parameters that create mock lightcurves matching the data properties in term of gaussian and correlated noise
-You can also provide directly the correct parameters in the config file. In this case I will just generate the python files to proceed to the step 3b and 3c
-and skip the optimisation
+You can also provide directly the correct parameters in the config file. In this case I will just write the noise model records
+(see noise_models.py) to proceed to the step 3b and 3c and skip the optimisation
+The grid cells are optimised at the same time, sharing the cores. With --warm-start, the optimisation of each cell starts
+from the B parameters found for the first ml model of the same knotstep.
+A grid cell whose inputs did not change since its noise model was written (see manifest.py) is skipped, use --force
+to process it again.
 """
 import matplotlib
 matplotlib.use('Agg')
 import os
+import glob
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import scipy.signal
+import pycs3.gen.stat
 import pycs3.sim.draw
 import pycs3.gen.util
 import pycs3.gen.splml
-import pycs3.sim.twk as twk
 import pycs3.spl.topopt
 import pycs3.pipe.optimiser
-import pycs3.pipe.pipe_utils as ut
-import sys
+from multiprocess import cpu_count
+import noise_models
+import run_config
+from instrumentation import annotate, stage_span, task_span
+from manifest import Manifest
 import argparse as ap
-import importlib
 import logging
 loggerformat='PID %(process)06d | %(asctime)s | %(levelname)s: %(name)s(%(funcName)s): %(message)s'
 logging.basicConfig(format=loggerformat,level=logging.INFO)
 
+# Periodograms of the residuals computed by cached_tweakml_PS, by hash of the curve and of the frequency grid.
+# The residuals are the same for all the mocks drawn from a curve, only B changes the frequency grid.
+PERIODOGRAM_CACHE_SIZE = 256
+_periodograms = OrderedDict()
+# low frequency cut of the noise of the mocks drawn by the DIC optimiser, as in DicOptimiser.get_tweakml_list
+DIC_F_MIN = 1 / 300.0
 
-def run_DIC(lcs, spline, fit_vector, kn, ml, optim_directory, config_file, stream, tolerance=0.75):
-    config = importlib.import_module(config_file)
+
+def cached_lombscargle(x, y, freqs, *args, **kwargs):
+    h = hashlib.sha1()
+    for array in (x, y, freqs):
+        h.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    h.update(repr((args, sorted(kwargs.items()))).encode())
+    key = h.hexdigest()
+    if key in _periodograms:
+        _periodograms.move_to_end(key)
+    else:
+        _periodograms[key] = scipy.signal.lombscargle(x, y, freqs, *args, **kwargs)
+        if len(_periodograms) > PERIODOGRAM_CACHE_SIZE:
+            _periodograms.popitem(last=False)
+    return _periodograms[key].copy()
+
+
+def cached_tweakml_PS(lcs, spline, B, A_correction):
+    """
+    The tweakml function of the DIC optimiser (twk.tweakml_PS with f_min=1/300), computing the periodograms of the
+    residuals with cached_lombscargle. As twk.tweakml_PS, the noise of every call is drawn from the system entropy.
+    """
+    noise_models.seeded_tweakml_PS(lcs, spline, B, np.random.RandomState(), f_min=DIC_F_MIN,
+                                   A_correction=A_correction, periodogram=cached_lombscargle)
+
+
+class CachedDicOptimiser(pycs3.pipe.optimiser.DicOptimiser):
+    """
+    DicOptimiser computing the periodograms of the residuals once per B vector, before forking its workers:
+    they inherit them instead of computing them again for every mock.
+    """
+    def get_tweakml_list(self, theta):
+        if self.tweakml_type != 'PS_from_residuals':
+            return super().get_tweakml_list(theta)
+        return [partial(cached_tweakml_PS, B=theta[k][0], A_correction=self.A_correction[k])
+                for k in range(self.ncurve)]
+
+    def prime_periodograms(self, theta):
+        # same residuals and frequency grid as cached_tweakml_PS
+        for l, b in zip(self.lcs, theta):
+            rl = pycs3.gen.stat.subtract([l], self.spline)[0]
+            cached_lombscargle(rl.jds, rl.mags, noise_models.ps_frequencies(rl, b[0], f_min=DIC_F_MIN))
+
+    def make_mocks_para(self, theta):
+        self.prime_periodograms(theta)
+        return super().make_mocks_para(theta)
+
+    def make_mocks(self, theta):
+        self.prime_periodograms(theta)
+        return super().make_mocks(theta)
+
+
+def read_dic_B(config, i, j):
+    """
+    The B parameters found by the DIC optimisation of grid cell (i, j), None if it did not run.
+    """
+    try:
+        record = noise_models.read_record(noise_models.record_path(config, i, j))
+    except FileNotFoundError:
+        return None
+    if record['optimisation'] is None or record['tweakml_type'] != 'PS_from_residuals':
+        return None
+    return [[curve['B']] for curve in record['curves']]
+
+
+def run_DIC(lcs, spline, fit_vector, kn, ml, optim_directory, config, tolerance=0.75, max_core=None,
+            theta_init=None):
+    """
+    Returns the parameters of the noise model of each curve, and the outcome of the optimisation.
+    """
     pycs3.sim.draw.saveresiduals(lcs, spline)
     print("I'll try to recover these parameters :", fit_vector)
-    dic_opt = pycs3.pipe.optimiser.DicOptimiser(lcs, fit_vector, spline, config.attachml, ml, knotstep=kn,
-                                                savedirectory=optim_directory,
-                                                recompute_spline=True, max_core=config.max_core,
-                                                n_curve_stat=config.n_curve_stat,
-                                                shotnoise=config.shotnoise_type, tweakml_type=config.tweakml_type,
-                                                tweakml_name=config.tweakml_name, display=config.display, verbose=False,
-                                                correction_PS_residuals=True, max_iter=config.max_iter, tolerance=tolerance,
-                                                theta_init=None)
+    if theta_init is not None:
+        print("Starting from B =", theta_init)
+    dic_opt = CachedDicOptimiser(lcs, fit_vector, spline, config.attachml, ml, knotstep=kn,
+                                 savedirectory=optim_directory,
+                                 recompute_spline=True, max_core=config.max_core if max_core is None else max_core,
+                                 n_curve_stat=config.n_curve_stat,
+                                 shotnoise=config.shotnoise_type, tweakml_type=config.tweakml_type,
+                                 tweakml_name=config.tweakml_name, display=config.display, verbose=False,
+                                 correction_PS_residuals=True, max_iter=config.max_iter, tolerance=tolerance,
+                                 theta_init=theta_init)
 
     chain = dic_opt.optimise()
     dic_opt.analyse_plot_results()
@@ -48,25 +137,149 @@ def run_DIC(lcs, spline, fit_vector, kn, ml, optim_directory, config_file, strea
         print("I didn't find a parameter that falls in the %2.2f sigma from the original lightcurve." % tolerance)
         print("I then choose the best one... but be carefull ! ")
 
-    for k in range(len(lcs)):
-        def tweakml_PS_NUMBER(lcs, spline):
-            return twk.tweakml_PS(lcs, spline, B_PARAM, f_min=1 / 300.0, psplot=False, verbose=False,
-                                  interpolation='linear', A_correction=A_PARAM)
-
-        ut.write_func_append(tweakml_PS_NUMBER, stream,
-                             B_PARAM=str(B_best[k][0]), NUMBER=str(k + 1), A_PARAM=str(A[k]))
+    parameters = [{'B': B_best[k][0], 'A_correction': A[k]} for k in range(len(lcs))]
+    return parameters, {'optimiser': 'DIC', 'chi2': float(chi2), 'success': bool(dic_opt.success)}
 
 
-def main(lensname, dataname, work_dir='./'):
-    sys.path.append(work_dir + "config/")
-    config_file = "config_" + lensname + "_" + dataname
-    config = importlib.import_module(config_file)
+def process_cell(i, j, kn, ml, string_ML, lensname, dataname, work_dir, optim_directory, max_core=None,
+                 theta_init=None):
+    """
+    Writes the noise model record of grid cell (i, j). Returns the B parameters when they are optimised, None otherwise.
+    optim_directory: where the DIC optimiser of this cell writes its report and plots.
+    theta_init: starting point of the DIC optimisation.
+    """
+    config = run_config.load(lensname, dataname, work_dir)
+    annotate(combkw=config.combkw[i, j])
     n_curves = len(config.lcs_label)
+    B_best = None
+    optimisation = None
+    if type(ml) is list:
+        assert len(ml) == n_curves, 'mismatch between the provided list of MLs and curves (number of)'
+    elif type(ml) is str:
+        ml = n_curves * [ml]  # same ml for every curve
+    else:
+        raise AssertionError('The provided ml is not what is should be:', ml, '. Should be str (e.g. "linear") or list (e.g. ["linear", "quadratic" ...])')
+    lcs, spline = pycs3.gen.util.readpickle(config.lens_directory + f"{config.combkw[i, j]}/initopt_{dataname}_ks{kn}_{string_ML}{ml}.pkl")
+    fit_vector = pycs3.pipe.optimiser.get_fit_vector(lcs, spline)  # we get the target parameter now
+    if not os.path.isdir(optim_directory):
+        os.makedirs(optim_directory, exist_ok=True)
+
+    # We need spline microlensing for tweaking the curve, if it is not the case we change it here to a flat spline that can be tweaked.
+    # the resulting mock light curve will have no ML anyway, we will attach it the ML defined in your config file before optimisation.
+    polyml = False
+    for k, l in enumerate(lcs):
+        if l.ml == None:
+            print(
+                'I dont have ml, I have to introduce minimal extrinsic variation to generate the mocks. Otherwise I have nothing to modulate.')
+            pycs3.gen.splml.addtolc(l, n=2)
+        elif l.ml.mltype == 'poly':
+            polyml = True
+            print(
+                'I have polyml and it can not be tweaked. I will replace it with a flat spline just for the mock light curve generation.')
+            l.rmml()
+
+    if polyml:
+        spline = pycs3.spl.topopt.opt_fine(lcs, nit=5, knotstep=kn,
+                                           verbose=False, bokeps=kn / 3.0,
+                                           stabext=100)  # we replace the spline optimised with poly ml by one without ml
+        for l in lcs:
+            pycs3.gen.splml.addtolc(l, n=2)
+        pycs3.gen.util.writepickle((lcs, spline),
+                                   config.lens_directory + f"{config.combkw[i, j]}/initopt_{dataname}_ks{kn}_{string_ML}{ml}_generative_polyml.pkl")
+
+    # Parameters of the noise model depending on tweak_ml_type :
+    if config.tweakml_type == 'colored_noise':
+        if config.shotnoise_type == None:
+            print('WARNING : you are using no shotnoise with the colored noise ! That will probably not work.')
+
+        if config.find_tweak_ml_param == True:
+            raise NotImplementedError(
+                "I am not supporting automatic optimisation for colored_noise yet. You should provide your generative noise model parameter yourself or use PS_from_residuals.")
+        else:
+            print("Colored noise : I will add the beta and sigma that you gave in input.")
+            parameters = [{'beta': config.colored_noise_param[k][0], 'sigma': config.colored_noise_param[k][1]}
+                          for k in range(len(lcs))]
+
+    elif config.tweakml_type == 'PS_from_residuals':
+        if config.shotnoise_type != None:
+            print('If you use PS_from_residuals, the shotnoise should be set to None. I will do it for you !')
+            config.shotnoise_type = None
+
+        if config.find_tweak_ml_param == True:
+            if config.optimiser == 'DIC':
+                parameters, optimisation = run_DIC(lcs, spline, fit_vector, kn, ml, optim_directory, config,
+                                                   max_core=max_core, theta_init=theta_init)
+                B_best = [[p['B']] for p in parameters]
+            else:
+                raise RuntimeError('I do not recognise your optimiser, please use DIC with PS_from_residuals')
+
+        else:
+            print("Noise from Power Spectrum of the data : I use PS_param that you gave in input.")
+            # the configs give [B] for each curve, like theta of the optimiser
+            parameters = [{'B': np.atleast_1d(config.PS_param_B[k])[0], 'A_correction': 1.0} for k in range(len(lcs))]
+
+    else:
+        raise RuntimeError("I don't know your tweak_ml_type, please use colored_noise or PS_form_residuals.")
+
+    record = noise_models.make_record(config.tweakml_type, config.tweakml_name, [l.object for l in lcs], parameters,
+                                      optimisation=optimisation, combkw=str(config.combkw[i, j]), knotstep=kn, ml=ml)
+    noise_models.write_record(noise_models.record_path(config, i, j), record)
+    noise_models.update_summary(work_dir, lensname + "_" + dataname, str(config.combkw[i, j]), record)
+    # rename the file :
+    files = [file for file in os.listdir(optim_directory)
+             if os.path.isfile(os.path.join(optim_directory, file)) and (string_ML not in file)]
+
+    for file in files:
+        prefix, extension = file.split('.')
+        os.rename(os.path.join(optim_directory, file),
+                  os.path.join(optim_directory, prefix + f"_kn{kn}_{string_ML}{ml}." + extension))
+    return B_best
+
+
+def process_cell_aux(args):
+    with task_span('noise model'):
+        return (args[0], args[1]), process_cell(*args)
+
+
+def cell_manifest(config, i, j, theta_init=None):
+    manifest = Manifest(config.lens_directory + config.combkw[i, j], '3a')
+    manifest.add_upstream('2', Manifest(config.lens_directory + config.combkw[i, j], '2').path)
+    manifest.add_config(config, ['tweakml_type', 'tweakml_name', 'shotnoise_type', 'find_tweak_ml_param', 'optimiser',
+                                 'colored_noise_param', 'PS_param_B', 'n_curve_stat', 'max_iter', 'attachml'])
+    manifest.add_value('theta_init', theta_init)
+    return manifest
+
+
+def cell_outputs(config, i, j):
+    # the record, and the spline without polyml of the cells that have one
+    return [noise_models.record_path(config, i, j)] + glob.glob(
+        config.lens_directory + config.combkw[i, j] + '/initopt_*_generative_polyml.pkl')
+
+
+def run_cells(job_args, n_parallel):
+    """
+    Runs the cells n_parallel at a time, in processes that can start their own pool (the DIC optimiser does),
+    unlike the workers of a Pool.
+    """
+    n_parallel = min(n_parallel, len(job_args))
+    if n_parallel <= 1:
+        return [process_cell_aux(args) for args in job_args]
+    with ProcessPoolExecutor(n_parallel, mp_context=multiprocessing.get_context('fork')) as executor:
+        return list(executor.map(process_cell_aux, job_args))
+
+
+def main(lensname, dataname, work_dir='./', cell=None, max_core=None, warm_start=False, force=False):
+    config = run_config.load(lensname, dataname, work_dir)
+    if max_core is not None:
+        config.max_core = max_core
+    if cell is not None:
+        annotate(combkw=config.combkw[cell[0], cell[1]])
+    processes = cpu_count() if config.max_core is None else config.max_core
     tweakml_plot_dir = config.figure_directory + 'tweakml_plots/'
     optim_directory = tweakml_plot_dir + 'twk_optim_%s_%s/' % (config.optimiser, config.tweakml_name)
 
     if not os.path.isdir(tweakml_plot_dir):
-        os.mkdir(tweakml_plot_dir)
+        os.makedirs(tweakml_plot_dir, exist_ok=True)
 
     if config.mltype == "splml":
         if config.forcen:
@@ -81,114 +294,44 @@ def main(lensname, dataname, work_dir='./'):
     else:
         raise RuntimeError('I dont know your microlensing type. Choose "polyml" or "spml".')
 
-    for i, kn in enumerate(config.knotstep):
-        for j, ml in enumerate(ml_param):
-            f = open(config.lens_directory + config.combkw[i, j] + '/tweakml_' + config.tweakml_name + '.py', 'w+')
-            f.write('import pycs3 \n')
-            f.write('from pycs3.sim import twk as twk \n')
-            if type(ml) is list:
-                assert len(ml) == n_curves, 'mismatch between the provided list of MLs and curves (number of)'
-            elif type(ml) is str:
-                ml = n_curves * [ml]  # same ml for every curve
-            else:
-                raise AssertionError('The provided ml is not what is should be:', ml, '. Should be str (e.g. "linear") or list (e.g. ["linear", "quadratic" ...])')
-            lcs, spline = pycs3.gen.util.readpickle(config.lens_directory + f"{config.combkw[i, j]}/initopt_{dataname}_ks{kn}_{string_ML}{ml}.pkl"
-)
-            fit_vector = pycs3.pipe.optimiser.get_fit_vector(lcs, spline)  # we get the target parameter now
-            if not os.path.isdir(optim_directory):
-                os.mkdir(optim_directory)
-
-            # We need spline microlensing for tweaking the curve, if it is not the case we change it here to a flat spline that can be tweaked.
-            # the resulting mock light curve will have no ML anyway, we will attach it the ML defined in your config file before optimisation.
-            polyml = False
-            for k, l in enumerate(lcs):
-                if l.ml == None:
-                    print(
-                        'I dont have ml, I have to introduce minimal extrinsic variation to generate the mocks. Otherwise I have nothing to modulate.')
-                    pycs3.gen.splml.addtolc(l, n=2)
-                elif l.ml.mltype == 'poly':
-                    polyml = True
-                    print(
-                        'I have polyml and it can not be tweaked. I will replace it with a flat spline just for the mock light curve generation.')
-                    l.rmml()
-
-            if polyml:
-                spline = pycs3.spl.topopt.opt_fine(lcs, nit=5, knotstep=kn,
-                                                   verbose=False, bokeps=kn / 3.0,
-                                                   stabext=100)  # we replace the spline optimised with poly ml by one without ml
-                for l in lcs:
-                    pycs3.gen.splml.addtolc(l, n=2)
-                pycs3.gen.util.writepickle((lcs, spline),
-                                           config.lens_directory + f"{config.combkw[i, j]}/initopt_{dataname}_ks{kn}_{string_ML}{ml}_generative_polyml.pkl"
-)
-
-            # Starting to write tweakml function depending on tweak_ml_type :
-            if config.tweakml_type == 'colored_noise':
-                if config.shotnoise_type == None:
-                    print('WARNING : you are using no shotnoise with the colored noise ! That will probably not work.')
-
-                if config.find_tweak_ml_param == True:
-                    raise NotImplementedError(
-                        "I am not supporting automatic optimisation for colored_noise yet. You should provide your generative noise model parameter yourself or use PS_from_residuals.")
-                else:
-                    print("Colored noise : I will add the beta and sigma that you gave in input.")
-                    for k in range(len(lcs)):
-                        def tweakml_colored_NUMBER(lcs, spline):
-                            return twk.tweakml(lcs, spline, beta=BETA, sigma=SIGMA, fmin=1.0 / 500.0, fmax=0.2,
-                                               psplot=False)
-
-                        ut.write_func_append(tweakml_colored_NUMBER, f,
-                                             BETA=str(config.colored_noise_param[k][0]),
-                                             SIGMA=str(config.colored_noise_param[k][1]), NUMBER=str(k + 1))
-
-                list_string = 'tweakml_list = ['
-                for k in range(len(lcs)):
-                    list_string += 'tweakml_colored_' + str(k + 1) + ','
-                list_string += ']'
-                f.write('\n')
-                f.write(list_string)
-
-
-            elif config.tweakml_type == 'PS_from_residuals':
-                if config.shotnoise_type != None:
-                    print('If you use PS_from_residuals, the shotnoise should be set to None. I will do it for you !')
-                    config.shotnoise_type = None
-
-                if config.find_tweak_ml_param == True:
-                    if config.optimiser == 'DIC':
-                        run_DIC(lcs, spline, fit_vector, kn, ml, optim_directory, config_file, f)
-                    else:
-                        raise RuntimeError('I do not recognise your optimiser, please use DIC with PS_from_residuals')
-
-                else:
-                    print("Noise from Power Spectrum of the data : I use PS_param that you gave in input.")
-                    for k in range(len(lcs)):
-                        def tweakml_PS_NUMBER(lcs, spline):
-                            return twk.tweakml_PS(lcs, spline, B_PARAM, f_min=1 / 300.0, psplot=False, verbose=False,
-                                                  interpolation='linear')
-
-                        ut.write_func_append(tweakml_PS_NUMBER, f,
-                                             B_PARAM=str(config.PS_param_B[k]), NUMBER=str(k + 1))
-
-                list_string = 'tweakml_list = ['
-                for k in range(len(lcs)):
-                    list_string += 'tweakml_PS_' + str(k + 1) + ','
-                list_string += ']'
-                f.write('\n')
-                f.write(list_string)
+    cells = [(i, j) for i in range(len(config.knotstep)) for j in range(len(ml_param))
+             if cell is None or (i, j) == tuple(cell)]
 
-            else:
-                raise RuntimeError("I don't know your tweak_ml_type, please use colored_noise or PS_form_residuals.")
-            f.close()
-            # rename the file :
-            files = [file for file in os.listdir(optim_directory)
-                     if os.path.isfile(os.path.join(optim_directory, file)) and (string_ML not in file)]
+    # The cells share the cores. A DIC optimisation draws n_curve_stat mocks at a time, more cores would be idle.
+    if config.tweakml_type == 'PS_from_residuals' and config.find_tweak_ml_param:
+        cores_per_cell = max(1, min(config.n_curve_stat, processes))
+    else:
+        cores_per_cell = processes  # nothing to optimise, the cells are done in no time
+    n_parallel = max(1, processes // cores_per_cell)
 
-            for file in files:
-                prefix, extension = file.split('.')
-                os.rename(os.path.join(optim_directory, file),
-                          os.path.join(optim_directory, prefix + f"_kn{kn}_{string_ML}{ml}." + extension))
+    def job(i, j, theta_init=None):
+        # one optim directory per cell: the cells running at the same time must not rename each other's files.
+        return (i, j, config.knotstep[i], ml_param[j], string_ML, lensname, dataname, work_dir,
+                optim_directory + config.combkw[i, j] + '/', cores_per_cell, theta_init)
 
+    def process(cells, seeds):
+        """
+        Processes the cells, the optimisation of cell (i, j) starting from seeds[i], except those that are up to date.
+        """
+        manifests = {(i, j): cell_manifest(config, i, j, seeds.get(i)) for (i, j) in cells}
+        todo = []
+        for (i, j) in cells:
+            if not force and manifests[(i, j)].up_to_date():
+                print("%s is up to date, I keep its noise model." % config.combkw[i, j])
+            else:
+                todo.append(job(i, j, seeds.get(i)))
+        B = dict(run_cells(todo, n_parallel))
+        for (i, j) in B:
+            manifests[(i, j)].write(cell_outputs(config, i, j))
+        return B
+
+    if warm_start:
+        # first the cells with the first ml model, then the others start from the B found for the same knotstep.
+        B = process([(i, j) for (i, j) in cells if j == 0], {})
+        seeds = {i: B[(i, 0)] if B.get((i, 0)) is not None else read_dic_B(config, i, 0) for (i, j) in cells}
+        process([(i, j) for (i, j) in cells if j != 0], seeds)
+    else:
+        process(cells, {})
 
 if __name__ == '__main__':
     parser = ap.ArgumentParser(prog="python {}".format(os.path.basename(__file__)),
@@ -197,6 +340,10 @@ if __name__ == '__main__':
     help_lensname = "name of the lens to process"
     help_dataname = "name of the data set to process (Euler, SMARTS, ... )"
     help_work_dir = "name of the working directory"
+    help_cell = "only process this grid cell (indices in the knotstep and ml lists of the config)"
+    help_max_core = "number of cores to use, overrides max_core of the config"
+    help_warm_start = "optimise the first ml model of each knotstep first, and start the others from its B parameters"
+    help_force = "process all the grid cells, even those whose inputs did not change since their last run"
     parser.add_argument(dest='lensname', type=str,
                         metavar='lens_name', action='store',
                         help=help_lensname)
@@ -206,5 +353,17 @@ if __name__ == '__main__':
     parser.add_argument('--dir', dest='work_dir', type=str,
                         metavar='', action='store', default='./',
                         help=help_work_dir)
+    parser.add_argument('--cell', dest='cell', type=int, nargs=2, default=None,
+                        metavar=('KNOTSTEP_INDEX', 'ML_INDEX'), action='store',
+                        help=help_cell)
+    parser.add_argument('--max-core', dest='max_core', type=int, default=None,
+                        metavar='', action='store',
+                        help=help_max_core)
+    parser.add_argument('--warm-start', dest='warm_start', action='store_true',
+                        help=help_warm_start)
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help=help_force)
     args = parser.parse_args()
-    main(args.lensname, args.dataname, work_dir = args.work_dir)
+    with stage_span('3a', args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell):
+        main(args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell, max_core=args.max_core,
+             warm_start=args.warm_start, force=args.force)
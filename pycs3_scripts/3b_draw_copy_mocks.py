@@ -1,37 +1,96 @@
 """
 This scrip will create copy of the data and mock light curves, according to your generative noise model.
-I am using multithreading to do that.
+I am using multithreading to do that: each pickle of each grid cell is a task, drawn with its own random stream
+derived from mock_seed (config), so that a pickle is the same whatever the number of workers. Use --resume to only
+draw the pickles missing after a crash.
+The curves of each grid cell are read once, and handed to the workers through shared memory (see shared_curves.py).
+If use_mock_store is True in the config, the curves go to one container per grid cell and simset (see mock_store.py)
+instead of one pickle per batch of curves.
+A simset whose inputs did not change since it was drawn (see manifest.py) is kept as it is, use --force to draw it again.
 """
+import contextlib
 import os
 import pycs3.gen.util
 import pycs3.sim.draw
-import sys
 import glob
+import hashlib
 import argparse as ap
 import multiprocess
-import importlib
 import logging
+import numpy as np
+import noise_models
+import run_config
+from instrumentation import annotate, stage_span, task_span
+from manifest import Manifest
+from mock_store import MockStore, store_path
+from shared_curves import SharedCurves, attach, detach
 loggerformat='PID %(process)06d | %(asctime)s | %(levelname)s: %(name)s(%(funcName)s): %(message)s'
 logging.basicConfig(format=loggerformat,level=logging.WARNING)
 
 
-def draw_mock_para(i, j, kn, ml, string_ML, lensname, dataname, work_dir):
-    current_dir = os.getcwd()
-    sys.path.append(work_dir + "config/")
-    config = importlib.import_module("config_" + lensname + "_" + dataname)
+def draw_simlcslist(lcs, spline, n, onlycopy=False, tweakml=None, shotnoise=None, truetsr=8.0, rng=None):
+    """
+    One pickle worth of copies or mocks, drawn as pycs3.sim.draw.multidraw does, but kept in memory.
+    rng: np.random.RandomState the true time shifts and the shot noise are drawn from (the tweakml functions should
+    draw from it too, see noise_models.tweakml_list).
+    """
+    if onlycopy:
+        simlcslist = [[l.copy() for l in lcs] for ni in range(n)]
+        for simlcs in simlcslist:
+            for l in simlcs:
+                l.resetshifts()
+        return simlcslist
 
-    print(f"I am drawing curves for ks{kn}, knml{ml}")
-    os.chdir(config.lens_directory + config.combkw[i, j])
-    lcs, spline = pycs3.gen.util.readpickle(f"initopt_{dataname}_ks{kn}_{string_ML}{ml}.pkl")
+    if rng is None:
+        rng = np.random.RandomState()
+    origshifts = np.array([l.timeshift for l in lcs])
+    simlcslist = []
+    for ni in range(n):
+        shifts = rng.uniform(low=-truetsr, high=truetsr, size=(len(lcs))) + origshifts
+        # pycs3 draws the shot noise from numpy's global generator, it is added below
+        simlcs = pycs3.sim.draw.draw([l.copy() for l in lcs], spline.copy(), shotnoise=None,
+                                     tweakml=tweakml, scaletweakresi=False, tweakspl=None, keepshifts=False,
+                                     keeptweakedml=False, keeporiginalml=False, trace=False,
+                                     inprint_fake_shifts=shifts)
+        add_shotnoise(simlcs, lcs, shotnoise, rng)
+        simlcslist.append(simlcs)
+    return simlcslist
 
-    pycs3.sim.draw.saveresiduals(lcs, spline)
 
-    if config.run_on_copies:
-        files_copy = glob.glob("sims_" + config.simset_copy + '/*.pkl')
-        pycs3.sim.draw.multidraw(lcs, onlycopy=True, n=config.ncopy, npkl=config.ncopypkls,
-                                 simset=config.simset_copy)
+def add_shotnoise(simlcs, lcs, shotnoise, rng):
+    """
+    The shot noise of pycs3.sim.draw.draw (shotnoisefrac=1), drawn from rng.
+    simlcs: the curves drawn from lcs, which have their residuals saved.
+    """
+    for simlc, l in zip(simlcs, lcs):
+        if shotnoise == "magerrs":
+            simlc.montecarlomags(f=1.0, seed=rng.randint(2 ** 31 - 1))
+        elif shotnoise == "none" or shotnoise is None:
+            pass
+        elif shotnoise == "res":
+            simlc.mags += l.residuals.copy()
+            simlc.commentlist.append("Added previously saved residuals !")
+        elif shotnoise == "mcres":
+            simlc.mags += l.residuals * rng.standard_normal(len(l))
+            simlc.commentlist.append("Monte Carlo with previously saved residuals as sigma !")
+        elif shotnoise == "sigma":
+            simlc.mags += np.std(l.residuals) * rng.standard_normal(len(l))
+            simlc.commentlist.append("White noise with std of residuals as sigma !")
+        else:
+            raise RuntimeError("Couldn't understand your shotnoise.")
 
-    if config.run_on_sims:
+
+def load_cell(config, i, j, kn, ml, string_ML, dataname, mocks=False):
+    """
+    The curves (with their residuals) and spline to draw from in grid cell (i, j),
+    and for the mocks the record of the noise model.
+    """
+    cell_dir = config.lens_directory + config.combkw[i, j] + '/'
+    lcs, spline = pycs3.gen.util.readpickle(cell_dir + f"initopt_{dataname}_ks{kn}_{string_ML}{ml}.pkl")
+    pycs3.sim.draw.saveresiduals(lcs, spline)
+    tweakml_file = None
+
+    if mocks:
         # add splml so that mytweakml will be applied by multidraw
         polyml = False
         for l in lcs:
@@ -44,39 +103,128 @@ def draw_mock_para(i, j, kn, ml, string_ML, lensname, dataname, work_dir):
 
         if polyml:
             lcs, spline = pycs3.gen.util.readpickle(
-                f"initopt_{dataname}_ks{kn}_{string_ML}{ml}_generative_polyml.pkl")
+                cell_dir + f"initopt_{dataname}_ks{kn}_{string_ML}{ml}_generative_polyml.pkl")
             pycs3.sim.draw.saveresiduals(lcs, spline)
 
-        # import the module with the parameter of the noise :
-        print('I will use the parameter from : %s' % ('tweakml_' + config.tweakml_name + '.py'))
-        exec(compile(open('tweakml_' + config.tweakml_name + '.py', "rb").read(),
-                     'tweakml_' + config.tweakml_name + '.py', 'exec'), globals())
+        tweakml_file = noise_models.record_path(config, i, j)
+        print('I will use the parameter from : %s' % tweakml_file)
+        noise_models.load_tweakml(tweakml_file)  # checked here, and built once for the workers forked after
+
+    return lcs, spline, tweakml_file
+
+
+def stable_key(name):
+    # the same in every process and session, unlike hash()
+    return int.from_bytes(hashlib.sha1(name.encode()).digest()[:4], 'little')
 
-        files_mock = glob.glob("sims_" + config.simset_mock + '/*.pkl')
-        pycs3.sim.draw.multidraw(lcs, spline, onlycopy=False, n=config.nsim, npkl=config.nsimpkls,
-                                 simset=config.simset_mock, tweakml=tweakml_list,
-                                 shotnoise=config.shotnoise_type, trace=False,
-                                 truetsr=config.truetsr, shotnoisefrac=1.0, scaletweakresi=False)
-    os.chdir(current_dir)
 
+def shard_seed(master_seed, lensname, dataname, i, j, simset, k):
+    """
+    Seed of the k-th pickle of simset in grid cell (i, j) of the data set. Each pickle has its own stream derived from
+    the master seed, whatever the worker drawing it and the order of the tasks. The data set is part of the stream:
+    the lenses sharing a mock_seed do not get the same noise.
+    """
+    return np.random.SeedSequence(master_seed, spawn_key=(stable_key(lensname + '_' + dataname), i, j,
+                                                          stable_key(simset), k))
 
-def draw_mock_para_aux(arguments):
-    return draw_mock_para(*arguments)
+
+def shard_pickle(destpath, simset, k):
+    return os.path.join(destpath, "sims_" + simset, "%i_shard.pkl" % (k + 1))
+
+
+def existing_shards(destpath, simset, use_mock_store):
+    if use_mock_store:
+        return MockStore(store_path(destpath, simset)).shards()
+    return {int(os.path.basename(f).split('_')[0]) - 1
+            for f in glob.glob(os.path.join(destpath, "sims_" + simset, '*_shard.pkl'))}
+
+
+def draw_shard(i, j, kn, ml, string_ML, lensname, dataname, work_dir, simset, k, master_seed, curves, spline,
+               tweakml_file):
+    """
+    Draws the k-th pickle of simset (copies or mocks) in grid cell (i, j).
+    curves: descriptor of the curves of the cell, published in shared memory by main.
+    """
+    config = run_config.load(lensname, dataname, work_dir)
+    annotate(combkw=config.combkw[i, j])
+    mocks = simset == config.simset_mock
+    lcs = attach(curves)
+
+    print(f"I am drawing pickle {k + 1} of {simset} for ks{kn}, {string_ML}{ml}")
+    try:
+        if mocks:
+            # all the random numbers of the pickle come from its own stream, numpy's global generator is not used
+            rng = np.random.RandomState(np.random.MT19937(shard_seed(master_seed, lensname, dataname, i, j, simset, k)))
+            tweakml_list = noise_models.load_tweakml(tweakml_file, rng=rng)
+            simlcslist = draw_simlcslist(lcs, spline, config.nsim, tweakml=tweakml_list,
+                                         shotnoise=config.shotnoise_type, truetsr=config.truetsr, rng=rng)
+        else:
+            simlcslist = draw_simlcslist(lcs, None, config.ncopy, onlycopy=True)
+    finally:
+        # the mocks are copies, the shared block of the cell is not needed anymore
+        del lcs
+        detach(curves)
+
+    destpath = config.lens_directory + config.combkw[i, j]
+    if getattr(config, 'use_mock_store', False):
+        MockStore(store_path(destpath, simset)).append(simlcslist, shard=k)
+    else:
+        pklfile = shard_pickle(destpath, simset, k)
+        os.makedirs(os.path.dirname(pklfile), exist_ok=True)
+        # 3c must not pick a half-written pickle
+        pycs3.gen.util.writepickle(simlcslist, pklfile + '.tmp', verbose=False)
+        os.replace(pklfile + '.tmp', pklfile)
 
 
-def main(lensname, dataname, work_dir='./'):
-    import importlib
-    sys.path.append(work_dir + "config/")
-    config = importlib.import_module("config_" + lensname + "_" + dataname)
+def draw_shard_aux(arguments):
+    with task_span('draw', simset=arguments[8], pickle=arguments[9]):
+        return draw_shard(*arguments)
+
+
+def simset_manifest(config, i, j, simset, npkl):
+    destpath = config.lens_directory + config.combkw[i, j]
+    manifest = Manifest(destpath, '3b', simset)
+    manifest.add_upstream('2', Manifest(destpath, '2').path)
+    if simset == config.simset_mock:
+        manifest.add_upstream('3a', Manifest(destpath, '3a').path)
+        manifest.add_config(config, ['nsim', 'truetsr', 'shotnoise_type', 'mock_seed'])
+    else:
+        manifest.add_config(config, ['ncopy'])
+    manifest.add_config(config, ['use_mock_store'])
+    manifest.add_value('npkl', npkl)
+    return manifest
+
+
+def simset_outputs(destpath, simset):
+    return [os.path.join(destpath, "sims_" + simset), store_path(destpath, simset)]
+
+
+def remove_simulations(f):
+    if isinstance(f, MockStore):
+        f.clear()
+    else:
+        os.remove(f)
+
+
+def main(lensname, dataname, work_dir='./', cell=None, max_core=None, resume=False, force=False):
+    config = run_config.load(lensname, dataname, work_dir)
+    if max_core is not None:
+        config.max_core = max_core
+    if cell is not None:
+        annotate(combkw=config.combkw[cell[0], cell[1]])
+    use_mock_store = getattr(config, 'use_mock_store', False)
     n_curves = len(config.lcs_label)
     if config.max_core is None:
         processes = multiprocess.cpu_count()
     else:
         processes = config.max_core
 
-    p = multiprocess.Pool(processes=processes)
-    print("Running on %i cores. " % processes)
+    master_seed = getattr(config, 'mock_seed', None)
+    if master_seed is None:
+        master_seed = np.random.SeedSequence().entropy
+        print("No mock_seed in the config, drawing with the seed %i." % master_seed)
     job_args = []
+    drawn = []
 
     if config.mltype == "splml":
         if config.forcen:
@@ -91,45 +239,89 @@ def main(lensname, dataname, work_dir='./'):
     else:
         raise RuntimeError("I dont know your microlensing type. Choose 'polyml' or 'spml''.")
 
-    for i, kn in enumerate(config.knotstep):
-        for j, ml in enumerate(ml_param):
-            if type(ml) is list:
-                assert len(ml) == n_curves, 'mismatch between the provided list of MLs and curves (number of)'
-            elif type(ml) is str:
-                ml = n_curves * [ml]  # same ml for every curve
-            else:
-                raise AssertionError('The provided ml is not what is should be:', ml, '. Should be str (e.g. "linear") or list (e.g. ["linear", "quadratic" ...])')
-            for simset in [config.simset_mock, config.simset_copy]:
-                file = glob.glob(os.path.join(config.lens_directory + config.combkw[i, j], "sims_" + simset + '/*.pkl'))
-                if len(file) != 0 and config.askquestions == True:
-                    while True:
-                        answer = int(input(
-                            "You already have files in the folder %s. Do you want to add more (1) or replace the existing file (2) ? (1/2)" % simset))
-                        if answer != 1 or answer != 2:
-                            break
-                        else:
-                            print("I did not understand your answer.")
-
-                    if answer == 1:
-                        print("OK, deleting everything ! ")
+    simsets = []
+    if config.run_on_copies:
+        simsets.append((config.simset_copy, config.ncopypkls))
+    if config.run_on_sims:
+        simsets.append((config.simset_mock, config.nsimpkls))
+
+    # the shared blocks of the cells are released when leaving the with block, also if something raises
+    with contextlib.ExitStack() as blocks:
+        for i, kn in enumerate(config.knotstep):
+            for j, ml in enumerate(ml_param):
+                if cell is not None and (i, j) != tuple(cell):
+                    continue
+                if type(ml) is list:
+                    assert len(ml) == n_curves, 'mismatch between the provided list of MLs and curves (number of)'
+                elif type(ml) is str:
+                    ml = n_curves * [ml]  # same ml for every curve
+                else:
+                    raise AssertionError('The provided ml is not what is should be:', ml, '. Should be str (e.g. "linear") or list (e.g. ["linear", "quadratic" ...])')
+                destpath = config.lens_directory + config.combkw[i, j]
+                for simset, npkl in simsets:
+                    manifest = simset_manifest(config, i, j, simset, npkl)
+                    if not (force or resume) and manifest.up_to_date():
+                        print("%s of %s is up to date, I keep it." % (simset, config.combkw[i, j]))
+                        continue
+                    file = glob.glob(os.path.join(destpath, "sims_" + simset + '/*.pkl'))
+                    store = MockStore(store_path(destpath, simset))
+                    n_existing = len(store) if use_mock_store else len(file)
+                    if store.exists():
+                        # the whole container counts as one file, deleting it clears the store.
+                        file.append(store)
+                    first_shard = 0
+                    if resume:
+                        print("Resuming %s: I will only draw the missing pickles." % simset)
+                    elif len(file) != 0 and config.askquestions == True:
+                        while True:
+                            answer = int(input(
+                                "You already have files in the folder %s. Do you want to add more (1) or replace the existing file (2) ? (1/2)" % simset))
+                            if answer != 1 or answer != 2:
+                                break
+                            else:
+                                print("I did not understand your answer.")
+
+                        if answer == 1:
+                            print("OK, deleting everything ! ")
+                            for f in file:
+                                remove_simulations(f)
+                        elif answer == 2:
+                            print("OK, I'll add more mocks !")
+                            # the new pickles get new shard indices, hence new random streams
+                            first_shard = max([n_existing] + [k + 1 for k in existing_shards(destpath, simset,
+                                                                                              use_mock_store)])
+                    elif len(file) != 0:
+                        print(
+                            "You already have files in the folder %s. You did not turn your ask question flag. By default, I will replace your simulation !" % simset)
+                        print("Warning : I am not deleting the optimised curves, you might want to delete them manually.")
                         for f in file:
-                            os.remove(f)
-                    elif answer == 2:
-                        print("OK, I'll add more mocks !")
-                elif len(file) != 0:
-                    print(
-                        "You already have files in the folder %s. You did not turn your ask question flag. By default, I will replace your simulation !" % simset)
-                    print("Warning : I am not deleting the optimised curves, you might want to delete them manually.")
-                    for f in file:
-                        os.remove(f)
-                    print("OK, deleted previous simulations ! ")
-
-            job_args.append((i, j, kn, ml, string_ML, lensname, dataname, work_dir))
-    if processes > 1:
-        p.map(draw_mock_para_aux, job_args)
-    else:
-        for args in job_args:
-            draw_mock_para(*args)
+                            remove_simulations(f)
+                        print("OK, deleted previous simulations ! ")
+
+                    done = existing_shards(destpath, simset, use_mock_store) if resume else set()
+                    todo = [k for k in range(first_shard, first_shard + npkl) if k not in done]
+                    drawn.append((manifest, simset_outputs(destpath, simset)))
+                    if not todo:
+                        continue
+                    # the curves of the cell are read once here and shared with all the workers
+                    lcs, spline, tweakml_file = load_cell(config, i, j, kn, ml, string_ML, dataname,
+                                                          mocks=(simset == config.simset_mock))
+                    shared = blocks.enter_context(SharedCurves(lcs))
+                    for k in todo:
+                        job_args.append((i, j, kn, ml, string_ML, lensname, dataname, work_dir, simset, k, master_seed,
+                                         shared.descriptor, spline, tweakml_file))
+
+        # one task per pickle
+        processes = max(min(processes, len(job_args)), 1)
+        print("Drawing %i pickles on %i cores. " % (len(job_args), processes))
+        if processes > 1:
+            with multiprocess.Pool(processes=processes) as p:
+                p.map(draw_shard_aux, job_args, chunksize=1)
+        else:
+            for args in job_args:
+                draw_shard_aux(args)
+    for manifest, outputs in drawn:
+        manifest.write(outputs)
     print("Done.")
 
 
@@ -140,6 +332,10 @@ if __name__ == '__main__':
     help_lensname = "name of the lens to process"
     help_dataname = "name of the data set to process (Euler, SMARTS, ... )"
     help_work_dir = "name of the working directory"
+    help_cell = "only process this grid cell (indices in the knotstep and ml lists of the config)"
+    help_max_core = "number of cores to use, overrides max_core of the config"
+    help_resume = "keep the pickles already drawn and only draw the missing ones (e.g. after a crash)"
+    help_force = "draw all the simsets, even those whose inputs did not change since they were drawn"
     parser.add_argument(dest='lensname', type=str,
                         metavar='lens_name', action='store',
                         help=help_lensname)
@@ -149,5 +345,17 @@ if __name__ == '__main__':
     parser.add_argument('--dir', dest='work_dir', type=str,
                         metavar='', action='store', default='./',
                         help=help_work_dir)
+    parser.add_argument('--cell', dest='cell', type=int, nargs=2, default=None,
+                        metavar=('KNOTSTEP_INDEX', 'ML_INDEX'), action='store',
+                        help=help_cell)
+    parser.add_argument('--max-core', dest='max_core', type=int, default=None,
+                        metavar='', action='store',
+                        help=help_max_core)
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help=help_resume)
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help=help_force)
     args = parser.parse_args()
-    main(args.lensname, args.dataname, work_dir=args.work_dir)
+    with stage_span('3b', args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell):
+        main(args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell, max_core=args.max_core,
+             resume=args.resume, force=args.force)
@@ -1,49 +1,364 @@
 """
 Optimise the copy and mock data. WARNING : this may take loooooooong. You probably want to launch that on several cores.
 I'm not re-running on already optimized lcs ! It should be safe to launch this script many times,
-it will run on different batch of lightcurves.
+it will run on different batch of lightcurves: each pickle is claimed by exactly one worker with an atomically
+created .workingon file, refreshed while it is optimised. The claims of crashed workers expire after LEASE_TIMEOUT.
+With --global-pool, a single pool of workers (each loading pycs3, the config and the curves once) optimises
+the pickles of all the grid cells, one task per pickle.
+The simsets drawn into a mock store (use_mock_store in the config) are optimised chunk by chunk into a result store.
+A simset whose inputs (simulations, curves, optimiser) did not change since it was optimised (see manifest.py) is
+skipped. If they changed, its previous results are deleted first, use --force to optimise it again anyway.
 """
 
 import argparse as ap
+import contextlib
 import copy
-import importlib
+import glob
 import logging
 import os
 import pickle as pkl
-import sys
+import socket
+import threading
+import traceback
 import time
 
 import numpy as np
 import pycs3.gen.lc_func
 import pycs3.gen.util
+import pycs3.sim.draw
 import pycs3.sim.run
 from multiprocess import Pool, cpu_count
 
+from instrumentation import annotate, stage_span, task_span
+from manifest import Manifest, list_outputs
+from mock_store import MockStore, ResultStore, store_path
+import run_config
+from shared_curves import SharedCurves, attach, detach
+
 loggerformat='PID %(process)06d | %(asctime)s | %(levelname)s: %(name)s(%(funcName)s): %(message)s'
 logging.basicConfig(format=loggerformat,level=logging.WARNING)
 
-def exec_worker_copie_aux(args):
-    return exec_worker_copie(*args)
+# a claim (.workingon file) not refreshed for that long belongs to a crashed worker and can be taken over.
+LEASE_TIMEOUT = 600.
+LEASE_REFRESH = 60.
+
+
+def claim_owner():
+    return "%s pid %i" % (socket.gethostname(), os.getpid())
+
+
+def create_claim(workingonfilepath):
+    """
+    Atomically creates the .workingon file, with the owner of the claim in it. False if it already exists.
+    """
+    try:
+        fd = os.open(workingonfilepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as wf:
+        wf.write("%s %s\n" % (time.ctime(), claim_owner()))
+    return True
+
+
+def read_claim_owner(workingonfilepath):
+    """
+    The owner written in the .workingon file, None if there is no such file.
+    """
+    try:
+        with open(workingonfilepath, 'r') as f:
+            line = f.readline()
+    except FileNotFoundError:
+        return None
+    # "<ctime> <host> pid <pid>", the ctime has 5 words
+    return ' '.join(line.split()[5:])
+
+
+def claim_pickle(workingonfilepath, lease_timeout=LEASE_TIMEOUT):
+    """
+    Atomically creates the .workingon file of a pickle. Returns True if this process now owns the pickle.
+    A claim older than lease_timeout is reclaimed.
+    """
+    if create_claim(workingonfilepath):
+        return True
+    try:
+        age = time.time() - os.stat(workingonfilepath).st_mtime
+    except FileNotFoundError:
+        return claim_pickle(workingonfilepath, lease_timeout)
+    if age < lease_timeout:
+        return False
+    # stale: only one of the workers trying to reclaim it manages to move it away.
+    stale = "%s.stale.%i" % (workingonfilepath, os.getpid())
+    try:
+        os.rename(workingonfilepath, stale)
+    except FileNotFoundError:
+        return False
+    if time.time() - os.stat(stale).st_mtime < lease_timeout:
+        # the claim was renewed in the meantime, give it back.
+        try:
+            os.link(stale, workingonfilepath)
+        except FileExistsError:
+            pass
+        os.remove(stale)
+        return False
+    os.remove(stale)
+    print("Reclaiming %s, its worker stopped refreshing it %i s ago." % (workingonfilepath, age))
+    return claim_pickle(workingonfilepath, lease_timeout)
+
+
+@contextlib.contextmanager
+def lease(workingonfilepath, refresh=LEASE_REFRESH):
+    """
+    Keeps the claim alive while the pickle is optimised, releases it at the end.
+    A claim found missing (e.g. moved away for a moment by a worker checking whether it is stale) is created again;
+    a claim taken over by another worker is logged, and left to it.
+    """
+    stop = threading.Event()
+    owner = claim_owner()
+
+    def heartbeat():
+        lost = False
+        while not stop.wait(refresh):
+            current_owner = read_claim_owner(workingonfilepath)
+            if current_owner == owner:
+                try:
+                    os.utime(workingonfilepath)
+                except FileNotFoundError:
+                    pass  # created again at the next refresh
+            elif current_owner is None:
+                if create_claim(workingonfilepath):
+                    logging.warning("The claim %s had disappeared, I created it again." % workingonfilepath)
+            elif not lost:
+                lost = True
+                logging.warning("The claim %s was taken over by %s, the pickle may be optimised twice."
+                                % (workingonfilepath, current_owner))
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        if read_claim_owner(workingonfilepath) == owner:
+            os.remove(workingonfilepath)
+
+
+def optimise_span(destpath, simset, optset, sim):
+    return task_span('optimise', combkw=os.path.basename(os.path.normpath(destpath)), simset=simset, optset=optset,
+                     pickle=sim)
+
+
+def optimise_pickle(simpkl, simset, lcs, optfct, kwargs_optim, optset, tsrand, destpath, keepopt=False):
+    """
+    Same as pycs3.sim.run.multirun, but for a single pickle of the simset.
+    Returns the success dictionary, or None if this pickle is already optimised (or claimed by another worker).
+    """
+    destdir = os.path.join(destpath, "sims_%s_opt_%s" % (simset, optset))
+    os.makedirs(destdir, exist_ok=True)
+    simpklfilebase = os.path.splitext(os.path.basename(simpkl))[0]
+    workingonfilepath = os.path.join(destdir, simpklfilebase + ".workingon")
+    resultsfilepath = os.path.join(destdir, simpklfilebase + "_runresults.pkl")
+    optfilepath = os.path.join(destdir, simpklfilebase + "_opt.pkl")
+    if os.path.exists(resultsfilepath) or not claim_pickle(workingonfilepath):
+        return None
+    if os.path.exists(resultsfilepath):
+        # finished by another worker between the two checks
+        os.remove(workingonfilepath)
+        return None
+
+    with lease(workingonfilepath), optimise_span(destpath, simset, optset, simpklfilebase):
+        simlcslist = pycs3.gen.util.readpickle(simpkl, verbose=False)
+        optfctouts, success_dic, clean_simlcslist, rr = optimise_simlcslist(
+            simlcslist, lcs, optfct, kwargs_optim, tsrand, name="sims_%s_opt_%s" % (simset, optset))
+        if keepopt:
+            pycs3.gen.util.writepickle({"optfctoutlist": optfctouts, "optlcslist": clean_simlcslist}, optfilepath)
+        pycs3.gen.util.writepickle(rr, resultsfilepath)
+    return success_dic
+
+
+def optimise_chunk(k, simset, lcs, optfct, kwargs_optim, optset, tsrand, destpath, keepopt=False):
+    """
+    Same as optimise_pickle, for the k-th chunk of the mock store of the simset.
+    The results go to the result store; the optimised curves (keepopt) are still pickled, as 3d reads them.
+    """
+    results = ResultStore(store_path(destpath, simset, optset))
+    destdir = os.path.join(destpath, "sims_%s_opt_%s" % (simset, optset))
+    os.makedirs(destdir, exist_ok=True)
+    os.makedirs(results.directory, exist_ok=True)
+    workingonfilepath = os.path.join(results.directory, "chunk_%i.workingon" % k)
+    optfilepath = os.path.join(destdir, "%i_opt.pkl" % (k + 1))
+    if k in results.done_chunks() or not claim_pickle(workingonfilepath):
+        return None
+    if k in results.done_chunks():
+        os.remove(workingonfilepath)
+        return None
+
+    with lease(workingonfilepath), optimise_span(destpath, simset, optset, "chunk_%i" % k):
+        simlcslist = MockStore(store_path(destpath, simset)).read_chunk(k)
+        optfctouts, success_dic, clean_simlcslist, rr = optimise_simlcslist(
+            simlcslist, lcs, optfct, kwargs_optim, tsrand, name="sims_%s_opt_%s" % (simset, optset))
+        if keepopt:
+            pycs3.gen.util.writepickle({"optfctoutlist": optfctouts, "optlcslist": clean_simlcslist}, optfilepath)
+        results.append(k, rr, success_dic)
+    return success_dic
 
 
-def exec_worker_copie(i, simset_copy, lcs, simoptfct, kwargs_optim, optset, tsrand, destpath):
+def optimise_simlcslist(simlcslist, lcs, optfct, kwargs_optim, tsrand, name):
+    """
+    The body of pycs3.sim.run.multirun for one list of simulations: initial shifts from lcs, random time shifts,
+    optimisation. Returns the outputs of optfct, the success dictionary, the optimised curves that did not fail
+    and their RunResults.
+    """
+    for simlcs in simlcslist:
+        pycs3.sim.draw.transfershifts(simlcs, lcs)
+    if tsrand != 0.0:
+        for simlcs in simlcslist:
+            for simlc in simlcs:
+                simlc.shifttime(np.random.uniform(low=-tsrand, high=tsrand))
+    for simlcs in simlcslist:
+        pycs3.gen.lc_func.shuffle(simlcs)
+    optfctouts, success_dic = pycs3.sim.run.applyopt(optfct, simlcslist, **kwargs_optim)
+    for simlcs in simlcslist:
+        pycs3.gen.lc_func.objsort(simlcs, verbose=False)
+
+    if isinstance(optfctouts[0], tuple):
+        qs = np.array([s[1] for s in optfctouts])  # regdiff, minwtv
+    else:
+        qs = np.array([s.lastr2nostab for s in optfctouts])  # spline
+    clean_simlcslist = pycs3.sim.run.clean_simlist(simlcslist, success_dic)
+    rr = pycs3.sim.run.RunResults(clean_simlcslist, qs=qs, name=name, success_dic=success_dic)
+    return optfctouts, success_dic, clean_simlcslist, rr
+
+
+def list_simulations(destpath, simset):
+    """
+    What there is to optimise in the simset: the chunks of its mock store if there is one, its pickles otherwise.
+    """
+    store = MockStore(store_path(destpath, simset))
+    if store.exists():
+        return list(range(len(store)))
+    simdir = os.path.join(destpath, "sims_%s" % simset)
+    if not os.path.isdir(simdir):
+        raise RuntimeError("Sorry, I cannot find the directory %s" % simset)
+    return sorted(glob.glob(os.path.join(simdir, "*.pkl")))
+
+
+def optimise_simulations(sim, *args, **kwargs):
+    if isinstance(sim, int):
+        return optimise_chunk(sim, *args, **kwargs)
+    return optimise_pickle(sim, *args, **kwargs)
+
+
+def run_worker(i, simset, lcs, simoptfct, kwargs_optim, optset, tsrand, destpath, keepopt=False):
+    """
+    Optimises the pickles (or chunks) of the simset that no other worker claimed. Worker i starts at the i-th one,
+    so that the workers do not all compete for the first one.
+    Returns the success dictionaries of the pickles it processed, merged, with the number of pickles it optimised
+    and the errors that stopped the optimisation of a pickle (the pickle is left for the next run).
+    """
     print("worker %i starting..." % i)
-    time.sleep(i)
-    sucess_dic = pycs3.sim.run.multirun(simset_copy, lcs, simoptfct, kwargs_optim=kwargs_optim,
-                                       optset=optset, tsrand=tsrand, destpath=destpath)
+    sims = list_simulations(destpath, simset)
+    if sims:
+        start = i % len(sims)
+        sims = sims[start:] + sims[:start]
+
+    sucess_dic = {'success': True, 'failed_id': [], 'error_list': [], 'worker': i, 'n_optimised': 0,
+                  'exceptions': []}
+    for sim in sims:
+        try:
+            dic = optimise_simulations(sim, simset, lcs, simoptfct, kwargs_optim, optset, tsrand, destpath,
+                                       keepopt=keepopt)
+        except Exception as e:
+            logging.error("Worker %i could not optimise %s:\n%s" % (i, sim, traceback.format_exc()))
+            sucess_dic['success'] = False
+            sucess_dic['exceptions'].append("%s: %s: %s" % (sim, type(e).__name__, e))
+            continue
+        if dic is None:
+            continue
+        sucess_dic['n_optimised'] += 1
+        sucess_dic['success'] = sucess_dic['success'] and dic['success']
+        sucess_dic['failed_id'] += dic['failed_id']
+        sucess_dic['error_list'] += dic['error_list']
     return sucess_dic
 
 
+def exec_worker_copie_aux(args):
+    return exec_worker_copie(*args)
+
+
+def exec_worker_copie(i, simset_copy, curves, simoptfct, kwargs_optim, optset, tsrand, destpath):
+    try:
+        return run_worker(i, simset_copy, attach(curves), simoptfct, kwargs_optim, optset, tsrand, destpath)
+    finally:
+        detach(curves)
+
+
 def exec_worker_mocks_aux(args):
     return exec_worker_mocks(*args)
 
 
-def exec_worker_mocks(i, simset_mock, lcs, simoptfct, kwargs_optim, optset, tsrand, destpath):
-    print("worker %i starting..." % i)
-    time.sleep(i)
-    sucess_dic = pycs3.sim.run.multirun(simset_mock, lcs, simoptfct, kwargs_optim=kwargs_optim,
-                                       optset=optset, tsrand=tsrand, keepopt=True, destpath=destpath)
-    return sucess_dic
+def exec_worker_mocks(i, simset_mock, curves, simoptfct, kwargs_optim, optset, tsrand, destpath):
+    try:
+        return run_worker(i, simset_mock, attach(curves), simoptfct, kwargs_optim, optset, tsrand, destpath,
+                          keepopt=True)
+    finally:
+        detach(curves)
+
+
+def opt_manifest(config, ml, simset, opts, kwargs, destpath):
+    manifest = Manifest(destpath, '3c', simset + '_opt_' + opts)
+    manifest.add_upstream('3b', Manifest(destpath, '3b', simset).path)
+    manifest.add_file('data', config.data)
+    manifest.add_config(config, ['timeshifts', 'magshift', 'attachml', 'simoptfctkw', 'simoptfct', 'tsrand'])
+    manifest.add_value('ml', ml)
+    manifest.add_value('kwargs', kwargs)
+    return manifest
+
+
+def opt_outputs(destpath, simset, opts):
+    return [os.path.join(destpath, "sims_%s_opt_%s" % (simset, opts)), store_path(destpath, simset, opts)]
+
+
+def to_optimise(manifest, outputs, force=False):
+    """
+    False if the simset is up to date. Otherwise, the results written from other inputs (or all of them with force)
+    are deleted, the optimisation would keep them as already done.
+    """
+    if not force and manifest.up_to_date():
+        print("%s is up to date, I do not optimise it again." % os.path.basename(manifest.path))
+        return False
+    if force or manifest.stored() is not None:
+        outputs = [output for output in outputs if os.path.exists(output)]
+        if outputs:
+            print("Deleting the previous results of %s." % ', '.join(outputs))
+        for output in outputs:
+            if os.path.isdir(output) and os.path.basename(output).startswith('store_'):
+                ResultStore(output).clear()
+            else:
+                for path in list_outputs(output):
+                    os.remove(path)
+        manifest.remove()
+    return True
+
+
+def completed(destpath, simset, optset):
+    """
+    True if every pickle (or chunk) of the simset has its results. A pickle whose optimisation stopped with an error,
+    or that is still claimed by another worker (of a concurrent job, or a crashed one whose claim did not expire
+    yet), leaves the simset not up to date: the next run optimises it.
+    """
+    sims = list_simulations(destpath, simset)
+    if sims and isinstance(sims[0], int):
+        done = ResultStore(store_path(destpath, simset, optset)).done_chunks()
+        missing = [k for k in sims if k not in done]
+    else:
+        destdir = os.path.join(destpath, "sims_%s_opt_%s" % (simset, optset))
+        missing = [sim for sim in sims if not os.path.exists(
+            os.path.join(destdir, os.path.splitext(os.path.basename(sim))[0] + "_runresults.pkl"))]
+    if missing:
+        print("%i of the %i pickles of sims_%s_opt_%s are not optimised, I do not mark it as up to date."
+              % (len(missing), len(sims), simset, optset))
+    return not missing
 
 
 def write_report_optimisation(f, success_dic):
@@ -54,21 +369,142 @@ def write_report_optimisation(f, success_dic):
             f.write('------------- \n')
             if dic == None:
                 continue
-            if dic['success']:
-                f.write('None of the optimisations have failed for pickle %i. \n' % i)
-            else:
-                f.write('The optimisation of the following curves have failed in pickle %i : \n' % i)
+            # the dictionaries of run_worker are per worker, the ones of the global pool per pickle
+            name = 'worker %i' % dic['worker'] if 'worker' in dic else 'pickle %i' % i
+            for exception in dic.get('exceptions', []):
+                f.write('The optimisation of %s stopped with an error, it is left for the next run : %s \n'
+                        % (name, exception))
+            if dic.get('n_optimised') == 0:
+                if not dic.get('exceptions'):
+                    f.write('Nothing left to optimise for %s, the pickles were done by other workers. \n' % name)
+            elif dic['failed_id']:
+                f.write('The optimisation of the following curves have failed in %s : \n' % name)
                 for id in dic['failed_id']:
                     f.write("   Curve %i :" % id + str(dic['error_list'][0]) + ' \n')
                 f.write('\n')
+            elif not dic.get('exceptions'):
+                f.write('None of the optimisations have failed for %s. \n' % name)
+
+
+# state of the workers of the global pool, filled once per worker by init_global_worker.
+_worker_state = {}
+
+
+def init_global_worker(lensname, dataname, work_dir, max_core, base_curves):
+    """
+    Runs once in each worker of the global pool: imports the config (and the whole of pycs3 with it)
+    and attaches the base curves shared by main, so that the tasks only carry indices and paths.
+    """
+    config = run_config.load(lensname, dataname, work_dir)
+    if max_core is not None:
+        config.max_core = max_core
+    _worker_state['config'] = config
+    _worker_state['base_lcs'] = attach(base_curves)
+    _worker_state['cell_lcs'] = {}
+
+
+def get_cell_lcs(a, b, ml):
+    """
+    Base curves shifted to the initial guess, with the microlensing of grid cell (a, b) attached.
+    Built once per worker and cell: multirun only reads them, to set the initial conditions of the mocks.
+    """
+    if (a, b) not in _worker_state['cell_lcs']:
+        config = _worker_state['config']
+        lcs = copy.deepcopy(_worker_state['base_lcs'])
+        if config.magshift is None:
+            magsft = [-np.median(lc.getmags()) for lc in lcs]
+        else:
+            magsft = config.magshift
+        pycs3.gen.lc_func.applyshifts(lcs, config.timeshifts, magsft)
+        config.attachml(lcs, ml)
+        _worker_state['cell_lcs'][(a, b)] = lcs
+    return _worker_state['cell_lcs'][(a, b)]
+
+
+def exec_global_task(args):
+    a, b, ml, c, kind, simset, sim, kwargs, optset, destpath = args
+    config = _worker_state['config']
+    lcs = get_cell_lcs(a, b, ml)
+    try:
+        success_dic = optimise_simulations(sim, simset, lcs, config.simoptfct, kwargs, optset, config.tsrand,
+                                           destpath, keepopt=(kind == 'mocks'))
+    except Exception as e:
+        logging.error("Could not optimise %s:\n%s" % (sim, traceback.format_exc()))
+        success_dic = {'success': False, 'failed_id': [], 'error_list': [],
+                       'exceptions': ["%s: %s: %s" % (sim, type(e).__name__, e)]}
+    return (a, b, c, kind), success_dic
+
+
+def run_global_pool(lensname, dataname, work_dir, config, ml_param, string_ML, f, cell=None, force=False):
+    """
+    One pool for the whole grid: each worker loads pycs3, the config and the curves once,
+    then takes (grid cell, simset, pickle) tasks from a single queue, so that the end of one grid cell
+    overlaps with the start of the next.
+    """
+    main_path = os.getcwd()
+    tasks = []
+    manifests = {}
+    for a, kn in enumerate(config.knotstep):
+        for b, ml in enumerate(ml_param):
+            if cell is not None and (a, b) != tuple(cell):
+                continue
+            destpath = os.path.join(main_path, config.lens_directory + config.combkw[a, b] + '/')
+            for c, opts in enumerate(config.optset):
+                kwargs = {'kn': kn, 'name': 'spl1'}
+                kinds = []
+                if config.run_on_copies:
+                    kinds.append(('copies', config.simset_copy))
+                if config.run_on_sims:
+                    kinds.append(('mocks', config.simset_mock))
+                for kind, simset in kinds:
+                    manifest = opt_manifest(config, ml, simset, opts, kwargs, destpath)
+                    if not to_optimise(manifest, opt_outputs(destpath, simset, opts), force=force):
+                        continue
+                    manifests[(a, b, c, kind)] = (manifest, destpath, simset, opts)
+                    for sim in list_simulations(destpath, simset):
+                        tasks.append((a, b, ml, c, kind, simset, sim, kwargs, opts, destpath))
+
+    nworkers = cpu_count() if config.max_core is None else config.max_core
+    print("%i pickles to optimise on %i workers." % (len(tasks), nworkers))
+    results = {}
+    base_lcs = pycs3.gen.util.readpickle(config.data, verbose=False)
+    with SharedCurves(base_lcs) as shared, Pool(nworkers, initializer=init_global_worker,
+                                                initargs=(lensname, dataname, work_dir, config.max_core,
+                                                          shared.descriptor)) as p:
+        for key, success_dic in p.imap_unordered(exec_global_task, tasks, chunksize=1):
+            results.setdefault(key, []).append(success_dic)
+    # checked once all the workers are done, from the results on disk
+    for manifest, destpath, simset, opts in manifests.values():
+        if completed(destpath, simset, opts):
+            manifest.write(opt_outputs(destpath, simset, opts))
+
+    for a, kn in enumerate(config.knotstep):
+        for b, ml in enumerate(ml_param):
+            for c, opts in enumerate(config.optset):
+                for kind, title in [('copies', 'COPIES'), ('mocks', 'SIMULATIONS')]:
+                    if (a, b, c, kind) not in results:
+                        continue
+                    success_list = results[(a, b, c, kind)]
+                    if all(dic is None for dic in success_list):
+                        success_list = None
+                    f.write(f"{title}, kn{kn}, {string_ML}{ml}, optimiseur spl1 : \n")
+                    write_report_optimisation(f, success_list)
+                    f.write('################### \n')
 
 
-def main(lensname, dataname, work_dir='./'):
+def main(lensname, dataname, work_dir='./', cell=None, max_core=None, global_pool=False, force=False):
     main_path = os.getcwd()
-    sys.path.append(work_dir + "config/")
-    config = importlib.import_module("config_" + lensname + "_" + dataname)
+    config = run_config.load(lensname, dataname, work_dir)
+    if max_core is not None:
+        config.max_core = max_core
+    if cell is not None:
+        annotate(combkw=config.combkw[cell[0], cell[1]])
     base_lcs = pycs3.gen.util.readpickle(config.data)
-    f = open(os.path.join(config.report_directory, 'report_optimisation_%s.txt' % config.simoptfctkw), 'w')
+    report_name = 'report_optimisation_%s.txt' % config.simoptfctkw
+    if cell is not None:
+        # one report per grid cell, several cells can run at the same time.
+        report_name = 'report_optimisation_%s_%s.txt' % (config.simoptfctkw, config.combkw[cell[0], cell[1]])
+    f = open(os.path.join(config.report_directory, report_name), 'w')
 
     if config.mltype == "splml":
         if config.forcen:
@@ -83,8 +519,19 @@ def main(lensname, dataname, work_dir='./'):
     else:
         raise RuntimeError('I dont know your microlensing type. Choose "polyml" or "spml".')
 
+    if global_pool and config.simoptfctkw != "spl1":
+        print("The global pool only supports spl1, running one pool per grid cell instead.")
+        global_pool = False
+    if global_pool:
+        run_global_pool(lensname, dataname, work_dir, config, ml_param, string_ML, f, cell=cell, force=force)
+        print("OPTIMISATION DONE : report written in %s" % (os.path.join(config.report_directory, report_name)))
+        f.close()
+        return
+
     for a, kn in enumerate(config.knotstep):
         for b, ml in enumerate(ml_param):
+            if cell is not None and (a, b) != tuple(cell):
+                continue
             lcs = copy.deepcopy(base_lcs)
             destpath = os.path.join(main_path, config.lens_directory + config.combkw[a, b] + '/')
             print(destpath)
@@ -97,36 +544,47 @@ def main(lensname, dataname, work_dir='./'):
 
             # We also give them a microlensing model (here, similar to Courbin 2011)
             config.attachml(lcs, ml)  # this is because they were saved as raw lcs, wihtout lcs.
-
             if config.max_core == None:
                 nworkers = cpu_count()
             else:
                 nworkers = config.max_core
 
-            for c, opts in enumerate(config.optset):
-                if config.simoptfctkw == "spl1":
-                    kwargs = {'kn': kn, 'name': 'spl1'}
-                elif config.simoptfctkw == "regdiff":
-                    kwargs = config.kwargs_optimiser_simoptfct[c]
-                else:
-                    print("Error : simoptfctkw must be spl1 or regdiff")
-
-                if config.run_on_copies:
-                    print("I will run the optimiser on the copies with the parameters :", kwargs)
-                    p = Pool(nworkers)
+            # the workers get the curves through shared memory, not pickled in every job.
+            # The block is released when leaving the with block, also if the optimisation raises.
+            with SharedCurves(lcs) as shared:
+                for c, opts in enumerate(config.optset):
                     if config.simoptfctkw == "spl1":
-                        job_args = [
-                            (j, config.simset_copy, lcs, config.simoptfct, kwargs, opts, config.tsrand, destpath) for j
-                            in
-                            range(nworkers)]
-                        success_list_copies = p.map(exec_worker_copie_aux, job_args)
-                        p.close()
-                        p.join()
-
+                        kwargs = {'kn': kn, 'name': 'spl1'}
                     elif config.simoptfctkw == "regdiff":
-                        if a == 0 and b == 0:  # for copies, run on only 1 (knstp,mlknstp) as it the same for others
+                        kwargs = config.kwargs_optimiser_simoptfct[c]
+                    else:
+                        print("Error : simoptfctkw must be spl1 or regdiff")
+
+                    copies_manifest = opt_manifest(config, ml, config.simset_copy, opts, kwargs, destpath)
+                    if config.run_on_copies and config.simoptfctkw == "regdiff" and (a, b) != (0, 0):
+                        # for copies, regdiff runs on only 1 (knstp,mlknstp) as it the same for others
+                        f.write(f"COPIES, kn{kn}, {string_ML}{ml}, optimiseur {kwargs['name']} : \n")
+                        f.write('The copies are optimised in the grid cell 0 0 only.\n')
+                        f.write('################### \n')
+                    elif config.run_on_copies and not to_optimise(copies_manifest,
+                                                                opt_outputs(destpath, config.simset_copy, opts), force):
+                        f.write(f"COPIES, kn{kn}, {string_ML}{ml}, optimiseur {kwargs['name']} : \n")
+                        write_report_optimisation(f, None)
+                        f.write('################### \n')
+                    elif config.run_on_copies:
+                        print("I will run the optimiser on the copies with the parameters :", kwargs)
+                        p = Pool(nworkers)
+                        if config.simoptfctkw == "spl1":
+                            job_args = [(j, config.simset_copy, shared.descriptor, config.simoptfct, kwargs, opts,
+                                         config.tsrand, destpath) for j in range(nworkers)]
+                            success_list_copies = p.map(exec_worker_copie_aux, job_args)
+                            p.close()
+                            p.join()
+
+                        elif config.simoptfctkw == "regdiff":
                             job_args = (
-                            0, config.simset_copy, lcs, config.simoptfct, kwargs, opts, config.tsrand, destpath)
+                            0, config.simset_copy, shared.descriptor, config.simoptfct, kwargs, opts, config.tsrand,
+                            destpath)
                             success_list_copies = exec_worker_copie_aux(job_args)
                             success_list_copies = [
                                 success_list_copies]  # we hace to turn it into a list to match spl format
@@ -136,29 +594,39 @@ def main(lensname, dataname, work_dir='./'):
                                 os.path.join(config.lens_directory, 'regdiff_copies_link_%s.pkl' % kwargs['name']),
                                 'wb'))
 
-                    f.write(f"COPIES, kn{kn}, {string_ML}{ml}, optimiseur {kwargs['name']} : \n")
-                    write_report_optimisation(f, success_list_copies)
-                    f.write('################### \n')
+                        if completed(destpath, config.simset_copy, opts):
+                            copies_manifest.write(opt_outputs(destpath, config.simset_copy, opts))
+                        f.write(f"COPIES, kn{kn}, {string_ML}{ml}, optimiseur {kwargs['name']} : \n")
+                        write_report_optimisation(f, success_list_copies)
+                        f.write('################### \n')
 
-                if config.run_on_sims:
-                    print("I will run the optimiser on the simulated lcs with the parameters :", kwargs)
-                    p = Pool(nworkers)
-                    job_args = [(j, config.simset_mock, lcs, config.simoptfct, kwargs, opts, config.tsrand, destpath) for j in range(nworkers)]
-                    """
-                    Serial version of this code :
-                        job_args = (0, config.simset_mock, lcs, config.simoptfct, kwargs, opts, config.tsrand, destpath)
-                        success_list_simu = exec_worker_mocks_aux(job_args)  # if regdiff uses another level of parallelism.
-                        success_list_simu = [success_list_simu]# p.map(exec_worker_copie_aux, job_args)
-                    """
-                    success_list_simu = p.map(exec_worker_mocks_aux, job_args)
-                    p.close()
-                    p.join()
-                    f.write(f"SIMULATIONS, kn{kn}, {string_ML}{ml}, optimiseur {kwargs['name']} : \n")
-                    write_report_optimisation(f, success_list_simu)
-                    f.write('################### \n')
+                    mocks_manifest = opt_manifest(config, ml, config.simset_mock, opts, kwargs, destpath)
+                    if config.run_on_sims and not to_optimise(mocks_manifest,
+                                                              opt_outputs(destpath, config.simset_mock, opts), force):
+                        f.write(f"SIMULATIONS, kn{kn}, {string_ML}{ml}, optimiseur {kwargs['name']} : \n")
+                        write_report_optimisation(f, None)
+                        f.write('################### \n')
+                    elif config.run_on_sims:
+                        print("I will run the optimiser on the simulated lcs with the parameters :", kwargs)
+                        p = Pool(nworkers)
+                        job_args = [(j, config.simset_mock, shared.descriptor, config.simoptfct, kwargs, opts,
+                                     config.tsrand, destpath) for j in range(nworkers)]
+                        """
+                        Serial version of this code :
+                            job_args = (0, config.simset_mock, lcs, config.simoptfct, kwargs, opts, config.tsrand, destpath)
+                            success_list_simu = exec_worker_mocks_aux(job_args)  # if regdiff uses another level of parallelism.
+                            success_list_simu = [success_list_simu]# p.map(exec_worker_copie_aux, job_args)
+                        """
+                        success_list_simu = p.map(exec_worker_mocks_aux, job_args)
+                        p.close()
+                        p.join()
+                        if completed(destpath, config.simset_mock, opts):
+                            mocks_manifest.write(opt_outputs(destpath, config.simset_mock, opts))
+                        f.write(f"SIMULATIONS, kn{kn}, {string_ML}{ml}, optimiseur {kwargs['name']} : \n")
+                        write_report_optimisation(f, success_list_simu)
+                        f.write('################### \n')
 
-    print("OPTIMISATION DONE : report written in %s" % (
-        os.path.join(config.report_directory, 'report_optimisation_%s.txt' % config.simoptfctkw)))
+    print("OPTIMISATION DONE : report written in %s" % (os.path.join(config.report_directory, report_name)))
     f.close()
 
 
@@ -169,6 +637,10 @@ if __name__ == '__main__':
     help_lensname = "name of the lens to process"
     help_dataname = "name of the data set to process (Euler, SMARTS, ... )"
     help_work_dir = "name of the working directory"
+    help_cell = "only process this grid cell (indices in the knotstep and ml lists of the config)"
+    help_max_core = "number of cores to use, overrides max_core of the config"
+    help_global_pool = "use a single pool of workers for all the grid cells, fed pickle by pickle (spl1 only)"
+    help_force = "optimise all the simsets again, even those whose inputs did not change"
     parser.add_argument(dest='lensname', type=str,
                         metavar='lens_name', action='store',
                         help=help_lensname)
@@ -178,5 +650,17 @@ if __name__ == '__main__':
     parser.add_argument('--dir', dest='work_dir', type=str,
                         metavar='', action='store', default='./',
                         help=help_work_dir)
+    parser.add_argument('--cell', dest='cell', type=int, nargs=2, default=None,
+                        metavar=('KNOTSTEP_INDEX', 'ML_INDEX'), action='store',
+                        help=help_cell)
+    parser.add_argument('--max-core', dest='max_core', type=int, default=None,
+                        metavar='', action='store',
+                        help=help_max_core)
+    parser.add_argument('--global-pool', dest='global_pool', action='store_true',
+                        help=help_global_pool)
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help=help_force)
     args = parser.parse_args()
-    main(args.lensname, args.dataname, work_dir=args.work_dir)
+    with stage_span('3c', args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell):
+        main(args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell, max_core=args.max_core,
+             global_pool=args.global_pool, force=args.force)
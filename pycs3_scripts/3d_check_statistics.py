@@ -1,45 +1,43 @@
 """
 This script simply check that the optimised mocks light curves have the same statistics than the real one in term of zruns and sigmas.
+The statistics are computed by mock_stats.py, the simsets of all the grid cells in parallel. The result is written in
+report_check_stats.txt and, one line per curve with whether it passed, in report_check_stats.csv.
 Plots are created in your figure directory.
 """
+import csv
 import matplotlib
 import pycs3.gen.stat
 import pycs3.gen.util
 import os
-import sys
-import glob
-import importlib
 from pathlib import Path
 import argparse as ap
-import numpy as np
 import logging
+from multiprocess import Pool, cpu_count
+import mock_stats
+from instrumentation import annotate, stage_span, task_span
+from plot_queue import PlotQueue
+import run_config
 matplotlib.use('Agg')
 loggerformat = 'PID %(process)06d | %(asctime)s | %(levelname)s: %(name)s(%(funcName)s): %(message)s'
 logging.basicConfig(format=loggerformat, level=logging.INFO)
 
 
 def write_report_checkstat(f, lcs, stats, combkw, sset, ooset, tolerance=1.0):
+    """
+    Writes the comparison to the report, returns the rows of the pass/fail table.
+    """
     f.write('\n')
     f.write('-' * 30 + '\n')
     f.write('%s, simset %s, optimiseur %s : \n' % (combkw, sset, ooset))
-    success = []
+    rel_error_zruns, rel_error_sig, success = mock_stats.check(stats, tolerance=tolerance)
+    rows = []
     for i, lc in enumerate(lcs):
-        origin_zruns = stats[i][0]
-        mean_mock_zruns = stats[i][1]
-        std_mock_zruns = stats[i][2]
-        origin_sig = stats[i][3]
-        mean_mock_sig = stats[i][4]
-        std_mock_sig = stats[i][5]
+        origin_zruns, mean_mock_zruns, std_mock_zruns, origin_sig, mean_mock_sig, std_mock_sig = stats[i]
         f.write("++++++ %s ++++++ \n" % lc.object)
         f.write("zruns : %.2f (obs) vs %.2f +/- %.2f (sim) \n" % (origin_zruns, mean_mock_zruns, std_mock_zruns))
         f.write("sigma : %.4f (obs) vs %.4f +/- %.4f (sim) \n" % (origin_sig, mean_mock_sig, std_mock_sig))
-
-        rel_error_zruns = np.abs(origin_zruns - mean_mock_zruns) / std_mock_zruns
-        rel_error_sig = np.abs(origin_sig - mean_mock_sig) / std_mock_sig
-        if rel_error_zruns < tolerance and rel_error_sig < tolerance:
-            success.append(True)
-        else:
-            success.append(False)
+        rows.append([combkw, sset, ooset, lc.object] + ['%.6g' % v for v in stats[i]]
+                    + ['%.4f' % rel_error_zruns[i], '%.4f' % rel_error_sig[i], bool(success[i])])
 
     if all(success):
         f.write("Successfully matched zruns and sigmas within %2.2f sigmas \n" % tolerance)
@@ -47,19 +45,45 @@ def write_report_checkstat(f, lcs, stats, combkw, sset, ooset, tolerance=1.0):
         for i, suc in enumerate(success):
             f.write("WARNING : did not matched zruns and sigmas within %2.2f sigmas for curve %s\n" % (
                 tolerance, lcs[i].object))
+    return rows
+
 
+def simset_stats(job):
+    """
+    The statistics of a simset and, for the figures, the residuals and zruns of its mocks and the residual curves of
+    its first mock (None without the figures).
+    """
+    directory, sset, ooset, orig_resi, plots = job
+    print("Analysing the residuals of simset %s, optimiser %s in %s" % (sset, ooset, directory))
+    with task_span('statistics', combkw=os.path.basename(os.path.normpath(directory)), simset=sset, optset=ooset):
+        mock_resi = mock_stats.load_residuals(directory, sset, ooset)
+        all_mock_zruns = mock_stats.mock_zruns(mock_resi)
+        stats = mock_stats.simset_stats(orig_resi, mock_resi, all_mock_zruns=all_mock_zruns)
+        if not plots:
+            return stats, None
+        return stats, (mock_resi, all_mock_zruns, mock_stats.first_mock_residuals(directory, sset, ooset))
 
-def main(lensname, dataname, work_dir='./'):
-    sys.path.append(work_dir + "config/")
-    config = importlib.import_module("config_" + lensname + "_" + dataname)
+
+def main(lensname, dataname, work_dir='./', cell=None, max_core=None, plots=True):
+    config = run_config.load(lensname, dataname, work_dir)
+    if max_core is not None:
+        config.max_core = max_core
+    if cell is not None:
+        annotate(combkw=config.combkw[cell[0], cell[1]])
+    processes = cpu_count() if config.max_core is None else config.max_core
     n_curves = len(config.lcs_label)
     check_stat_plot_dir = config.figure_directory + 'check_stat_plots/'
     report_file = os.path.join(config.report_directory, 'report_check_stats.txt')
-    f = open(report_file, 'w')
-    f.write('### REPORT STATISTICS ###')
+    if cell is not None:
+        # one report per grid cell, several cells can run at the same time.
+        report_file = os.path.join(config.report_directory, f'report_check_stats_{config.combkw[cell[0], cell[1]]}.txt')
+    table_file = report_file[:-len('.txt')] + '.csv'
 
     if not os.path.isdir(check_stat_plot_dir):
-        os.mkdir(check_stat_plot_dir)
+        os.makedirs(check_stat_plot_dir, exist_ok=True)
+    queue = PlotQueue(check_stat_plot_dir, processes=processes, enabled=plots)
+    jobs = []
+    checks = []
 
     if config.mltype == "splml":
         if config.forcen:
@@ -76,6 +100,8 @@ def main(lensname, dataname, work_dir='./'):
 
     for i, kn in enumerate(config.knotstep):
         for j, ml in enumerate(ml_param):
+            if cell is not None and (i, j) != tuple(cell):
+                continue
             if type(ml) is list:
                 assert len(ml) == n_curves, 'mismatch between the provided list of MLs and curves (number of)'
             elif type(ml) is str:
@@ -86,8 +112,9 @@ def main(lensname, dataname, work_dir='./'):
             simset_available = [str(e) for e in ppp.glob('sims_mocks_*')]
             lcs, spline = pycs3.gen.util.readpickle(
                 config.lens_directory + config.combkw[i, j] + f"/initopt_{dataname}_ks{kn}_{string_ML}{ml}.pkl")
+            orig_resi = mock_stats.orig_residuals(lcs, spline)
 
-            for a in simset_available:
+            for a in sorted(simset_available):
                 a = a.split('/')[-1]
 
                 if "_opt_" in a:  # take only the optimised sub-folders
@@ -97,18 +124,38 @@ def main(lensname, dataname, work_dir='./'):
                     if ooset[0:7] == 'regdiff':
                         continue  # it makes no sens to use this function for regdiff
                     else:
-                        stats = pycs3.gen.stat.anaoptdrawn(lcs, spline, simset=sset, optset=ooset, showplot=False,
-                                                           nplots=1,
-                                                           directory=config.lens_directory + config.combkw[i, j] + '/',
-                                                           plotpath= check_stat_plot_dir, id =config.combkw[i, j])
-                        # move the figure to the correct directory :
-                        # os.system("mv " + "fig_anaoptdrawn_%s_%s_resi_1.png " % (sset, ooset) + check_stat_plot_dir
-                        #           + "%s_fig_anaoptdrawn_%s_%s_resi_1.png" % (config.combkw[i, j], sset, ooset))
-                        # os.system("mv " + "fig_anaoptdrawn_%s_%s_resihists.png " % (sset, ooset) + check_stat_plot_dir
-                        #           + "%s_fig_anaoptdrawn_%s_%s_resihists.png" % (config.combkw[i, j], sset, ooset))
-                        write_report_checkstat(f, lcs, stats, config.combkw[i, j], sset, ooset)
+                        directory = config.lens_directory + config.combkw[i, j] + '/'
+                        jobs.append((directory, sset, ooset, orig_resi, plots))
+                        checks.append((lcs, spline, config.combkw[i, j], sset, ooset))
+
+    # the simsets are independent, they are analysed in parallel
+    if processes == 1 or len(jobs) <= 1:
+        results = [simset_stats(job) for job in jobs]
+    else:
+        with Pool(min(processes, len(jobs))) as p:
+            results = p.map(simset_stats, jobs, chunksize=1)
 
+    f = open(report_file, 'w')
+    f.write('### REPORT STATISTICS ###')
+    rows = []
+    for (lcs, spline, combkw, sset, ooset), (stats, figure_data) in zip(checks, results):
+        rows += write_report_checkstat(f, lcs, stats, combkw, sset, ooset)
+        if figure_data is not None:
+            # the figures of anaoptdrawn, drawn from the residuals and statistics computed above, rendered at the end
+            mock_resi, all_mock_zruns, first_mock_rlcs = figure_data
+            orig_rlcs = pycs3.gen.stat.subtract(lcs, spline)
+            queue.add(check_stat_plot_dir + "%s_fig_anaoptdrawn_%s_%s_resihists.png" % (combkw, sset, ooset),
+                      mock_stats.plot_resihists, orig_rlcs, stats, mock_resi, all_mock_zruns)
+            queue.add(check_stat_plot_dir + "%s_fig_anaoptdrawn_%s_%s_resi_1.png" % (combkw, sset, ooset),
+                      pycs3.gen.stat.plotresiduals, [orig_rlcs, first_mock_rlcs], nicelabel=False,
+                      showlegend=False, showsigmalines=False, errorbarcolour="#999999")
     f.close()
+    with open(table_file, 'w', newline='') as tf:
+        writer = csv.writer(tf)
+        writer.writerow(mock_stats.TABLE_COLUMNS)
+        writer.writerows(rows)
+    print("Report written in %s, table in %s" % (report_file, table_file))
+    queue.render()
 
 
 if __name__ == '__main__':
@@ -118,6 +165,9 @@ if __name__ == '__main__':
     help_lensname = "name of the lens to process"
     help_dataname = "name of the data set to process (Euler, SMARTS, ... )"
     help_work_dir = "name of the working directory"
+    help_cell = "only process this grid cell (indices in the knotstep and ml lists of the config)"
+    help_max_core = "number of cores used to analyse the simsets and render the figures, overrides max_core of the config"
+    help_no_plots = "do not render the figures"
     parser.add_argument(dest='lensname', type=str,
                         metavar='lens_name', action='store',
                         help=help_lensname)
@@ -127,5 +177,15 @@ if __name__ == '__main__':
     parser.add_argument('--dir', dest='work_dir', type=str,
                         metavar='', action='store', default='./',
                         help=help_work_dir)
+    parser.add_argument('--cell', dest='cell', type=int, nargs=2, default=None,
+                        metavar=('KNOTSTEP_INDEX', 'ML_INDEX'), action='store',
+                        help=help_cell)
+    parser.add_argument('--max-core', dest='max_core', type=int, default=None,
+                        metavar='', action='store',
+                        help=help_max_core)
+    parser.add_argument('--no-plots', dest='no_plots', action='store_true',
+                        help=help_no_plots)
     args = parser.parse_args()
-    main(args.lensname, args.dataname, work_dir=args.work_dir)
+    with stage_span('3d', args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell):
+        main(args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell, max_core=args.max_core,
+             plots=not args.no_plots)
@@ -9,29 +9,59 @@ import pycs3.sim.plot
 import pycs3.gen.util
 import pycs3.tdcomb.plot
 import pycs3.tdcomb.comb
-import sys
+import mock_store
 import os
-import importlib
 import argparse as ap
 import pickle as pkl
 import logging
+import warnings
+from multiprocess import cpu_count
+from instrumentation import annotate, stage_span
+from plot_queue import PlotQueue
+import run_config
 loggerformat='%(message)s'
 logging.basicConfig(format=loggerformat,level=logging.INFO)
 
 
-def main(lensname, dataname, work_dir='./'):
-    sys.path.append(work_dir + "config/")
-    config = importlib.import_module("config_" + lensname + "_" + dataname)
+def write_dataout(plot_func, rrlist, outdir, **kwargs):
+    """
+    Writes the <autoname>_delays.pkl or _errorbars.pkl of pycs3.sim.plot.hists or measvstrue (dataout=True).
+    The figure is drawn on the non-interactive Agg backend and thrown away without being rendered, the queue renders
+    it separately.
+    """
+    backend = plt.get_backend()
+    plt.switch_backend('Agg')
+    try:
+        with warnings.catch_warnings():
+            # with filename=None, the functions call plt.show(), which does nothing on Agg
+            warnings.simplefilter('ignore', UserWarning)
+            plot_func(rrlist, dataout=True, outdir=outdir, filename=None, **kwargs)
+    finally:
+        plt.close('all')
+        plt.switch_backend(backend)
+
+
+def main(lensname, dataname, work_dir='./', cell=None, max_core=None, plots=True):
+    config = run_config.load(lensname, dataname, work_dir)
+    if max_core is not None:
+        config.max_core = max_core
+    if cell is not None:
+        annotate(combkw=config.combkw[cell[0], cell[1]])
+    processes = cpu_count() if config.max_core is None else config.max_core
 
     regdiff_dir = os.path.join(config.lens_directory, "regdiff_outputs/")
     figure_directory = config.figure_directory + "final_results/"
     if not os.path.isdir(figure_directory):
-        os.mkdir(figure_directory)
+        os.makedirs(figure_directory, exist_ok=True)
     if not os.path.isdir(regdiff_dir):
-        os.mkdir(regdiff_dir)
+        os.makedirs(regdiff_dir, exist_ok=True)
+    # the delays and error bars are written here, the figures are rendered at the end
+    queue = PlotQueue(figure_directory, processes=processes, enabled=plots or config.display, display=config.display)
 
     binclip = True  # be careful this could be dangerous, make sure you kick out only outlier otherwise errror bar will be underestimated. TODO : add warning if you exceed a certain percentage of rejected curves
     binclipr = 40.0  # rather conservative value
+    # the delays of the copies: the same for the pickle (read by 4b) and the figure
+    hists_kwargs = dict(r=50.0, nbins=100, usemedian=True)
     if config.mltype == "splml":
         if config.forcen:
             ml_param = config.nmlspl
@@ -47,39 +77,46 @@ def main(lensname, dataname, work_dir='./'):
 
     for a, kn in enumerate(config.knotstep):
         for b, ml in enumerate(ml_param):
+            if cell is not None and (a, b) != tuple(cell):
+                continue
             for o, opt in enumerate(config.optset):
 
                 # simulations
                 toplot = []
-                simres = [pycs3.sim.run.collect(
+                simres = [mock_store.collect(
                     config.lens_directory + config.combkw[a, b] + '/sims_%s_opt_%s' % (config.simset_mock, opt),
                     'blue', dataname + "_" + config.combkw[a, b])]
 
                 # Copies :
                 if config.simoptfctkw == "regdiff":
                     kwargs = config.kwargs_optimiser_simoptfct[o]
-                    dir_link = pkl.load(
-                        open(os.path.join(config.lens_directory, 'regdiff_copies_link_%s.pkl' % kwargs['name']), 'rb'))
 
+                    # the copies are only optimised (3c) and measured (here) in the grid cell 0 0, the same for all
+                    regdiff_copie_dir = os.path.join(regdiff_dir, "copies/")
                     if a == 0 and b == 0:
-                        regdiff_copie_dir = os.path.join(regdiff_dir, "copies/")
+                        dir_link = pkl.load(
+                            open(os.path.join(config.lens_directory, 'regdiff_copies_link_%s.pkl' % kwargs['name']),
+                                 'rb'))
                         if not os.path.isdir(regdiff_copie_dir):
-                            os.mkdir(regdiff_copie_dir)
-                        copiesres = [pycs3.sim.run.collect(dir_link, 'blue',
-                                                           dataname + "_regdiff_%s" % kwargs['name'])]
-                        pycs3.sim.plot.hists(copiesres, r=50.0, nbins=100, dataout=True, usemedian=True,
-                                             filename=figure_directory + f"delay_hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png",
-                                             outdir=regdiff_copie_dir)
+                            os.makedirs(regdiff_copie_dir, exist_ok=True)
+                        copiesres = [mock_store.collect(dir_link, 'blue',
+                                                        dataname + "_regdiff_%s" % kwargs['name'])]
+                        write_dataout(pycs3.sim.plot.hists, copiesres, regdiff_copie_dir, **hists_kwargs)
+                        queue.add(figure_directory + f"delay_hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png",
+                                  pycs3.sim.plot.hists, copiesres, **hists_kwargs)
+                    elif not os.path.exists(regdiff_copie_dir + 'sims_%s_opt_%s_delays.pkl' % (config.simset_copy, opt)):
+                        raise RuntimeError("The delays of the regdiff copies are written by the grid cell 0 0, "
+                                           "run it first (--cell 0 0).")
 
                     regdiff_mocks_dir = os.path.join(regdiff_dir, f"mocks_knt{kn}_mlknt{ml}/")
                     if not os.path.isdir(regdiff_mocks_dir):
-                        os.mkdir(regdiff_mocks_dir)
-                    pycs3.sim.plot.measvstrue(simres, r=2 * config.truetsr, nbins=1, plotpoints=True,
-                                              ploterrorbars=True, sidebyside=True,
-                                              errorrange=5., binclip=binclip, binclipr=binclipr, dataout=True,
-                                              figsize=(12, 9),
-                                              filename=figure_directory + f"deviation_hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png",
-                                              outdir=regdiff_mocks_dir)
+                        os.makedirs(regdiff_mocks_dir, exist_ok=True)
+                    measvstrue_kwargs = dict(r=2 * config.truetsr, nbins=1, plotpoints=True, ploterrorbars=True,
+                                             sidebyside=True, errorrange=5., binclip=binclip, binclipr=binclipr,
+                                             figsize=(12, 9))
+                    write_dataout(pycs3.sim.plot.measvstrue, simres, regdiff_mocks_dir, **measvstrue_kwargs)
+                    queue.add(figure_directory + f"deviation_hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png",
+                              pycs3.sim.plot.measvstrue, simres, **measvstrue_kwargs)
 
                     cscontainer = pycs3.tdcomb.comb.CScontainer("Regdiff kn%s %s%s"%(kn, string_ML, ml), knots=str(kn), ml=str(ml),
                                                               result_file_delays=regdiff_copie_dir + 'sims_%s_opt_%s_delays.pkl' % (
@@ -88,19 +125,15 @@ def main(lensname, dataname, work_dir='./'):
                                                                   config.simset_mock, opt))
 
                 elif config.simoptfctkw == "spl1":
-                    copiesres = [pycs3.sim.run.collect(
+                    copiesres = [mock_store.collect(
                         config.lens_directory + config.combkw[a, b] + '/sims_%s_opt_%s' % (config.simset_copy, opt),
                         'blue',
                         dataname + "_" + config.combkw[a, b])]
 
-                    pycs3.sim.plot.hists(copiesres, r=50.0, nbins=100, dataout=True, usemedian=True,
-                                         filename=figure_directory + f"deviation_hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png",
-                                         outdir=config.lens_directory + config.combkw[a, b] + '/sims_%s_opt_%s/' % (
-                                             config.simset_copy, opt))
-                    pycs3.sim.plot.hists(copiesres, r=50.0, nbins=100, dataout=True, usemedian=True,
-                                         filename=figure_directory + f'hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png',
-                                         outdir=config.lens_directory + config.combkw[a, b] + '/sims_%s_opt_%s/' % (
-                                             config.simset_copy, opt))
+                    write_dataout(pycs3.sim.plot.hists, copiesres, config.lens_directory + config.combkw[a, b] +
+                                  '/sims_%s_opt_%s/' % (config.simset_copy, opt), **hists_kwargs)
+                    queue.add(figure_directory + f'hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png',
+                              pycs3.sim.plot.hists, copiesres, **hists_kwargs)
 
                     covplotdir = os.path.join(figure_directory, f"covplot_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}")
                     os.makedirs(covplotdir, exist_ok=True)
@@ -108,14 +141,13 @@ def main(lensname, dataname, work_dir='./'):
                     #                          figsize=(12, 9),
                     #                          filepath=covplotdir)
 
-                    pycs3.sim.plot.measvstrue(simres, r=2 * config.truetsr, nbins=1, plotpoints=True,
-                                              ploterrorbars=True, sidebyside=True,
-                                              errorrange=10., binclip=binclip, binclipr=binclipr, dataout=True,
-                                              figsize=(12, 9),
-                                              filename=figure_directory + f"deviation_hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png",
-                                              outdir=config.lens_directory + config.combkw[
-                                                  a, b] + '/sims_%s_opt_%s/' % (
-                                                         config.simset_copy, opt))
+                    measvstrue_kwargs = dict(r=2 * config.truetsr, nbins=1, plotpoints=True, ploterrorbars=True,
+                                             sidebyside=True, errorrange=10., binclip=binclip, binclipr=binclipr,
+                                             figsize=(12, 9))
+                    write_dataout(pycs3.sim.plot.measvstrue, simres, config.lens_directory + config.combkw[a, b] +
+                                  '/sims_%s_opt_%s/' % (config.simset_copy, opt), **measvstrue_kwargs)
+                    queue.add(figure_directory + f"deviation_hist_{kn}-{ml}_sims_{config.simset_copy}_opt_{opt}.png",
+                              pycs3.sim.plot.measvstrue, simres, **measvstrue_kwargs)
 
 
                     cscontainer = pycs3.tdcomb.comb.CScontainer("Spline kn%s %s%s"%(kn, string_ML,ml), knots=str(kn), ml=str(ml),
@@ -133,18 +165,15 @@ def main(lensname, dataname, work_dir='./'):
                                                                                         config.simset_mock, opt))
                     print(cscontainer.result_file_delays)
 
-                if config.display:
-                    plt.show()
-
                 toplot.append(pycs3.tdcomb.comb.getresults(cscontainer, useintrinsic=False))
 
                 text = [(0.12, 0.9, r"$\mathrm{" + config.full_lensname + "}$", {"fontsize": 22})]
 
-                pycs3.tdcomb.plot.delayplot(toplot, rplot=10.0, displaytext=True, text=text, showlegend=False,
-                                          filename=figure_directory + f"fig_delays_{kn}-{ml}_{config.simset_mock}_{opt}.png", autoobj=config.lcs_label)
+                queue.add(figure_directory + f"fig_delays_{kn}-{ml}_{config.simset_mock}_{opt}.png",
+                          pycs3.tdcomb.plot.delayplot, toplot, rplot=10.0, displaytext=True, text=text,
+                          showlegend=False, autoobj=config.lcs_label)
 
-                if config.display:
-                    plt.show()
+    queue.render()
 
 
 if __name__ == '__main__':
@@ -154,6 +183,9 @@ if __name__ == '__main__':
     help_lensname = "name of the lens to process"
     help_dataname = "name of the data set to process (Euler, SMARTS, ... )"
     help_work_dir = "name of the working directory"
+    help_cell = "only process this grid cell (indices in the knotstep and ml lists of the config)"
+    help_max_core = "number of cores used to render the figures, overrides max_core of the config"
+    help_no_plots = "do not render the figures, only write the delays and error bars"
     parser.add_argument(dest='lensname', type=str,
                         metavar='lens_name', action='store',
                         help=help_lensname)
@@ -163,5 +195,15 @@ if __name__ == '__main__':
     parser.add_argument('--dir', dest='work_dir', type=str,
                         metavar='', action='store', default='./',
                         help=help_work_dir)
+    parser.add_argument('--cell', dest='cell', type=int, nargs=2, default=None,
+                        metavar=('KNOTSTEP_INDEX', 'ML_INDEX'), action='store',
+                        help=help_cell)
+    parser.add_argument('--max-core', dest='max_core', type=int, default=None,
+                        metavar='', action='store',
+                        help=help_max_core)
+    parser.add_argument('--no-plots', dest='no_plots', action='store_true',
+                        help=help_no_plots)
     args = parser.parse_args()
-    main(args.lensname, args.dataname, work_dir=args.work_dir)
+    with stage_span('4a', args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell):
+        main(args.lensname, args.dataname, work_dir=args.work_dir, cell=args.cell, max_core=args.max_core,
+             plots=not args.no_plots)
@@ -4,17 +4,18 @@ Groups to combine.  See Bonvin et al.(2018,2019) and Millon et al. (2020) for de
 """
 import argparse as ap
 import copy
-import importlib
 import logging
 import os
 import pickle as pkl
-import sys
 
 import matplotlib.style
 import numpy as np
 
 import pycs3.tdcomb.comb
 import pycs3.tdcomb.plot
+from instrumentation import stage_span
+from plot_queue import PlotQueue
+import run_config
 
 loggerformat='%(message)s'
 logging.basicConfig(format=loggerformat,level=logging.INFO)
@@ -23,9 +24,8 @@ matplotlib.style.use('classic')
 matplotlib.rc('font', family="Times New Roman")
 
 
-def main(lensname, dataname, work_dir='./'):
-    sys.path.append(work_dir + "config/")
-    config = importlib.import_module("config_" + lensname + "_" + dataname)
+def main(lensname, dataname, work_dir='./', plots=True):
+    config = run_config.load(lensname, dataname, work_dir)
     marginalisation_plot_dir = config.figure_directory + 'marginalisation_plots/'
 
     if not os.path.isdir(marginalisation_plot_dir):
@@ -164,11 +164,6 @@ def main(lensname, dataname, work_dir='./'):
         auto_radius = False
         figsize = (15, 10)
 
-    if config.display:
-        pycs3.tdcomb.plot.delayplot(group_list + [combined], rplot=radius, refgroup=combined, text=text, hidedetails=True,
-                                  showbias=False, showran=False, showlegend=True, figsize=figsize,
-                                  horizontaldisplay=False, legendfromrefgroup=False, auto_radius=auto_radius,
-                                  tick_step_auto=True)
     ############# TMP blinding
     #mmult = lambda x: x * 1.0928
     #for gg in group_list + [combined]:
@@ -176,11 +171,12 @@ def main(lensname, dataname, work_dir='./'):
     #    gg.errors_up = list(map(mmult, gg.errors_up))
     #    gg.errors_down = list(map(mmult, gg.errors_down))
 
-    pycs3.tdcomb.plot.delayplot(group_list + [combined], rplot=radius, refgroup=combined, text=text,
-                              autoobj=config.lcs_label,
-                              hidedetails=True, showbias=False, showran=False, showlegend=True, auto_radius=auto_radius,
-                              figsize=figsize, horizontaldisplay=False, legendfromrefgroup=False, tick_step_auto=True,
-                              filename=indiv_marg_dir + config.name_marg_spline + "_sigma_%2.2f.png" % config.sigmathresh)
+    queue = PlotQueue(indiv_marg_dir, enabled=plots or config.display, display=config.display)
+    queue.add(indiv_marg_dir + config.name_marg_spline + "_sigma_%2.2f.png" % config.sigmathresh,
+              pycs3.tdcomb.plot.delayplot, group_list + [combined], rplot=radius, refgroup=combined, text=text,
+              autoobj=config.lcs_label,
+              hidedetails=True, showbias=False, showran=False, showlegend=True, auto_radius=auto_radius,
+              figsize=figsize, horizontaldisplay=False, legendfromrefgroup=False, tick_step_auto=True)
 
     pkl.dump(group_list,
              open(marginalisation_dir + config.name_marg_spline + "_sigma_%2.2f" % config.sigmathresh + '_groups.pkl',
@@ -191,6 +187,8 @@ def main(lensname, dataname, work_dir='./'):
     pkl.dump(surviving_groups,
          open(marginalisation_dir + config.name_marg_spline + "_sigma_%2.2f" % config.sigmathresh + '_groups_used_in_combined.pkl',
               'wb'))
+    # rendered once the results are written
+    queue.render()
 
 
 if __name__ == '__main__':
@@ -200,6 +198,7 @@ if __name__ == '__main__':
     help_lensname = "name of the lens to process"
     help_dataname = "name of the data set to process (Euler, SMARTS, ... )"
     help_work_dir = "name of the working directory"
+    help_no_plots = "do not render the figure"
     parser.add_argument(dest='lensname', type=str,
                         metavar='lens_name', action='store',
                         help=help_lensname)
@@ -209,7 +208,10 @@ if __name__ == '__main__':
     parser.add_argument('--dir', dest='work_dir', type=str,
                         metavar='', action='store', default='./',
                         help=help_work_dir)
+    parser.add_argument('--no-plots', dest='no_plots', action='store_true',
+                        help=help_no_plots)
     args = parser.parse_args()
-    main(args.lensname, args.dataname, work_dir=args.work_dir)
+    with stage_span('4b', args.lensname, args.dataname, work_dir=args.work_dir):
+        main(args.lensname, args.dataname, work_dir=args.work_dir, plots=not args.no_plots)
 
 # TODO : add exception if there is no error bars measured
@@ -1,13 +1,19 @@
 import sys
 import pickle
+import argparse as ap
 from pathlib import Path
 import numpy as np
 import pandas as pd
-from scipy.stats import sigmaclip
-from scipy.optimize import brentq
+from multiprocess import Pool
 
 import pycs3.sim.run
 
+import mock_store
+from instrumentation import stage_span, task_span
+
+# width of the bins of the error sketches of the streaming mode, in days
+SKETCH_WIDTH = 0.01
+
 
 def load_groups(directory: Path) -> list:
     """Load group information from pickle files produced during 4b"""
@@ -56,21 +62,28 @@ def get_accepted_params(groups: list) -> list:
     return accepted_params
 
 
-def load_mock_results(spls: list, accepted_params: list, directory: Path):
-    """Load mock results that match the accepted parameters."""
-    all_tsarray = []
-    all_truetsarray = []
-    all_results = []
+def mock_paths(spls: list, accepted_params: list) -> list:
+    """The optimised mocks directories of the estimators that match the accepted parameters."""
+    paths = []
     for spl in spls:
         if not any(param[0] in spl.name and param[1] in spl.name for param in accepted_params):
             continue
-        print(f'Loading mocks from {spl}')
         possible_paths = list(spl.glob('sims_mocks*opt*'))
         if not possible_paths:
             print(f'No mocks found in {spl}, skipping.')
             continue
-        path = max(possible_paths)  # there should be only one path, but max will select that with the most mocks.
-        results = pycs3.sim.run.collect(directory=path)
+        paths.append(max(possible_paths))  # there should be only one path, but max will select that with the most mocks.
+    return paths
+
+
+def load_mock_results(spls: list, accepted_params: list, directory: Path):
+    """Load mock results that match the accepted parameters."""
+    all_tsarray = []
+    all_truetsarray = []
+    all_results = []
+    for path in mock_paths(spls, accepted_params):
+        print(f'Loading mocks from {path.parent}')
+        results = mock_store.collect(directory=path)
         all_tsarray.append(results.tsarray)
         all_truetsarray.append(results.truetsarray)
         all_results.append(results)
@@ -88,85 +101,314 @@ def desired_std_from_percentiles(error: np.ndarray) -> float:
     return (upper - lower) / 2.0
 
 
-def find_optimal_clip_sigma(error: np.ndarray, desired_std: float, sigma_bounds=(2.0, 5.0), tol=1e-2) -> float:
+class SortedSigmaClip:
+    """
+    scipy.stats.sigmaclip of each column of a matrix, for any clip sigma, without clipping the data again:
+    the columns are sorted once, the clipped values are then always a range of the sorted values, and the mean and
+    std of any range come from the prefix sums of x and x**2.
+    """
+    def __init__(self, errors: np.ndarray):
+        values = np.sort(np.asarray(errors, dtype=float), axis=0)
+        # centred on the medians, so that the sums of squares do not lose precision
+        centre = values[len(values) // 2]
+        centred = values - centre
+        self._prefix_sums(values, np.ones_like(values), centred, centred ** 2, centre)
+
+    @classmethod
+    def from_sketches(cls, sketches: list) -> 'SortedSigmaClip':
+        """The same on the bins of one ErrorSketch per column, the values of a bin all count as their mean."""
+        k = len(sketches)
+        size = max(len(sketch.bins) for sketch in sketches)
+        # the columns are padded with empty bins at +inf
+        values = np.full((size, k), np.inf)
+        counts, sums, sums2 = np.zeros((size, k)), np.zeros((size, k)), np.zeros((size, k))
+        for c, sketch in enumerate(sketches):
+            nbins = len(sketch.bins)
+            values[:nbins, c] = sketch.values()
+            counts[:nbins, c], sums[:nbins, c], sums2[:nbins, c] = sketch.counts, sketch.sums, sketch.sums2
+        clipper = cls.__new__(cls)
+        clipper._prefix_sums(values, counts, sums, sums2, np.zeros(k))
+        return clipper
+
+    def _prefix_sums(self, values, counts, sums, sums2, centre):
+        self.sorted = values
+        self.n, self.k = values.shape
+        self.cols = np.arange(self.k)
+        self.centre = centre
+        zeros = np.zeros((1, self.k))
+        self.s0 = np.vstack((zeros, np.cumsum(counts, axis=0)))
+        self.s1 = np.vstack((zeros, np.cumsum(sums, axis=0)))
+        self.s2 = np.vstack((zeros, np.cumsum(sums2, axis=0)))
+
+    def moments(self, lo, hi):
+        """Mean and std of the sorted values lo to hi (excluded) of each column."""
+        size = self.s0[hi, self.cols] - self.s0[lo, self.cols]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (self.s1[hi, self.cols] - self.s1[lo, self.cols]) / size
+            var = (self.s2[hi, self.cols] - self.s2[lo, self.cols]) / size - mean ** 2
+        return mean + self.centre, np.sqrt(np.maximum(var, 0.0))
+
+    def clip(self, clip_sigma):
+        """
+        Same fixed point as sigmaclip(column, low=clip_sigma, high=clip_sigma), for each column.
+        Returns the range of the sorted values kept, the lower and upper clipping values, and the std of the kept values.
+        """
+        clip_sigma = np.broadcast_to(np.asarray(clip_sigma, dtype=float), (self.k,))
+        lo = np.zeros(self.k, dtype=int)
+        hi = np.full(self.k, self.n)
+        while True:
+            mean, std = self.moments(lo, hi)
+            lower = mean - std * clip_sigma
+            upper = mean + std * clip_sigma
+            new_lo = np.maximum(lo, [np.searchsorted(self.sorted[:, c], lower[c], side='left') for c in self.cols])
+            new_hi = np.minimum(hi, [np.searchsorted(self.sorted[:, c], upper[c], side='right') for c in self.cols])
+            new_lo = np.minimum(new_lo, new_hi)
+            if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi):
+                return lo, hi, lower, upper, std
+            lo, hi = new_lo, new_hi
+
+
+def find_optimal_clip_sigma(clipper: SortedSigmaClip, desired_std: np.ndarray, sigma_bounds=(2.0, 5.0),
+                            tol=1e-2) -> np.ndarray:
     """
-    Find the clip_sigma such that the standard deviation of the clipped error
+    Find, for each column of the clipper, the clip_sigma such that the standard deviation of the clipped error
     matches the desired_std.
     In other words: cutting the tails so the standard deviation matches the 84-16 percentiles interval.
 
-    Uses a root-finding approach to solve:
+    Bisection on all the columns at once of:
         std(clipped_error) - desired_std = 0
     """
-    
+    desired_std = np.asarray(desired_std, dtype=float)
+
     def objective(clip_sigma):
-        clipped, lower, upper = sigmaclip(error, low=clip_sigma, high=clip_sigma)
-        if len(clipped) == 0:
-            return desired_std  # no data left; return the difference as desired_std
-        print('clip sigma: ', clip_sigma, 'obj: ', np.std(clipped))
-        return np.std(clipped) - desired_std
+        lo, hi, _, _, std = clipper.clip(clip_sigma)
+        # no data left: return the difference as desired_std
+        return np.where(hi > lo, std - desired_std, desired_std)
 
-    lower_bound, upper_bound = sigma_bounds
-    try:
-        # ensure the objective changes sign over the interval
-        obj_lower = objective(lower_bound)
-        obj_upper = objective(upper_bound)
-        if obj_lower * obj_upper > 0:
-            print(f"Warning: No root found for sigma clipping within bounds {sigma_bounds}.")
-            print(f"Objective at lower bound ({lower_bound}): {obj_lower}")
-            print(f"Objective at upper bound ({upper_bound}): {obj_upper}")
-            return 3.5  # default if no root is found
-
-        # Find the root using Brent's method
-        optimal_sigma = brentq(objective, lower_bound, upper_bound, xtol=tol)
-        return optimal_sigma
-    except Exception as e:
-        print(f"Error finding optimal clip_sigma: {e}")
-        return 3.5  # default value in case of error
+    lower_bound = np.full(clipper.k, sigma_bounds[0])
+    upper_bound = np.full(clipper.k, sigma_bounds[1])
+    # ensure the objective changes sign over the interval
+    obj_lower = objective(lower_bound)
+    obj_upper = objective(upper_bound)
+    no_root = obj_lower * obj_upper > 0
+    for c in np.flatnonzero(no_root):
+        print(f"Warning: No root found for sigma clipping within bounds {sigma_bounds} (column {c}).")
+        print(f"Objective at lower bound ({sigma_bounds[0]}): {obj_lower[c]}")
+        print(f"Objective at upper bound ({sigma_bounds[1]}): {obj_upper[c]}")
 
+    while np.max(upper_bound - lower_bound) > tol:
+        middle = (lower_bound + upper_bound) / 2.0
+        obj_middle = objective(middle)
+        left = obj_lower * obj_middle <= 0
+        upper_bound = np.where(left, middle, upper_bound)
+        lower_bound = np.where(left, lower_bound, middle)
+        obj_lower = np.where(left, obj_lower, obj_middle)
+    return np.where(no_root, 3.5, (lower_bound + upper_bound) / 2.0)  # default if no root is found
 
-def compute_errors(labels: list, lensed_images: list, results):
-    """Compute errors, determine desired std, find optimal sigma clipping, and apply clipping."""
-    errors = []
-    interval16_84 = []
+
+def label_errors(labels: list, lensed_images: list, tsarray: np.ndarray, truetsarray: np.ndarray) -> np.ndarray:
+    """Measured minus true delay of each mock, one column per label."""
+    error_matrix = []
     for label in labels:
         im_ref, im = label[:-1], label[-1:]
         im_ref_idx = lensed_images.index(im_ref)
         im_idx = lensed_images.index(im)
 
-        measured_delays = results.tsarray[:, im_idx] - results.tsarray[:, im_ref_idx]
-        true_delays = results.truetsarray[:, im_idx] - results.truetsarray[:, im_ref_idx]
-        error = measured_delays - true_delays
+        measured_delays = tsarray[:, im_idx] - tsarray[:, im_ref_idx]
+        true_delays = truetsarray[:, im_idx] - truetsarray[:, im_ref_idx]
+        error_matrix.append(measured_delays - true_delays)
+    return np.column_stack(error_matrix)
 
-        # desired standard deviation from 84 - 16 percentiles
-        desired_std = desired_std_from_percentiles(error)
-        interval16_84_width = desired_std * 2  # desired_std = (p(84) - p(16))/2
-        interval16_84.append(desired_std)
 
+def print_desired_std(labels: list, interval16_84: list):
+    for label, desired_std in zip(labels, interval16_84):
+        interval16_84_width = desired_std * 2  # desired_std = (p(84) - p(16))/2
         print(f'{label}: Desired 16-84 percentile interval width: {interval16_84_width:.2f}')
 
-        # optimal clip_sigma
-        optimal_clip_sigma = find_optimal_clip_sigma(error, desired_std)
 
-        print(f'{label}: Optimal clip_sigma found: {optimal_clip_sigma:.2f}')
+def compute_errors(labels: list, lensed_images: list, results):
+    """Compute errors, determine desired std, find optimal sigma clipping, and apply clipping."""
+    error_matrix = label_errors(labels, lensed_images, results.tsarray, results.truetsarray)
+
+    # desired standard deviation from 84 - 16 percentiles
+    interval16_84 = [desired_std_from_percentiles(error) for error in error_matrix.T]
+    print_desired_std(labels, interval16_84)
+
+    # optimal clip_sigma, for all the labels at once
+    clipper = SortedSigmaClip(error_matrix)
+    optimal_clip_sigmas = find_optimal_clip_sigma(clipper, interval16_84)
 
-        # sigma clipping with optimal clip_sigma
-        clipped_error, lower_clip, upper_clip = sigmaclip(error, low=optimal_clip_sigma, high=optimal_clip_sigma)
+    # sigma clipping with optimal clip_sigma
+    _, _, lower_clips, upper_clips, _ = clipper.clip(optimal_clip_sigmas)
+    errors = []
+    for c, label in enumerate(labels):
+        error = error_matrix[:, c]
+        print(f'{label}: Optimal clip_sigma found: {optimal_clip_sigmas[c]:.2f}')
         error_clipped = error.copy()  # seems overcomplicated, but I want to keep track of excluded values in all mocks
-        mask = (error > upper_clip) | (error < lower_clip)
+        mask = (error > upper_clips[c]) | (error < lower_clips[c])
         error_clipped[mask] = np.nan
         num_excluded = np.sum(mask)
-        print(f"{label}: Excluding {num_excluded} mocks out of {error.size} (sigma={optimal_clip_sigma:.2f})")
+        print(f"{label}: Excluding {num_excluded} mocks out of {error.size} (sigma={optimal_clip_sigmas[c]:.2f})")
 
         errors.append(error_clipped)  # here errors has NaNs for clipped values.
     return errors, interval16_84
 
 
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: script.py <lens> <dataset>")
-        sys.exit(1)
-    
-    lens, dataset = sys.argv[1:]
+class ErrorSketch:
+    """
+    Mergeable histogram of the errors of one label: number, sum and sum of squares of the errors in bins of
+    SKETCH_WIDTH days. Its quantiles are exact to a bin width, whatever the number of mocks.
+    """
+    def __init__(self, width: float = None):
+        self.width = SKETCH_WIDTH if width is None else width
+        self.bins = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0)
+        self.sums = np.empty(0)
+        self.sums2 = np.empty(0)
+
+    def _add_bins(self, bins, counts, sums, sums2):
+        self.bins, inverse = np.unique(np.concatenate((self.bins, bins)), return_inverse=True)
+        size = len(self.bins)
+        self.counts = np.bincount(inverse, weights=np.concatenate((self.counts, counts)), minlength=size)
+        self.sums = np.bincount(inverse, weights=np.concatenate((self.sums, sums)), minlength=size)
+        self.sums2 = np.bincount(inverse, weights=np.concatenate((self.sums2, sums2)), minlength=size)
+
+    def add(self, error: np.ndarray):
+        error = error[~np.isnan(error)]
+        self._add_bins(np.floor(error / self.width).astype(np.int64), np.ones_like(error), error, error ** 2)
+
+    def merge(self, other: 'ErrorSketch') -> 'ErrorSketch':
+        self._add_bins(other.bins, other.counts, other.sums, other.sums2)
+        return self
+
+    def values(self) -> np.ndarray:
+        """Mean error of each bin."""
+        return self.sums / self.counts
+
+    def percentile(self, q: float, lower: float = -np.inf, upper: float = np.inf) -> float:
+        """q-th percentile of the errors between lower and upper, interpolated within its bin."""
+        keep = (self.values() >= lower) & (self.values() <= upper)
+        counts = self.counts[keep]
+        cdf = np.cumsum(counts)
+        target = q / 100. * cdf[-1]
+        b = min(np.searchsorted(cdf, target), len(cdf) - 1)
+        fraction = (target - (cdf[b] - counts[b])) / counts[b]
+        return (self.bins[keep][b] + fraction) * self.width
+
+
+class PairwiseCovariance:
+    """
+    Running covariance of the columns of a matrix with NaNs, over the rows where both columns are defined
+    (as pandas.DataFrame.cov). Chunks and partial results are merged with the update of Chan, Golub & LeVeque:
+    n, mean and co-moment are kept for each pair of columns, mean[a, b] being the mean of column a over the rows where
+    a and b are defined.
+    """
+    def __init__(self, k: int):
+        self.n = np.zeros((k, k))
+        self.mean = np.zeros((k, k))
+        self.comoment = np.zeros((k, k))
+
+    def _merge(self, n, mean, comoment):
+        total = self.n + n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(total > 0, mean - self.mean, 0.0)
+            weight = np.where(total > 0, self.n * n / total, 0.0)
+            self.mean = np.where(total > 0, self.mean + delta * n / total, 0.0)
+        self.comoment = self.comoment + comoment + delta * delta.T * weight
+        self.n = total
+
+    def add(self, x: np.ndarray):
+        valid = ~np.isnan(x)
+        weights = valid.astype(float)
+        n = weights.T @ weights
+        # centred on the chunk means, so that the products do not lose precision
+        shift = np.array([np.mean(col[ok]) if ok.any() else 0.0 for col, ok in zip(x.T, valid.T)])
+        centred = np.where(valid, x - shift, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(n > 0, (centred.T @ weights) / n, 0.0)
+        comoment = centred.T @ centred - n * mean * mean.T
+        self._merge(n, mean + shift[:, np.newaxis], comoment)
+
+    def merge(self, other: 'PairwiseCovariance') -> 'PairwiseCovariance':
+        self._merge(other.n, other.mean, other.comoment)
+        return self
+
+    def covariance(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.n > 1, self.comoment / (self.n - 1), np.nan)
+
+
+def sketch_shard(job):
+    shard, labels, lensed_images = job
+    with task_span('sketch', shard=str(shard[0]), chunk=shard[1]):
+        error_matrix = label_errors(labels, lensed_images, *mock_store.read_shard(shard))
+        sketches = [ErrorSketch() for _ in labels]
+        for sketch, error in zip(sketches, error_matrix.T):
+            sketch.add(error)
+    return sketches
+
+
+def covariance_shard(job):
+    shard, labels, lensed_images, lower_clips, upper_clips = job
+    with task_span('covariance', shard=str(shard[0]), chunk=shard[1]):
+        error_matrix = label_errors(labels, lensed_images, *mock_store.read_shard(shard))
+        error_matrix[(error_matrix > upper_clips) | (error_matrix < lower_clips)] = np.nan
+        covariance = PairwiseCovariance(len(labels))
+        covariance.add(error_matrix)
+    return covariance
+
+
+def map_shards(func, jobs, merge, processes=1):
+    """
+    func on each shard, the partial results merged as they come, so that only one shard per worker is in memory.
+    """
+    if processes > 1 and len(jobs) > 1:
+        with Pool(min(processes, len(jobs))) as p:
+            return _merge_all(p.imap_unordered(func, jobs), merge)
+    return _merge_all(map(func, jobs), merge)
+
+
+def _merge_all(partials, merge):
+    result = None
+    for partial in partials:
+        result = partial if result is None else merge(result, partial)
+    return result
+
+
+def stream_errors(labels: list, lensed_images: list, paths: list, processes=1):
+    """
+    Same as compute_errors, reading the mocks shard by shard: one pass to sketch the errors of each label
+    (percentiles and sigma clipping), one to accumulate the covariance of the clipped errors.
+    Returns the covariance (without the systematic part), the median clipped errors and the 16-84 intervals.
+    """
+    shards = [shard for path in paths for shard in mock_store.result_shards(path)]
+    if not shards:
+        raise ValueError("No mock results loaded. Check your accepted parameters and mock paths.")
+    print(f'Streaming {len(shards)} shards of mocks from {len(paths)} grid cells')
+
+    sketches = map_shards(sketch_shard, [(shard, labels, lensed_images) for shard in shards],
+                          lambda a, b: [s.merge(o) for s, o in zip(a, b)], processes=processes)
+    interval16_84 = [(sketch.percentile(84) - sketch.percentile(16)) / 2.0 for sketch in sketches]
+    print_desired_std(labels, interval16_84)
+
+    clipper = SortedSigmaClip.from_sketches(sketches)
+    optimal_clip_sigmas = find_optimal_clip_sigma(clipper, interval16_84)
+    _, _, lower_clips, upper_clips, _ = clipper.clip(optimal_clip_sigmas)
+    medians = []
+    for c, (label, sketch) in enumerate(zip(labels, sketches)):
+        print(f'{label}: Optimal clip_sigma found: {optimal_clip_sigmas[c]:.2f}')
+        total = np.sum(sketch.counts)
+        kept = np.sum(sketch.counts[(sketch.values() >= lower_clips[c]) & (sketch.values() <= upper_clips[c])])
+        print(f"{label}: Excluding {int(total - kept)} mocks out of {int(total)} (sigma={optimal_clip_sigmas[c]:.2f})")
+        medians.append(sketch.percentile(50, lower_clips[c], upper_clips[c]))
+
+    covariance = map_shards(covariance_shard,
+                            [(shard, labels, lensed_images, lower_clips, upper_clips) for shard in shards],
+                            lambda a, b: a.merge(b), processes=processes)
+    return covariance.covariance(), np.array(medians), interval16_84
+
+
+def main(lens, dataset, stream=False, processes=1):
     directory = Path('Simulation') / f"{lens}_{dataset}"
     
     # List all the estimators
@@ -185,27 +427,40 @@ def main():
     # accepted parameters of 4b
     accepted_params = get_accepted_params(groups)
     
-    # load mock results
-    try:
-        results = load_mock_results(spls, accepted_params, directory)
-    except ValueError as e:
-        print(e)
-        sys.exit(1)
-    
-    # covariance errors with dynamic sigma clipping
-    errors, interval16_84 = compute_errors(labels, lensed_images, results)
-    
-    # wrap in a pandas dataframe, easier
-    errors_by_label = {label: error for label, error in zip(labels, errors)}
-    df = pd.DataFrame(errors_by_label)
-    # the systematic error, important e.g. for WGD2021 (because of the very small intersect of the LCs)
-    sys_error = np.abs(df.median().values)
+    if stream:
+        # covariance errors with dynamic sigma clipping, one shard of mocks at a time
+        try:
+            covariance, medians, interval16_84 = stream_errors(labels, lensed_images,
+                                                               mock_paths(spls, accepted_params), processes=processes)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        cov_matrix = pd.DataFrame(covariance, index=labels, columns=labels)
+        # the systematic error, important e.g. for WGD2021 (because of the very small intersect of the LCs)
+        sys_error = np.abs(medians)
+    else:
+        # load mock results
+        try:
+            results = load_mock_results(spls, accepted_params, directory)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+        # covariance errors with dynamic sigma clipping
+        errors, interval16_84 = compute_errors(labels, lensed_images, results)
+
+        # wrap in a pandas dataframe, easier
+        errors_by_label = {label: error for label, error in zip(labels, errors)}
+        df = pd.DataFrame(errors_by_label)
+        cov_matrix = df.cov()
+        # the systematic error, important e.g. for WGD2021 (because of the very small intersect of the LCs)
+        sys_error = np.abs(df.median().values)
     
     # systemic ""variance"" diagonal matrix
     sys_variance_diagonal = np.diag(sys_error**2)
     
     # covariance matrix, with systematic added in quadrature to the diagonal.
-    cov_matrix = df.cov() + sys_variance_diagonal
+    cov_matrix = cov_matrix + sys_variance_diagonal
     
     # prep for output
     stds = np.sqrt(np.diag(cov_matrix))
@@ -230,4 +485,25 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = ap.ArgumentParser(prog="python {}".format(Path(__file__).name),
+                               description="Covariance matrix of the time delays, from the mocks of the accepted "
+                                           "grid cells of 4b.",
+                               formatter_class=ap.RawTextHelpFormatter)
+    help_lensname = "name of the lens to process"
+    help_dataname = "name of the data set to process (Euler, SMARTS, ... )"
+    help_stream = "read the mocks one shard at a time, with constant memory (percentiles exact to %.2f days)" % SKETCH_WIDTH
+    help_processes = "number of workers reading the shards in streaming mode"
+    parser.add_argument(dest='lensname', type=str,
+                        metavar='lens_name', action='store',
+                        help=help_lensname)
+    parser.add_argument(dest='dataname', type=str,
+                        metavar='dataname', action='store',
+                        help=help_dataname)
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help=help_stream)
+    parser.add_argument('--processes', dest='processes', type=int, default=1,
+                        metavar='', action='store',
+                        help=help_processes)
+    args = parser.parse_args()
+    with stage_span('4c', args.lensname, args.dataname):
+        main(args.lensname, args.dataname, stream=args.stream, processes=args.processes)
@@ -56,10 +56,12 @@ nsim = 20 #number of copy per pickle
 nsimpkls = 40 #number of pickle
 truetsr = 10.0  # Range of true time delay shifts when drawing the mock curves
 tsrand = 10.0  # Random shift of initial condition for each simulated lc in [initcond-tsrand, initcond+tsrand]
+mock_seed = 1  # master seed of the mocks, each pickle draws from its own stream derived from it
 
 ## sim
 run_on_copies = True
 run_on_sims = True
+use_mock_store = False  # True: one container per grid cell and simset instead of one pickle per batch of curves
 
 
 ### MICROLENSING ####
@@ -0,0 +1,239 @@
+"""
+Wall time, CPU time and peak memory of the stages and of their worker tasks.
+The scripts run their main() in a stage span, and their workers run each task (grid cell, pickle, shard...) in a
+task span, which takes the stage, lens, data set and grid cell of the spans it is nested in (also across a fork):
+
+    with stage_span('3c', lensname, dataname, work_dir=work_dir, cell=cell):
+        main(...)
+
+    def worker(args):
+        with task_span('optimise', simset=simset, pickle=k):
+            annotate(combkw=config.combkw[i, j])
+            ...
+
+Each span appends one line to the timings file of the run when it ends:
+
+    {"run": "20250629-101500-1234", "kind": "task", "stage": "3c", "lens": ..., "dataset": ..., "combkw": ...,
+     "task": "optimise", "simset": ..., "pickle": 3, "host": ..., "pid": ..., "start": <unix time>,
+     "wall": <s>, "cpu": <s>, "peak_rss": <MB>, "status": "ok"}
+
+Stage records also have "cpu_children" and "peak_rss_children", for the workers of the stage.
+The file is pipeline_logs/timings_<run>.jsonl in the run directory. run_pipeline.py uses one run (and file) for all
+the stages it starts, a script started by hand has its own. The lines are appended under an exclusive lock, so that
+all the processes of a run can write to the same file.
+
+    python instrumentation.py pipeline_logs/timings_<run>.jsonl --by lens stage
+
+prints the totals per lens and stage (--by lens stage combkw --kind task for the grid cells).
+"""
+import argparse as ap
+import json
+import os
+import socket
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:  # windows: no locking
+    fcntl = None
+try:
+    import resource
+except ImportError:  # windows: no peak memory
+    resource = None
+
+RUN_ENV = 'PIPELINE_RUN'
+TIMINGS_ENV = 'PIPELINE_TIMINGS'
+
+# fields a task span takes from the spans it is nested in
+INHERITED_FIELDS = ('stage', 'lens', 'dataset', 'combkw', 'cell')
+
+# spans open in this process, innermost last
+_open_spans = []
+
+
+def new_run_id():
+    return time.strftime('%Y%m%d-%H%M%S') + '-%i' % os.getpid()
+
+
+def timings_path(work_dir, run):
+    return os.path.join(work_dir, 'pipeline_logs', 'timings_%s.jsonl' % run)
+
+
+def _peak_rss():
+    """
+    Peak resident memory of this process in MB, since the last _reset_peak_rss if the system allows it.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    if resource is None:
+        return 0.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024. ** 2 if sys.platform == 'darwin' else maxrss / 1024.
+
+
+def _reset_peak_rss():
+    # linux only, elsewhere the peak is the one of the whole process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _children_usage():
+    if resource is None:
+        return 0., 0.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    maxrss = usage.ru_maxrss / 1024. ** 2 if sys.platform == 'darwin' else usage.ru_maxrss / 1024.
+    return usage.ru_utime + usage.ru_stime, maxrss
+
+
+def append_record(record, path=None):
+    path = path or os.environ.get(TIMINGS_ENV)
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    line = json.dumps(record, default=str) + '\n'
+    with open(path, 'a') as f:
+        if fcntl is None:
+            f.write(line)
+            return
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Span:
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.fields = fields
+
+    def __enter__(self):
+        if _open_spans:
+            parent = _open_spans[-1]
+            # the reset below would hide what the enclosing span used until now
+            parent.peak = max(parent.peak, _peak_rss())
+            for key in INHERITED_FIELDS:
+                if self.fields.get(key) is None and parent.fields.get(key) is not None:
+                    self.fields[key] = parent.fields[key]
+        _open_spans.append(self)
+        self.peak = 0.
+        _reset_peak_rss()
+        self.start = time.time()
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.children0, _ = _children_usage()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall0
+        cpu = time.process_time() - self.cpu0
+        peak = max(self.peak, _peak_rss())
+        if self in _open_spans:
+            _open_spans.remove(self)
+        if _open_spans:
+            _open_spans[-1].peak = max(_open_spans[-1].peak, peak)
+
+        record = {'run': os.environ.get(RUN_ENV), 'kind': self.kind}
+        record.update(self.fields)
+        record.update({'host': socket.gethostname(), 'pid': os.getpid(), 'start': round(self.start, 3),
+                       'wall': round(wall, 4), 'cpu': round(cpu, 4), 'peak_rss': round(peak, 1),
+                       'status': 'ok' if exc_type is None else exc_type.__name__})
+        if self.kind == 'stage':
+            children, children_peak = _children_usage()
+            record['cpu_children'] = round(children - self.children0, 4)
+            record['peak_rss_children'] = round(children_peak, 1)
+        append_record(record)
+        return False
+
+
+def stage_span(stage, lensname, dataname, work_dir='./', cell=None):
+    """
+    Span of a whole script. Outside of run_pipeline.py, it starts a new run (and timings file) in work_dir.
+    """
+    if not os.environ.get(TIMINGS_ENV):
+        os.environ.setdefault(RUN_ENV, new_run_id())
+        os.environ[TIMINGS_ENV] = os.path.abspath(timings_path(work_dir, os.environ[RUN_ENV]))
+    return Span('stage', stage=stage, lens=lensname, dataset=dataname,
+                cell=None if cell is None else '%i %i' % tuple(cell))
+
+
+def task_span(task, **fields):
+    return Span('task', task=task, **fields)
+
+
+def annotate(**fields):
+    """
+    Adds fields (e.g. the combkw, once the config is read) to the innermost open span of this process.
+    """
+    if _open_spans:
+        _open_spans[-1].fields.update(fields)
+
+
+def read_records(paths):
+    records = []
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        print("Skipping a truncated line of %s." % path)
+    return records
+
+
+def summarise(records, by=('lens', 'stage'), kind='stage'):
+    """
+    Totals of the records of this kind ('all' for both), grouped by the fields of by, the longest first:
+    [(group values, number of records, total wall time, longest wall time, total CPU time, peak memory), ...]
+    """
+    groups = {}
+    for record in records:
+        if kind != 'all' and record.get('kind') != kind:
+            continue
+        key = tuple('-' if record.get(field) is None else str(record[field]) for field in by)
+        count, wall, wall_max, cpu, peak = groups.get(key, (0, 0., 0., 0., 0.))
+        groups[key] = (count + 1, wall + record['wall'], max(wall_max, record['wall']),
+                       cpu + record['cpu'] + record.get('cpu_children', 0.),
+                       max(peak, record['peak_rss'], record.get('peak_rss_children', 0.)))
+    return sorted(((key,) + value for key, value in groups.items()), key=lambda row: -row[2])
+
+
+def print_summary(rows, by):
+    widths = [max([len(field)] + [len(row[0][k]) for row in rows]) for k, field in enumerate(by)]
+    header = '  '.join(field.ljust(w) for field, w in zip(by, widths))
+    print(header + '      n    wall [h]     max [h]     cpu [h]  peak RSS [MB]')
+    for key, count, wall, wall_max, cpu, peak in rows:
+        print('  '.join(value.ljust(w) for value, w in zip(key, widths)) +
+              ' %6i %11.3f %11.3f %11.3f %14.0f' % (count, wall / 3600., wall_max / 3600., cpu / 3600., peak))
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(prog="python {}".format(os.path.basename(__file__)),
+                               description="Summary of the timings of pipeline runs.",
+                               formatter_class=ap.RawTextHelpFormatter)
+    help_files = "timings files (pipeline_logs/timings_<run>.jsonl)"
+    help_by = "fields to group by, among run, lens, dataset, stage, combkw, cell, task, host"
+    help_kind = "records to sum: stage (whole scripts), task (worker tasks) or all"
+    parser.add_argument(dest='files', type=str, nargs='+',
+                        metavar='files', action='store',
+                        help=help_files)
+    parser.add_argument('--by', dest='by', type=str, nargs='+', default=['lens', 'stage'],
+                        metavar='', action='store',
+                        help=help_by)
+    parser.add_argument('--kind', dest='kind', type=str, default='stage', choices=['stage', 'task', 'all'],
+                        metavar='', action='store',
+                        help=help_kind)
+    args = parser.parse_args()
+    print_summary(summarise(read_records(args.files), by=args.by, kind=args.kind), args.by)
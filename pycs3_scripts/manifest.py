@@ -0,0 +1,156 @@
+"""
+Manifests of the inputs of the stages, so that a stage skips the grid cells whose inputs did not change.
+A manifest is written next to the outputs of a stage, for a grid cell (and simset, optimiser...):
+
+    <cell directory>/manifest_<stage>[_<name>].json
+
+    {"stage": "2", "digest": <sha1 of the inputs>,
+     "inputs": {"data": <sha1 of the base pickle>, "config.knotstep": 20, "upstream.2": <sha1>, ...},
+     "outputs": {<path>: [size, mtime_ns, sha1], ...},
+     "result": <what the stage needs from a skipped cell, e.g. the fit summary of 2_fit_spline>}
+
+The inputs are the content hashes of the files read, the config values used and the hashes of the outputs of the
+stages upstream (add_upstream). A cell is up to date when its inputs hash to the stored digest and its outputs
+are still there, unmodified. Changing one knotstep hence only recomputes the combkw directories that use it.
+The hash of an output is only computed again when its size or modification time changed.
+"""
+import hashlib
+import inspect
+import json
+import os
+
+MANIFEST_PREFIX = 'manifest_'
+
+
+def file_hash(path):
+    """
+    sha1 of the content of path, None if it does not exist.
+    """
+    h = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def _jsonable(value):
+    # config values: numbers, strings, lists, numpy arrays and functions (hashed by their source)
+    if callable(value):
+        try:
+            return hashlib.sha1(inspect.getsource(value).encode()).hexdigest()
+        except (OSError, TypeError):
+            return getattr(value, '__qualname__', repr(value))
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def list_outputs(path):
+    """
+    The files of an output: the file itself, or the files of a directory (not recursive). The locks, temporary files
+    and claims of the workers (.workingon, see 3c) are not outputs.
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if os.path.isfile(os.path.join(path, name)) and not name.endswith(('.lock', '.tmp', '.workingon'))
+                      and '.workingon.stale.' not in name)
+    if os.path.exists(path):
+        return [path]
+    return []
+
+
+class Manifest:
+    def __init__(self, directory, stage, name=None):
+        self.stage = stage
+        self.path = os.path.join(str(directory), MANIFEST_PREFIX + stage + ('' if name is None else '_' + name) + '.json')
+        self.inputs = {}
+
+    def add_file(self, key, path):
+        self.inputs[key] = file_hash(path)
+
+    def add_value(self, key, value):
+        self.inputs[key] = _jsonable(value)
+
+    def add_config(self, config, fields):
+        """
+        The values of the fields of the config (None for a missing field).
+        """
+        for field in fields:
+            self.inputs['config.' + field] = _jsonable(getattr(config, field, None))
+
+    def add_upstream(self, key, path):
+        """
+        The hash of the outputs recorded by the manifest in path, None if there is none.
+        """
+        stored = read(path)
+        outputs = None if stored is None else stored['outputs']
+        self.inputs['upstream.' + key] = None if outputs is None else hashlib.sha1(
+            json.dumps(sorted((os.path.basename(p), v[2]) for p, v in outputs.items())).encode()).hexdigest()
+
+    def digest(self):
+        return hashlib.sha1(json.dumps(self.inputs, sort_keys=True).encode()).hexdigest()
+
+    def stored(self):
+        return read(self.path)
+
+    def up_to_date(self):
+        """
+        True if the inputs did not change since the manifest was written, and the outputs are still there.
+        """
+        stored = self.stored()
+        if stored is None or stored['digest'] != self.digest() or not stored['outputs']:
+            return False
+        for path, (size, mtime_ns, sha1) in stored['outputs'].items():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return False
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns) and file_hash(path) != sha1:
+                return False
+        return True
+
+    def result(self):
+        stored = self.stored()
+        return None if stored is None else stored.get('result')
+
+    def write(self, outputs, result=None):
+        """
+        outputs: the files or directories written by the stage for this cell.
+        result: anything json can write, read back by result() when the cell is skipped.
+        """
+        previous = self.stored()
+        previous = {} if previous is None else previous['outputs']
+        record = {}
+        for path in [p for output in outputs for p in list_outputs(output)]:
+            st = os.stat(path)
+            known = previous.get(path)
+            if known is not None and (known[0], known[1]) == (st.st_size, st.st_mtime_ns):
+                record[path] = known
+            else:
+                record[path] = [st.st_size, st.st_mtime_ns, file_hash(path)]
+        manifest = {'stage': self.stage, 'digest': self.digest(), 'inputs': self.inputs, 'outputs': record,
+                    'result': _jsonable(result)}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_file = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=1, default=lambda o: o.item() if hasattr(o, 'item') else str(o))
+        os.replace(tmp_file, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def read(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
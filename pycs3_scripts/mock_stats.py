@@ -0,0 +1,171 @@
+"""
+Residual statistics of the optimised mock curves, as checked by 3d_check_statistics.py.
+Same statistics as pycs3.gen.stat.anaoptdrawn (median absolute deviation of the spline fit residuals and z-score of
+the runs test), but the residuals of all the mocks of a simset are stacked into one (n_mocks, n_points) array per
+curve, and the statistics are computed for all the mocks at once.
+
+    rlcs = load_residuals(directory, simset, optset)
+    stats = simset_stats(orig_residuals(lcs, spline), rlcs)
+
+The figures of anaoptdrawn are drawn by plot_resihists and pycs3.gen.stat.plotresiduals, from the residuals and
+the zruns of the mocks computed for the statistics.
+"""
+import glob
+import os
+
+import numpy as np
+import pycs3.gen.stat
+import pycs3.gen.util
+
+# columns of the pass/fail table written by 3d
+TABLE_COLUMNS = ['combkw', 'simset', 'optset', 'object', 'zruns_obs', 'zruns_sim', 'zruns_sim_std',
+                 'sigma_obs', 'sigma_sim', 'sigma_sim_std', 'zruns_deviation', 'sigma_deviation', 'passed']
+
+
+def residuals(lcs, spline):
+    """
+    The spline fit residuals of each curve, taking into account the shifts and the microlensing, as
+    pycs3.gen.stat.subtract but without copying the curves.
+    """
+    return [lc.getmags() - spline.eval(lc.getjds()) for lc in lcs]
+
+
+def orig_residuals(lcs, spline):
+    """
+    The residuals of the original curves, as (1, n_points) arrays.
+    """
+    return [r[np.newaxis, :] for r in residuals(lcs, spline)]
+
+
+def load_residuals(directory, simset, optset, npkl=1000):
+    """
+    The residuals of all the optimised mocks of a simset, one (n_mocks, n_points) array per curve.
+    """
+    pkls = sorted(glob.glob(os.path.join(directory, "sims_%s_opt_%s/*_opt.pkl" % (simset, optset))))[:npkl]
+    rows = None
+    for pkl in pkls:
+        opttweak = pycs3.gen.util.readpickle(pkl, verbose=False)
+        for optmocklcs, optmockspline in zip(opttweak["optlcslist"], opttweak["optfctoutlist"]):
+            if rows is None:
+                rows = [[] for _ in optmocklcs]
+            for k, r in enumerate(residuals(optmocklcs, optmockspline)):
+                rows[k].append(r)
+    if rows is None:
+        raise RuntimeError("No optimised mocks in %s for simset %s and optimiser %s." % (directory, simset, optset))
+    try:
+        return [np.stack(r) for r in rows]
+    except ValueError:
+        raise RuntimeError("The mocks of simset %s do not all have the same number of points." % simset)
+
+
+def first_mock_residuals(directory, simset, optset):
+    """
+    The residual curves of the first optimised mock of a simset, as pycs3.gen.stat.subtract, for the residual plot.
+    """
+    pkls = sorted(glob.glob(os.path.join(directory, "sims_%s_opt_%s/*_opt.pkl" % (simset, optset))))
+    if len(pkls) == 0:
+        raise RuntimeError("No optimised mocks in %s for simset %s and optimiser %s." % (directory, simset, optset))
+    opttweak = pycs3.gen.util.readpickle(pkls[0], verbose=False)
+    rlcs = pycs3.gen.stat.subtract(opttweak["optlcslist"][0], opttweak["optfctoutlist"][0])
+    for rlc in rlcs:
+        rlc.plotcolour = "black"
+    return rlcs
+
+
+def mad(resi):
+    """
+    Median absolute deviation of each row.
+    """
+    return np.median(np.abs(resi - np.median(resi, axis=1)[:, np.newaxis]), axis=1)
+
+
+def zruns(resi):
+    """
+    z-score of the runs test of each row, as pycs3.gen.stat.runstest (residuals closer than 1e-6 to zero are ignored).
+    """
+    keep = np.abs(resi) > 0.000001
+    signs = resi > 0
+    # carry the last significant sign over the ignored points, so that they do not count as runs
+    last = np.maximum.accumulate(np.where(keep, np.arange(resi.shape[1]), 0), axis=1)
+    signs = np.take_along_axis(signs, last, axis=1)
+    started = np.cumsum(keep, axis=1) > 0
+    nruns = np.sum((signs[:, 1:] != signs[:, :-1]) & started[:, :-1], axis=1) + 1
+
+    n = np.sum(keep, axis=1).astype(float)
+    nplus = np.sum(signs & keep, axis=1)
+    nminus = n - nplus
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mur = (2.0 * nplus * nminus / n) + 1.0
+        sigmar = np.sqrt((mur - 1.0) * (mur - 2.0) / (n - 1.0))
+        return (nruns - mur) / sigmar
+
+
+def mock_zruns(mock_resi):
+    """
+    The zruns of each mock, one (n_mocks,) array per curve.
+    """
+    return [zruns(mocks) for mocks in mock_resi]
+
+
+def simset_stats(orig_resi, mock_resi, all_mock_zruns=None):
+    """
+    For each curve: zruns of the original curve, mean and std of the zruns of the mocks, then the same for sigma,
+    the list returned by pycs3.gen.stat.anaoptdrawn.
+    all_mock_zruns: the output of mock_zruns, if it was already computed.
+    """
+    if all_mock_zruns is None:
+        all_mock_zruns = mock_zruns(mock_resi)
+    stats = []
+    for orig, mocks, mock_zruns_ in zip(orig_resi, mock_resi, all_mock_zruns):
+        mock_zruns_ = np.asarray(mock_zruns_)
+        mock_sig = mad(mocks)
+        stats.append([zruns(orig)[0], np.mean(mock_zruns_), np.std(mock_zruns_),
+                      mad(orig)[0], np.mean(mock_sig), np.std(mock_sig)])
+    return stats
+
+
+def check(stats, tolerance=1.0):
+    """
+    Deviations of the original curves from the mocks, in units of the spread of the mocks, and whether they are
+    within tolerance, for each curve.
+    """
+    stats = np.asarray(stats, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dev_zruns = np.abs(stats[:, 0] - stats[:, 1]) / stats[:, 2]
+        dev_sig = np.abs(stats[:, 3] - stats[:, 4]) / stats[:, 5]
+    return dev_zruns, dev_sig, (dev_zruns < tolerance) & (dev_sig < tolerance)
+
+
+def plot_resihists(orig_rlcs, stats, mock_resi, all_mock_zruns, r=0.11, filename=None):
+    """
+    The histograms of the residuals and of the zruns of the mocks against those of the original curves, the
+    "resihists" figure of pycs3.gen.stat.anaoptdrawn, drawn from the output of simset_stats, load_residuals and
+    mock_zruns.
+    orig_rlcs: residual curves of the original curves (pycs3.gen.stat.subtract), for the histograms and the colours.
+    """
+    import matplotlib.pyplot as plt
+
+    n_curves = len(orig_rlcs)
+    plt.figure(figsize=(3 * n_curves, 4))
+    plt.subplots_adjust(left=0.02, bottom=0.12, right=0.98, top=0.98, wspace=0.08, hspace=0.37)
+
+    for i, (rlc, mocks) in enumerate(zip(orig_rlcs, mock_resi)):
+        plt.subplot(2, n_curves, i + 1)
+        plt.hist(np.ravel(mocks), 50, range=(-r, r), facecolor='black', alpha=0.4, density=1, histtype="stepfilled")
+        plt.hist(rlc.mags, 50, facecolor=rlc.plotcolour, alpha=0.5, range=(-r, r), density=1, histtype="stepfilled")
+        plt.xlabel("Spline fit residuals [mag]")
+        plt.text(-r + 0.1 * r, 0.8 * plt.gca().get_ylim()[1], rlc.object, fontsize=18)
+        plt.xlim(-r, r)
+        plt.gca().get_yaxis().set_ticks([])
+
+    for i, (rlc, curve_stats, mock_zruns_) in enumerate(zip(orig_rlcs, stats, all_mock_zruns)):
+        plt.subplot(2, n_curves, n_curves + i + 1)
+        plt.hist(np.asarray(mock_zruns_), 20, facecolor="black", alpha=0.4, density=1, histtype="stepfilled")
+        plt.axvline(curve_stats[0], color=rlc.plotcolour, linewidth=2.0, alpha=1.0)
+        plt.xlabel(r"$z_{\mathrm{r}}$", fontsize=18)
+        plt.gca().get_yaxis().set_ticks([])
+
+    if filename is None:
+        plt.show()
+    else:
+        plt.savefig(filename)
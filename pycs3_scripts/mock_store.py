@@ -0,0 +1,359 @@
+"""
+Consolidated storage of the copies and mock curves and of their optimisation results, used instead of the
+thousands of small pickles of pycs3.sim.draw.multidraw and pycs3.sim.run.multirun when use_mock_store is set
+in the config. One container per grid cell and simset, and one per optimisation of that simset:
+
+    <cell directory>/store_sims_<simset>/                 curves.bin + index.json
+    <cell directory>/store_sims_<simset>_opt_<optset>/    results.bin + index.json
+
+The .bin files are raw float64, appended chunk by chunk (a chunk is what used to be one pickle) and read
+memory-mapped, by chunk or by range of simulations. index.json holds the offsets and the metadata of the chunks.
+Appends take a lock on the container, so several processes can write to the same one.
+The data are not compressed: compressed chunks could not be memory-mapped.
+
+collect() keeps what it collected in <cell directory>/collected_sims_<simset>_opt_<optset>.npz: the time shift
+arrays and, for each pickle (or chunk) they come from, its size, modification time and number of runs.
+The stages after 3c collect the same simsets again and again, they read this file instead as long as the pickles
+did not change.
+"""
+import contextlib
+import glob
+import json
+import os
+
+import numpy as np
+import pycs3.gen.lc_func
+import pycs3.gen.util
+import pycs3.sim.run
+
+try:
+    import fcntl
+except ImportError:  # windows: no locking
+    fcntl = None
+
+STORE_PREFIX = 'store_'
+COLLECT_PREFIX = 'collected_'
+
+
+def store_path(destpath, simset, optset=None):
+    """
+    The container of the curves of simset (or of their optimisation by optset) in the grid cell directory destpath.
+    """
+    if optset is None:
+        name = "sims_%s" % simset
+    else:
+        name = "sims_%s_opt_%s" % (simset, optset)
+    return os.path.join(destpath, STORE_PREFIX + name)
+
+
+class _Container:
+    data_name = None
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+        self.data_file = os.path.join(self.directory, self.data_name)
+        self.index_file = os.path.join(self.directory, 'index.json')
+
+    def exists(self):
+        return os.path.exists(self.index_file)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, 'store.lock'), 'w') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def chunks(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)['chunks']
+        except FileNotFoundError:
+            return []
+
+    def __len__(self):
+        return len(self.chunks())
+
+    def _append(self, block, entry):
+        """
+        Appends the float64 block to the data file, then registers it in the index. A crash in between leaves
+        unreferenced bytes at the end of the data file, never a broken index.
+        """
+        block = np.ascontiguousarray(block, dtype=np.float64).ravel()
+        with self._lock():
+            chunks = self.chunks()
+            with open(self.data_file, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                entry['offset'] = f.tell() // 8
+                entry['size'] = int(block.size)
+                f.write(block.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            chunks.append(entry)
+            tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump({'chunks': chunks}, f)
+            os.replace(tmp_file, self.index_file)
+        return len(chunks) - 1
+
+    def _block(self, entry):
+        if entry['size'] == 0:
+            return np.empty(0)
+        return np.memmap(self.data_file, dtype=np.float64, mode='c', offset=8 * entry['offset'],
+                         shape=(entry['size'],))
+
+    def clear(self):
+        for name in (self.data_name, 'index.json'):
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class MockStore(_Container):
+    """
+    The drawn copies or mocks of a grid cell: a list of simulations, each a list of curves (one per image).
+    """
+    data_name = 'curves.bin'
+
+    def append(self, simlcslist, shard=None):
+        """
+        Stores a list of simulations as a new chunk, returns its index.
+        shard: index of the pickle this chunk replaces, the chunks can be appended in any order.
+        """
+        lcs = simlcslist[0]
+        lengths = [[len(l.jds) for l in simlcs] for simlcs in simlcslist]
+        block = np.concatenate([np.concatenate((l.jds, l.mags, l.magerrs))
+                                for simlcs in simlcslist for l in simlcs])
+        entry = {'n': len(simlcslist),
+                 'shard': shard,
+                 'objects': [l.object for l in lcs],
+                 'telescopenames': [l.telescopename for l in lcs],
+                 'plotcolours': [l.plotcolour for l in lcs],
+                 'lengths': lengths,
+                 # the copies have no true shifts
+                 'truetimeshifts': [[float(getattr(l, 'truetimeshift', 0.0)) for l in simlcs]
+                                    for simlcs in simlcslist]}
+        return self._append(block, entry)
+
+    def shards(self):
+        return {entry['shard'] for entry in self.chunks()}
+
+    def n_sims(self):
+        return sum(entry['n'] for entry in self.chunks())
+
+    def _simlcslist(self, entry, start=0, stop=None):
+        block = np.asarray(self._block(entry))
+        stop = entry['n'] if stop is None else stop
+        lengths = np.array(entry['lengths'], dtype=int).reshape(entry['n'], -1)
+        offsets = np.concatenate(([0], np.cumsum(3 * lengths.ravel())))
+        nimages = lengths.shape[1]
+        simlcslist = []
+        for s in range(start, stop):
+            simlcs = []
+            for k in range(nimages):
+                npts = lengths[s, k]
+                o = offsets[s * nimages + k]
+                l = pycs3.gen.lc_func.factory(block[o:o + npts], block[o + npts:o + 2 * npts],
+                                              block[o + 2 * npts:o + 3 * npts],
+                                              telescopename=entry['telescopenames'][k],
+                                              object=entry['objects'][k])
+                l.plotcolour = entry['plotcolours'][k]
+                l.truetimeshift = entry['truetimeshifts'][s][k]
+                simlcs.append(l)
+            simlcslist.append(simlcs)
+        return simlcslist
+
+    def read_chunk(self, k):
+        return self._simlcslist(self.chunks()[k])
+
+    def read(self, start, stop):
+        """
+        Simulations start to stop (excluded), counted over all the chunks.
+        """
+        simlcslist = []
+        first = 0
+        for entry in self.chunks():
+            last = first + entry['n']
+            if last > start and first < stop:
+                simlcslist += self._simlcslist(entry, max(start - first, 0), min(stop, last) - first)
+            first = last
+        return simlcslist
+
+
+class ResultStore(_Container):
+    """
+    The optimisation results (what RunResults keeps: measured and true time shifts, qs) of the chunks of a MockStore.
+    """
+    data_name = 'results.bin'
+
+    def append(self, chunk, rr, success_dic=None):
+        block = np.column_stack((rr.tsarray, rr.truetsarray, rr.qs))
+        if success_dic is not None:
+            # the errors are exceptions, keep their message
+            success_dic = {'success': success_dic['success'], 'failed_id': list(success_dic['failed_id']),
+                           'error_list': [str(e) for e in success_dic['error_list']]}
+        entry = {'chunk': chunk, 'n': len(rr), 'labels': rr.labels, 'success_dic': success_dic}
+        return self._append(block, entry)
+
+    def done_chunks(self):
+        return {entry['chunk'] for entry in self.chunks()}
+
+    def read_chunk(self, k):
+        """
+        tsarray, truetsarray and qs of the k-th chunk.
+        """
+        entry = self.chunks()[k]
+        nimages = len(entry['labels'])
+        table = np.array(self._block(entry)).reshape(entry['n'], 2 * nimages + 1)
+        return table[:, :nimages], table[:, nimages:2 * nimages], table[:, -1]
+
+    def collect(self, plotcolour="#008800", name=None):
+        """
+        Same as pycs3.sim.run.collect on the directory of the runresults pickles.
+        """
+        chunks = self.chunks()
+        if len(chunks) == 0:
+            raise RuntimeError("I couldn't find any result in %s" % self.directory)
+        nimages = len(chunks[0]['labels'])
+        table = np.concatenate([np.asarray(self._block(entry)).reshape(entry['n'], 2 * nimages + 1)
+                                for entry in chunks])
+        # sims_<simset>_opt_<optset>, as the runresults pickles name it: 4a writes the delays to <autoname>_delays.pkl
+        autoname = os.path.basename(self.directory)[len(STORE_PREFIX):]
+        rr = _runresults(chunks[0]['labels'], table[:, :nimages], table[:, nimages:2 * nimages], table[:, -1],
+                         autoname if name is None else name, plotcolour)
+        rr.autoname = autoname
+        print("OK, I have collected %i runs from %s" % (len(rr), self.directory))
+        return rr
+
+
+def _runresults(labels, tsarray, truetsarray, qs, name, plotcolour):
+    # RunResults only needs the shifts and names of the curves, build it from the first row and fill it.
+    first = [_ShiftsOnly(label, ts, truets) for label, ts, truets in zip(labels, tsarray[0], truetsarray[0])]
+    rr = pycs3.sim.run.RunResults([first], qs=qs[:1], name=name, plotcolour=plotcolour)
+    rr.tsarray = tsarray
+    rr.truetsarray = truetsarray
+    rr.qs = qs
+    rr.check()
+    return rr
+
+
+class _ShiftsOnly:
+    def __init__(self, label, timeshift, truetimeshift):
+        self.object = label
+        self.timeshift = timeshift
+        self.truetimeshift = truetimeshift
+
+
+def _signature(path):
+    st = os.stat(path)
+    return [os.path.basename(path), st.st_size, st.st_mtime_ns]
+
+
+class CollectCache:
+    """
+    The collected results of a directory of runresults pickles (or of a ResultStore), in one .npz file.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+
+    def load(self, sources):
+        """
+        The cached RunResults, None if there is no cache or if the sources changed since it was written.
+        """
+        try:
+            with np.load(self.path) as data:
+                meta = json.loads(str(data['meta']))
+                if meta['sources'] != [_signature(s) for s in sources]:
+                    return None
+                rr = _runresults(meta['labels'], data['tsarray'], data['truetsarray'], data['qs'], meta['name'],
+                                 meta['plotcolour'])
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+        rr.autoname = meta['autoname']
+        return rr
+
+    def save(self, rr, sources, provenance):
+        """
+        provenance: (pickle or chunk, number of runs) of the rows of rr, in order.
+        """
+        meta = {'labels': rr.labels, 'name': rr.name, 'autoname': rr.autoname, 'plotcolour': rr.plotcolour,
+                'sources': [_signature(s) for s in sources],
+                'provenance': [[str(origin), int(n)] for origin, n in provenance]}
+        tmp_file = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, tsarray=rr.tsarray, truetsarray=rr.truetsarray, qs=rr.qs, meta=json.dumps(meta))
+        os.replace(tmp_file, self.path)
+
+
+def _collect_pickles(pklfiles, plotcolour):
+    # as pycs3.sim.run.collect, keeping the number of runs of each pickle
+    print("Reading %i runresult pickles..." % len(pklfiles))
+    rrlist = [pycs3.gen.util.readpickle(pklfile, verbose=False) for pklfile in pklfiles]
+    jrr = pycs3.sim.run.joinresults(rrlist)
+    jrr.plotcolour = plotcolour
+    print("OK, I have collected %i runs from %s" % (len(jrr), jrr.name))
+    return jrr, [(os.path.basename(pklfile), len(rr)) for pklfile, rr in zip(pklfiles, rrlist)]
+
+
+def collect(directory, plotcolour="#008800", name=None):
+    """
+    Drop-in for pycs3.sim.run.collect: reads the results from the store matching the directory
+    <cell>/sims_<simset>_opt_<optset> if there is one, from the runresults pickles otherwise.
+    The result is cached, see CollectCache.
+    """
+    directory = str(directory).rstrip('/')
+    store = ResultStore(os.path.join(os.path.dirname(directory), STORE_PREFIX + os.path.basename(directory)))
+    cache = CollectCache(os.path.join(os.path.dirname(directory), COLLECT_PREFIX + os.path.basename(directory) + '.npz'))
+    if store.exists():
+        sources = [store.index_file, store.data_file]
+    else:
+        if not os.path.isdir(directory):
+            raise RuntimeError("I cannot find the directory %s" % directory)
+        sources = sorted(glob.glob(os.path.join(directory, "*_runresults.pkl")))
+        if len(sources) == 0:
+            raise RuntimeError("I couldn't find pkl files in directory %s" % directory)
+
+    rr = cache.load(sources)
+    if rr is not None:
+        rr.plotcolour = plotcolour
+        print("OK, I have read %i runs of %s from %s" % (len(rr), directory, cache.path))
+    elif store.exists():
+        rr = store.collect(plotcolour=plotcolour)
+        cache.save(rr, sources, [('chunk %i' % entry['chunk'], entry['n']) for entry in store.chunks()])
+    else:
+        rr, provenance = _collect_pickles(sources, plotcolour)
+        cache.save(rr, sources, provenance)
+
+    if name is not None:
+        # only the label of the plots, the autoname stays sims_<simset>_opt_<optset> as with the pickles
+        rr.name = name
+    return rr
+
+
+def result_shards(directory):
+    """
+    The pickles (or store chunks) of the results of directory <cell>/sims_<simset>_opt_<optset>, to be read one by one
+    with read_shard instead of collecting them all.
+    """
+    directory = str(directory).rstrip('/')
+    store = ResultStore(os.path.join(os.path.dirname(directory), STORE_PREFIX + os.path.basename(directory)))
+    if store.exists():
+        return [(store.directory, k) for k in range(len(store))]
+    return [(pklfile, None) for pklfile in sorted(glob.glob(os.path.join(directory, "*_runresults.pkl")))]
+
+
+def read_shard(shard):
+    """
+    tsarray and truetsarray of a shard of result_shards.
+    """
+    path, chunk = shard
+    if chunk is None:
+        rr = pycs3.gen.util.readpickle(path, verbose=False)
+        return rr.tsarray, rr.truetsarray
+    tsarray, truetsarray, _ = ResultStore(path).read_chunk(chunk)
+    return tsarray, truetsarray
@@ -0,0 +1,261 @@
+"""
+The parameters of the generative noise models (tweakml) found or set by 3a, stored as records instead of python code:
+
+    <cell directory>/tweakml_<tweakml_name>.json
+
+    {"tweakml_type": "PS_from_residuals", "tweakml_name": "PS", "combkw": ..., "knotstep": ..., "ml": ...,
+     "curves": [{"object": "A", "B": 0.8, "A_correction": 1.07}, ...],
+     "optimisation": {"optimiser": "DIC", "chi2": 3.04, "success": true}}
+
+colored_noise records have "beta" and "sigma" for each curve instead of "B" and "A_correction"; "optimisation" is
+null when the parameters come from the config. tweakml_list() builds the functions used by the drawing.
+3a also adds every record to noise_models.json in the run directory, the summary of all the lenses:
+
+    {"<lensname>_<dataname>": {"<combkw>": record, ...}, ...}
+"""
+import contextlib
+import json
+import os
+from functools import partial
+
+import numpy as np
+import pycs3.gen.lc
+import pycs3.gen.stat
+import pycs3.sim.src
+import pycs3.sim.twk as twk
+import scipy.signal
+
+try:
+    import fcntl
+except ImportError:  # windows: no locking
+    fcntl = None
+
+SUMMARY_NAME = 'noise_models.json'
+
+# the parameters of each curve, per type of noise
+CURVE_PARAMETERS = {
+    'PS_from_residuals': ('B', 'A_correction'),
+    'colored_noise': ('beta', 'sigma'),
+}
+
+# tweakml functions already built by this process, by file
+_tweakml_cache = {}
+
+
+def record_path(config, i, j):
+    return config.lens_directory + config.combkw[i, j] + '/tweakml_' + config.tweakml_name + '.json'
+
+
+def make_record(tweakml_type, tweakml_name, objects, parameters, optimisation=None, **cell):
+    """
+    parameters: one dict per curve, with the parameters of CURVE_PARAMETERS[tweakml_type].
+    cell: description of the grid cell (combkw, knotstep, ml).
+    """
+    record = dict(cell)
+    record.update({'tweakml_type': tweakml_type, 'tweakml_name': tweakml_name,
+                   'curves': [dict(object=obj, **{key: float(value) for key, value in params.items()})
+                              for obj, params in zip(objects, parameters)],
+                   'optimisation': optimisation})
+    validate(record)
+    return record
+
+
+def validate(record):
+    tweakml_type = record.get('tweakml_type')
+    if tweakml_type not in CURVE_PARAMETERS:
+        raise RuntimeError("I don't know the tweakml_type %s of this noise model." % tweakml_type)
+    if not record.get('curves'):
+        raise RuntimeError("This noise model has no curves.")
+    for curve in record['curves']:
+        missing = [key for key in CURVE_PARAMETERS[tweakml_type] if key not in curve]
+        if missing:
+            raise RuntimeError("Curve %s of this %s noise model misses %s." % (curve.get('object'), tweakml_type,
+                                                                               ', '.join(missing)))
+
+
+def _write_json(path, data):
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_file, path)
+
+
+def write_record(path, record):
+    validate(record)
+    _write_json(path, record)
+
+
+def read_record(path):
+    with open(path, 'r') as f:
+        record = json.load(f)
+    validate(record)
+    return record
+
+
+def tweakml_list(record, rng=None):
+    """
+    One tweakml function per curve, with the parameters of the record.
+    rng: np.random.RandomState the noise is drawn from. The tweakml functions of pycs3 reseed numpy's global generator
+    from the system entropy, the drawing of the mocks hence uses seeded_tweakml_PS and seeded_tweakml instead.
+    """
+    tweaks = []
+    for curve in record['curves']:
+        if record['tweakml_type'] == 'PS_from_residuals':
+            if rng is None:
+                tweaks.append(partial(twk.tweakml_PS, B=curve['B'], f_min=1 / 300.0, psplot=False, verbose=False,
+                                      interpolation='linear', A_correction=curve['A_correction']))
+            else:
+                tweaks.append(partial(seeded_tweakml_PS, B=curve['B'], rng=rng, f_min=1 / 300.0,
+                                      A_correction=curve['A_correction']))
+        else:
+            if rng is None:
+                tweaks.append(partial(twk.tweakml, beta=curve['beta'], sigma=curve['sigma'], fmin=1.0 / 500.0,
+                                      fmax=0.2, psplot=False))
+            else:
+                tweaks.append(partial(seeded_tweakml, beta=curve['beta'], sigma=curve['sigma'], rng=rng,
+                                      fmin=1.0 / 500.0, fmax=0.2))
+    return tweaks
+
+
+def _fftnoise(f, rng):
+    # twk.fftnoise, with the phases drawn from rng
+    f = np.array(f, dtype='complex')
+    Np = (len(f) - 1) // 2
+    phases = rng.rand(Np) * 2 * np.pi
+    phases = np.cos(phases) + 1j * np.sin(phases)
+    f[1:Np + 1] *= phases
+    f[-1:-1 - Np:-1] = np.conj(f[1:Np + 1])
+    return np.fft.ifft(f).real
+
+
+def _band_limited_noise_withPS(freqs, PS, samples, samplerate, rng):
+    # twk.band_limited_noise_withPS, with the phases drawn from rng
+    freqs_noise = np.abs(np.fft.fftfreq(samples, 1 / samplerate))
+    PS_interp = np.interp(freqs_noise, freqs, PS, left=0., right=0.)
+    return _fftnoise(np.ones(samples) * PS_interp, rng)
+
+
+def ps_frequencies(rls, B, f_min=1 / 300.0):
+    """
+    The frequency grid of the periodogram of the residuals rls in twk.tweakml_PS.
+    """
+    sampling = (rls.jds[-1] - rls.jds[0]) / len(rls.jds)
+    return np.linspace(f_min, B * 1 / (sampling * 2.0), 10000)
+
+
+def seeded_tweakml_PS(lcs, spline, B, rng, f_min=1 / 300.0, A_correction=1.0, periodogram=scipy.signal.lombscargle):
+    """
+    twk.tweakml_PS (without its plots), drawing the phases of the noise from rng instead of numpy's global generator.
+    periodogram: computes the periodogram of the residuals, as periodogram(jds, mags, ps_frequencies(...)).
+    """
+    for l in lcs:
+        if l.ml == None:
+            raise RuntimeError("ERROR, curve %s has no ML to tweak ! I won't tweak anything." % (str(l)))
+        elif l.ml.mltype != "spline":
+            raise RuntimeError("ERROR, I can only tweak SplineML objects, curve %s has something else !  "
+                               "I won't tweak anything." % (str(l)))
+
+        name = "ML(%s)" % (l.object)
+        ml_spline = l.ml.spline.copy()
+        rls = pycs3.gen.stat.subtract([l], spline)[0]
+        target_std = pycs3.gen.stat.resistats(rls)['std']
+
+        x = rls.jds
+        y = rls.mags
+        start = x[0]
+        stop = x[-1]
+        span = stop - start
+
+        # same number of samples of the generated noise as twk.tweakml_PS
+        sample_per_day = 5
+        for B_min, n in [(1., 7), (1.5, 10), (2., 15), (2.5, 20), (3., 30)]:
+            if B >= B_min:
+                sample_per_day = n
+        samples = int(span) * sample_per_day
+        if samples % 2 == 1:
+            samples -= 1
+        samplerate = 1
+
+        freqs_data = ps_frequencies(rls, B, f_min=f_min)
+        pgram = periodogram(x, y, freqs_data)
+
+        # generate the noise once to find its scaling, then with the right amplitude
+        band_noise = _band_limited_noise_withPS(freqs_data, len(freqs_data) * pgram, samples, samplerate, rng)
+        x_sample = np.linspace(start, stop, samples)
+        noise_lcs_band = pycs3.gen.lc.LightCurve()
+        noise_lcs_band.jds = x_sample
+        noise_lcs_band.mags = band_noise
+        Amp = target_std / pycs3.gen.stat.resistats(noise_lcs_band)['std']
+        band_noise_rescaled = _band_limited_noise_withPS(freqs_data, len(freqs_data) * Amp * pgram * A_correction,
+                                                         samples, samplerate, rng)
+
+        source = pycs3.sim.src.Source(ml_spline, name=name, sampling=span / float(samples))
+        if len(band_noise_rescaled) != len(source.imags):  # round error, as in twk.tweakml_PS
+            source.sampling = float(source.jdmax - source.jdmin) / float(len(band_noise_rescaled))
+            source.ijds = np.linspace(source.jdmin, source.jdmax, (len(band_noise_rescaled)))
+            source.imags = source.inispline.eval(jds=source.ijds)
+
+        source.imags += band_noise_rescaled
+        newspline = source.generate_spline()
+        l.ml.replacespline(newspline)
+
+
+def seeded_tweakml(lcs, spline, beta, sigma, rng, fmin=1 / 500.0, fmax=None, sampling=0.1):
+    """
+    twk.tweakml (without its plots), with the seed of the power law noise drawn from rng.
+    """
+    for l in lcs:
+        if l.ml is None or l.ml.mltype != "spline":
+            twk.logger.warning("I can only tweak SplineML objects, curve %s has something else !" % (str(l)))
+            continue
+        source = pycs3.sim.src.Source(l.ml.spline.copy(), name="ML(%s)" % l.object, sampling=sampling)
+        source.addplaw2(beta=beta, sigma=sigma, fmin=fmin, fmax=fmax, flux=False, seed=rng.randint(2 ** 31 - 1))
+        source.name += "_twk"
+        l.ml.replacespline(source.generate_spline())
+
+
+def load_tweakml(path, rng=None):
+    """
+    The tweakml functions of the record in path, built once per process, or drawing from rng (see tweakml_list).
+    """
+    if rng is not None:
+        return tweakml_list(read_record(path), rng=rng)
+    if path not in _tweakml_cache:
+        _tweakml_cache[path] = tweakml_list(read_record(path))
+    return _tweakml_cache[path]
+
+
+@contextlib.contextmanager
+def _lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'w') as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+
+def update_summary(work_dir, dataset, combkw, record):
+    """
+    Adds the record of grid cell combkw of dataset (<lensname>_<dataname>) to the summary of the run directory.
+    """
+    path = os.path.join(work_dir, SUMMARY_NAME)
+    # the cells of all the lenses write here
+    with _lock(path):
+        summary = read_summary(work_dir)
+        summary.setdefault(dataset, {})[combkw] = record
+        _write_json(path, summary)
+
+
+def read_summary(work_dir='./'):
+    """
+    The records of all the lenses and grid cells: {dataset: {combkw: record}}.
+    """
+    try:
+        with open(os.path.join(work_dir, SUMMARY_NAME), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
@@ -0,0 +1,175 @@
+"""
+Deferred rendering of the figures of the stages. Instead of drawing inline, in the middle of the compute loops,
+the stages add plot specs to a PlotQueue (the plotting function, the data to plot and the file to write), and
+render() draws them afterwards in a pool of processes.
+A figure is skipped when its inputs hash to the same value as when it was last rendered and the file is still there.
+The hashes are kept in plot_cache.json, in the directory of the figures.
+
+    queue = PlotQueue(figure_directory, processes=8)
+    queue.add(figure_directory + 'fit.png', pycs3.gen.lc_func.display, lcs, [spline], showdelays=True)
+    queue.render()
+
+With enabled=False (--no-plots of the scripts), add() and render() do nothing.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+
+from multiprocess import Pool
+
+try:
+    import fcntl
+except ImportError:  # windows: no locking
+    fcntl = None
+
+CACHE_NAME = 'plot_cache.json'
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return path, st.st_size, st.st_mtime_ns
+
+
+class PlotSpec:
+    """
+    A figure to render: func(*args, **kwargs), with the output file passed as the filename_kw argument.
+    outputs: the files the figure writes (the filename by default).
+    inputs: files read by func, their size and modification time are part of the hash.
+    """
+    def __init__(self, filename, func, args, kwargs, filename_kw='filename', outputs=None, inputs=None):
+        self.filename = filename
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.filename_kw = filename_kw
+        self.outputs = [filename] if outputs is None else list(outputs)
+        self.inputs = [] if inputs is None else list(inputs)
+        # the figure is known by its (first) output file
+        self.key = self.outputs[0]
+
+    def digest(self):
+        """
+        The hash of the inputs of the figure, None if they cannot be pickled (the figure is then always rendered).
+        """
+        try:
+            blob = pickle.dumps((self.func.__module__, self.func.__qualname__, self.args, sorted(self.kwargs.items()),
+                                 self.filename_kw, [_file_signature(p) for p in self.inputs]), protocol=4)
+        except Exception:
+            return None
+        return hashlib.sha1(blob).hexdigest()
+
+    def draw(self):
+        kwargs = dict(self.kwargs)
+        if self.filename_kw is not None:
+            kwargs[self.filename_kw] = self.filename
+        self.func(*self.args, **kwargs)
+
+
+def _render(spec):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    try:
+        spec.draw()
+        return spec.key, None
+    except Exception as e:
+        return spec.key, "%s: %s" % (type(e).__name__, e)
+    finally:
+        plt.close('all')
+
+
+class PlotQueue:
+    def __init__(self, directory, processes=1, enabled=True, display=False):
+        """
+        directory: where the cache of the hashes is kept, usually the figure directory of the stage.
+        display: render in this process and show the figures on screen as well.
+        """
+        self.cache_file = os.path.join(directory, CACHE_NAME)
+        self.processes = max(processes or 1, 1)
+        self.enabled = enabled
+        self.display = display
+        self.specs = {}
+
+    def add(self, filename, func, *args, filename_kw='filename', outputs=None, inputs=None, **kwargs):
+        """
+        Queues func(*args, **kwargs, filename=filename). A figure queued again for the same file replaces the first one.
+        """
+        if not self.enabled:
+            return
+        spec = PlotSpec(filename, func, args, kwargs, filename_kw=filename_kw, outputs=outputs, inputs=inputs)
+        self.specs[spec.key] = spec
+
+    def __len__(self):
+        return len(self.specs)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(self.cache_file + '.lock', 'w') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _update_cache(self, digests):
+        # several stages (or grid cells) can share the directory: merge with what they wrote in the meantime
+        with self._lock():
+            cache = self._read_cache()
+            cache.update(digests)
+            tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.cache_file)
+
+    def render(self):
+        """
+        Renders the queued figures whose inputs changed, returns the number of figures rendered.
+        """
+        if not self.enabled or len(self.specs) == 0:
+            return 0
+        cache = self._read_cache()
+        digests = {key: spec.digest() for key, spec in self.specs.items()}
+        todo = [spec for key, spec in self.specs.items()
+                if self.display or digests[key] is None or cache.get(key) != digests[key]
+                or not all(os.path.exists(p) for p in spec.outputs)]
+        print("Rendering %i figures, %i unchanged." % (len(todo), len(self.specs) - len(todo)))
+
+        if self.display:
+            import matplotlib.pyplot as plt
+            results = []
+            for spec in todo:
+                spec.draw()
+                plt.show()
+                results.append((spec.key, None))
+        elif self.processes == 1 or len(todo) <= 1:
+            results = [_render(spec) for spec in todo]
+        else:
+            with Pool(min(self.processes, len(todo))) as p:
+                results = p.map(_render, todo, chunksize=1)
+
+        rendered = {}
+        for key, error in results:
+            if error is not None:
+                print("Could not render %s, %s" % (key, error))
+            elif digests[key] is not None:
+                rendered[key] = digests[key]
+        # a figure that failed is rendered again next time
+        failed = {key: None for key, error in results if error is not None}
+        self._update_cache({**rendered, **failed})
+        self.specs = {}
+        return len(todo) - len(failed)
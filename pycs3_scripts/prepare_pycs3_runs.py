@@ -27,40 +27,41 @@ db = Database(initial_guess_path, pkl_dir)
 import importlib
 create_dataset = importlib.import_module('1_create_dataset', package=None).create_dataset
 
-alldb = db.get()
-
-
-# create configs
-for key, item in alldb.items():
-    print(f"Creating directory structure for {key}")
-
-    # okkkk fine sticking with the PyCS3 script convention,
-    # dataname = obj_inst
-    inst = key.split('_')[1].replace('.rdb', '').replace('.pkl', '')
-    obj = key.split('_')[0]
-
-    dataname = f"{obj}_{inst}"
-
-    ddb = db.get([key])
-    labels = sorted(list(ddb['curves'].keys()))
-    timeshifts = [ddb['curves'][key]['timeshift'] for key in labels]
-    magshifts = [ddb['curves'][key]['magshift'] for key in labels]
-    
-    if 'mltouse' not in ddb:
-        print("No indication of which MLs to use!!!")
-        continue
-    else:
-        mltouse = ddb['mltouse']
-
-    if 'knotstouse' not in ddb:
-        print("No indication of which knot steps to use!!!")
-        # we do not proceed
-        continue
-    else:
-        knotstouse = ddb['knotstouse']
-    tsrand = ddb.get('tsrand', None)
-    create_dataset(dataname, labels, mltouse, knotstouse, timeshifts_ini=timeshifts,
-                   tsrand=tsrand, work_dir=run_dir, TEST=False)
+# one read of the database for the whole loop
+with db.read_cache():
+    alldb = db.get()
+
+    # create configs
+    for key, item in alldb.items():
+        print(f"Creating directory structure for {key}")
+
+        # okkkk fine sticking with the PyCS3 script convention,
+        # dataname = obj_inst
+        inst = key.split('_')[1].replace('.rdb', '').replace('.pkl', '')
+        obj = key.split('_')[0]
+
+        dataname = f"{obj}_{inst}"
+
+        ddb = db.get([key])
+        labels = sorted(list(ddb['curves'].keys()))
+        timeshifts = [ddb['curves'][key]['timeshift'] for key in labels]
+        magshifts = [ddb['curves'][key]['magshift'] for key in labels]
+
+        if 'mltouse' not in ddb:
+            print("No indication of which MLs to use!!!")
+            continue
+        else:
+            mltouse = ddb['mltouse']
+
+        if 'knotstouse' not in ddb:
+            print("No indication of which knot steps to use!!!")
+            # we do not proceed
+            continue
+        else:
+            knotstouse = ddb['knotstouse']
+        tsrand = ddb.get('tsrand', None)
+        create_dataset(dataname, labels, mltouse, knotstouse, timeshifts_ini=timeshifts,
+                       tsrand=tsrand, work_dir=run_dir, TEST=False)
 
 scripts = [
     "2_fit_spline.py",
@@ -77,6 +78,17 @@ runscripttemplate = "#!/bin/bash\n"
 for script in scripts:
     copy(script, str(run_dir))
     runscripttemplate += f"python {script} {{obj}} {{inst}}\n"
+# and the scheduler running all of them for all the lenses at once:
+copy("run_pipeline.py", str(run_dir))
+# imported by the scripts:
+copy("mock_store.py", str(run_dir))
+copy("shared_curves.py", str(run_dir))
+copy("plot_queue.py", str(run_dir))
+copy("noise_models.py", str(run_dir))
+copy("mock_stats.py", str(run_dir))
+copy("manifest.py", str(run_dir))
+copy("instrumentation.py", str(run_dir))
+copy("run_config.py", str(run_dir))
 
 configdir.mkdir(exist_ok=True, parents=True)
 
@@ -0,0 +1,226 @@
+"""
+The config of a data set (config/config_<lensname>_<dataname>.py), as a typed object that the scripts and their
+workers can read without importing the config module, hence the whole of pycs3 it imports:
+
+    config = run_config.load(lensname, dataname, work_dir)
+    config.knotstep, config.combkw[i, j]    # read from the snapshot
+    config.spl1(lcs, kn=kn)                 # the functions import the config module on first use
+
+The snapshot config/config_<lensname>_<dataname>.json is a declarative copy of the config module:
+
+    {"module_sha1": <sha1 of the .py>, "values": {"knotstep": [15, 25], "combkw": {"__ndarray__": [[...]],
+     "dtype": "<U32"}, ...}, "lazy": ["spl1", "regdiff", "attachml", "optfct", "simoptfct", ...]}
+
+"values" has the numbers, strings, lists and arrays of the module, "lazy" the names of everything else (functions).
+The snapshot is written again, by importing the module once, whenever the .py changed: the .py stays the file to edit.
+A config is loaded once per process, the workers forked after main loaded it do not even read the snapshot.
+"""
+import hashlib
+import importlib
+import json
+import os
+import sys
+import types
+
+import numpy as np
+
+SNAPSHOT_FORMAT = 1
+
+# expected types of the values of the config, checked when the snapshot is written
+FIELDS = {
+    'lcs_label': list,
+    'delay_labels': list,
+    'timeshifts': (list, np.ndarray),
+    'magshift': (list, np.ndarray, type(None)),
+    'askquestions': bool,
+    'display': bool,
+    'max_core': (int, type(None)),
+    'optfctkw': str,
+    'simoptfctkw': str,
+    'knotstep': list,
+    'ncopy': int,
+    'ncopypkls': int,
+    'nsim': int,
+    'nsimpkls': int,
+    'truetsr': (int, float),
+    'tsrand': (int, float),
+    'mock_seed': (int, type(None)),
+    'run_on_copies': bool,
+    'run_on_sims': bool,
+    'use_mock_store': bool,
+    'mltype': str,
+    'mlknotsteps': list,
+    'forcen': bool,
+    'nmlspl': list,
+    'degree': list,
+    'tweakml_name': str,
+    'tweakml_type': str,
+    'find_tweak_ml_param': bool,
+    'n_curve_stat': int,
+    'max_iter': int,
+    'combkw': np.ndarray,
+    'simset_copy': str,
+    'simset_mock': str,
+    'optset': list,
+    'lens_directory': str,
+    'figure_directory': str,
+    'report_directory': str,
+    'data': str,
+}
+
+# configs loaded by this process, by path of the config module
+_configs = {}
+
+
+def module_name(lensname, dataname):
+    return "config_" + lensname + "_" + dataname
+
+
+def config_directory(work_dir='./'):
+    return os.path.join(work_dir, 'config')
+
+
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _encode(value):
+    # None for the values that cannot go to json
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind not in 'biufU':
+            return None
+        return {'__ndarray__': value.tolist(), 'dtype': value.dtype.str}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        items = [_encode(v) for v in value]
+        if any(item is None and v is not None for item, v in zip(items, value)):
+            return None
+        return items
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        items = {k: _encode(v) for k, v in value.items()}
+        if any(items[k] is None and value[k] is not None for k in value):
+            return None
+        return items
+    return None
+
+
+def _decode(value):
+    if isinstance(value, dict) and '__ndarray__' in value:
+        return np.array(value['__ndarray__'], dtype=value['dtype'])
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _decode(v) for k, v in value.items()}
+    return value
+
+
+def validate(values, name=''):
+    wrong = []
+    for field, expected in FIELDS.items():
+        if field in values and not isinstance(values[field], expected):
+            expected = expected if isinstance(expected, tuple) else (expected,)
+            wrong.append("%s (%s, expected %s)" % (field, type(values[field]).__name__,
+                                                   ' or '.join(t.__name__ for t in expected)))
+    if wrong:
+        raise RuntimeError("Wrong type of %s in config %s." % (', '.join(wrong), name))
+
+
+def import_config_module(lensname, dataname, work_dir='./'):
+    directory = config_directory(work_dir)
+    if directory not in sys.path:
+        sys.path.append(directory)
+    return importlib.import_module(module_name(lensname, dataname))
+
+
+def snapshot(module):
+    """
+    The values of the config module and the names of its other attributes (functions...).
+    """
+    values, lazy = {}, []
+    for name, value in vars(module).items():
+        if name.startswith('_') or isinstance(value, types.ModuleType):
+            continue
+        encoded = _encode(value)
+        if encoded is None and value is not None:
+            lazy.append(name)
+        else:
+            values[name] = value
+    validate(values, module.__name__)
+    return values, lazy
+
+
+def write_snapshot(path, module_sha1, values, lazy):
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({'format': SNAPSHOT_FORMAT, 'module_sha1': module_sha1,
+                   'values': {name: _encode(value) for name, value in values.items()}, 'lazy': lazy}, f, indent=1)
+    os.replace(tmp_file, path)
+
+
+def read_snapshot(path, module_sha1):
+    """
+    The values and lazy names of the snapshot, None if there is none or if it is not the one of this module.
+    """
+    try:
+        with open(path, 'r') as f:
+            stored = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if stored.get('format') != SNAPSHOT_FORMAT or stored.get('module_sha1') != module_sha1:
+        return None
+    return {name: _decode(value) for name, value in stored['values'].items()}, stored['lazy']
+
+
+class RunConfig:
+    def __init__(self, lensname, dataname, work_dir, values, lazy, module=None):
+        self.__dict__.update(values)
+        self._lensname = lensname
+        self._dataname = dataname
+        self._work_dir = work_dir
+        self._lazy = set(lazy)
+        self._module = module
+
+    @property
+    def module(self):
+        """
+        The config module itself, imported on first use.
+        """
+        if self._module is None:
+            self._module = import_config_module(self._lensname, self._dataname, self._work_dir)
+        return self._module
+
+    def __getattr__(self, name):
+        # only called for what is not in the snapshot
+        if name.startswith('_') or name not in self.__dict__.get('_lazy', ()):
+            raise AttributeError("config %s has no %s" % (module_name(self.__dict__.get('_lensname'),
+                                                                    self.__dict__.get('_dataname')), name))
+        value = getattr(self.module, name)
+        setattr(self, name, value)
+        return value
+
+
+def load(lensname, dataname, work_dir='./'):
+    """
+    The config of the data set, from its snapshot if it is up to date, from the module otherwise.
+    """
+    path = os.path.join(config_directory(work_dir), module_name(lensname, dataname) + '.py')
+    key = os.path.abspath(path)
+    if key in _configs:
+        return _configs[key]
+
+    module_sha1 = file_sha1(path)
+    snapshot_path = path[:-len('.py')] + '.json'
+    stored = read_snapshot(snapshot_path, module_sha1)
+    module = None
+    if stored is None:
+        module = import_config_module(lensname, dataname, work_dir)
+        values, lazy = snapshot(module)
+        write_snapshot(snapshot_path, module_sha1, values, lazy)
+        # the same types as when read from the snapshot (lists instead of tuples...)
+        stored = {name: _decode(_encode(value)) for name, value in values.items()}, lazy
+    _configs[key] = RunConfig(lensname, dataname, work_dir, *stored, module=module)
+    return _configs[key]
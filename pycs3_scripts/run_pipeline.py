@@ -0,0 +1,251 @@
+"""
+Runs the scripts 2 to 4c for all the lenses at once, instead of the run_*.sh files (one lens after the other,
+one stage after the other).
+Each stage of each lens (and each grid cell of the knotstep x ml grid, for the stages that loop over it) is a task,
+started as soon as the tasks it depends on are done and enough cores are free within the global budget:
+
+    2_fit_spline -> 3a -> 3b -> 3c -> 3d
+                                   -> 4a -> 4b -> 4c
+
+A marker file is written for every finished task, so that running this script again after an interruption
+resumes where it stopped. Use --restart to ignore the markers.
+The wall time, CPU time and peak memory of every stage and worker task go to pipeline_logs/timings_<run>.jsonl
+(see instrumentation.py).
+Run it from your run directory, where prepare_pycs3_runs.py copied the scripts.
+"""
+import argparse as ap
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from multiprocess import cpu_count
+
+import instrumentation
+import run_config
+
+# stage name, script, granularity ('lens' or 'cell'), whether the script runs its own pool of workers
+STAGES = [
+    ('2', '2_fit_spline.py', 'lens', True),
+    ('3a', '3a_generate_tweakml.py', 'cell', True),
+    ('3b', '3b_draw_copy_mocks.py', 'cell', True),
+    ('3c', '3c_optimise_copy_mocks.py', 'cell', True),
+    ('3d', '3d_check_statistics.py', 'cell', True),
+    ('4a', '4a_plot_results.py', 'cell', True),
+    ('4b', '4b_marginalise_spline.py', 'lens', False),
+    ('4c', '4c_covariance_matrices.py', 'lens', False),
+]
+
+# the stages that draw figures (see plot_queue.py), they take --no-plots
+PLOTTING_STAGES = ['2', '3d', '4a', '4b']
+
+DEPENDENCIES = {
+    '2': [],
+    '3a': ['2'],
+    '3b': ['3a'],
+    '3c': ['3b'],
+    '3d': ['3c'],
+    '4a': ['3c'],
+    '4b': ['4a'],
+    '4c': ['4b'],
+}
+
+# with regdiff, the copies are optimised by the 3c of the grid cell 0 0 only, and their delays written by its 4a:
+# the 4a of the other cells also wait for these
+REGDIFF_FIRST_CELL_DEPENDENCIES = {
+    '4a': ['3c', '4a'],
+}
+
+
+class Task:
+    def __init__(self, lensname, dataname, stage, script, cell=None, combkw=None, cores=1, uses_pool=False,
+                 work_dir='./', plots=True):
+        self.lensname = lensname
+        self.dataname = dataname
+        self.stage = stage
+        self.script = script
+        self.cell = cell
+        self.cores = cores
+        self.uses_pool = uses_pool
+        self.plots = plots
+        self.deps = []
+        name = stage if combkw is None else f"{stage}_{combkw}"
+        self.key = (f"{lensname}_{dataname}", name)
+        self.marker = Path(work_dir) / 'pipeline_status' / f"{lensname}_{dataname}" / f"{name}.done"
+        self.log = Path(work_dir) / 'pipeline_logs' / f"{lensname}_{dataname}" / f"{name}.log"
+
+    def command(self):
+        cmd = [sys.executable, self.script, self.lensname, self.dataname]
+        if self.cell is not None:
+            cmd += ['--cell', str(self.cell[0]), str(self.cell[1])]
+        if self.uses_pool:
+            cmd += ['--max-core', str(self.cores)]
+        if not self.plots and self.stage in PLOTTING_STAGES:
+            cmd += ['--no-plots']
+        return cmd
+
+    def __repr__(self):
+        return '/'.join(self.key)
+
+
+def build_tasks(datanames, work_dir='./', per_cell=True, cores_per_task=8, plots=True):
+    """
+    The tasks of all the lenses, with their dependencies.
+
+    datanames: list of (lensname, dataname) as in the name of the config files (config_<lensname>_<dataname>.py)
+    """
+    tasks = []
+    for lensname, dataname in datanames:
+        config = run_config.load(lensname, dataname, work_dir)
+        by_stage = {}
+        for stage, script, granularity, uses_pool in STAGES:
+            cores = cores_per_task if uses_pool else 1
+            if granularity == 'cell' and per_cell:
+                n_kn, n_ml = config.combkw.shape
+                by_stage[stage] = {(i, j): Task(lensname, dataname, stage, script, cell=(i, j),
+                                                combkw=config.combkw[i, j], cores=cores, uses_pool=uses_pool,
+                                                work_dir=work_dir, plots=plots)
+                                   for i in range(n_kn) for j in range(n_ml)}
+            else:
+                by_stage[stage] = {None: Task(lensname, dataname, stage, script, cores=cores, uses_pool=uses_pool,
+                                              work_dir=work_dir, plots=plots)}
+            for cell, task in by_stage[stage].items():
+                for dep in DEPENDENCIES[stage]:
+                    if None in by_stage[dep]:
+                        task.deps.append(by_stage[dep][None])
+                    elif cell is not None:
+                        task.deps.append(by_stage[dep][cell])
+                    else:
+                        # a lens level stage waits for all the cells of the previous one
+                        task.deps += list(by_stage[dep].values())
+                if config.simoptfctkw == "regdiff" and cell not in (None, (0, 0)):
+                    for dep in REGDIFF_FIRST_CELL_DEPENDENCIES.get(stage, []):
+                        if (0, 0) in by_stage[dep] and by_stage[dep][(0, 0)] not in task.deps:
+                            task.deps.append(by_stage[dep][(0, 0)])
+                tasks.append(task)
+    return tasks
+
+
+def run_tasks(tasks, total_cores, work_dir='./', poll=2.0):
+    """
+    Starts the tasks whose dependencies are done, as long as they fit in total_cores.
+    A failed task does not stop the others, only the tasks depending on it.
+    """
+    done = {task.key for task in tasks if task.marker.exists()}
+    if done:
+        print(f"Resuming: {len(done)} of {len(tasks)} tasks already done.")
+    pending = [task for task in tasks if task.key not in done]
+    failed = set()
+    running = {}
+    used_cores = 0
+
+    while pending or running:
+        for task, (proc, log) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            log.close()
+            del running[task]
+            used_cores -= task.cores
+            if proc.returncode == 0:
+                task.marker.parent.mkdir(parents=True, exist_ok=True)
+                task.marker.write_text(' '.join(task.command()) + '\n')
+                done.add(task.key)
+                print(f"done: {task}")
+            else:
+                failed.add(task.key)
+                print(f"FAILED: {task} (exit code {proc.returncode}), see {task.log}")
+
+        for task in list(pending):
+            if any(dep.key in failed for dep in task.deps):
+                pending.remove(task)
+                failed.add(task.key)
+                print(f"skipped: {task}, a task it depends on failed.")
+                continue
+            if not all(dep.key in done for dep in task.deps):
+                continue
+            task.cores = min(task.cores, total_cores)
+            if used_cores + task.cores > total_cores:
+                continue
+            task.log.parent.mkdir(parents=True, exist_ok=True)
+            log = open(task.log, 'w')
+            proc = subprocess.Popen(task.command(), cwd=work_dir,
+                                    stdout=log, stderr=subprocess.STDOUT)
+            running[task] = (proc, log)
+            used_cores += task.cores
+            pending.remove(task)
+            print(f"started: {task} on {task.cores} core(s)")
+
+        if pending or running:
+            time.sleep(poll)
+
+    print(f"Finished: {len(done)} tasks done, {len(failed)} failed or skipped.")
+    return len(failed) == 0
+
+
+def find_datanames(work_dir='./'):
+    datanames = []
+    for cfile in sorted((Path(work_dir) / 'config').glob('config_*.py')):
+        # config_<obj>_<inst>.py, same convention as prepare_pycs3_runs.py
+        _, obj, inst = cfile.stem.split('_', 2)
+        datanames.append((obj, inst))
+    return datanames
+
+
+def main(datanames=None, work_dir='./', cores=None, cores_per_task=8, per_cell=True, restart=False, plots=True):
+    if cores is None:
+        cores = cpu_count()
+    if not datanames:
+        datanames = find_datanames(work_dir)
+    tasks = build_tasks(datanames, work_dir=work_dir, per_cell=per_cell, cores_per_task=min(cores_per_task, cores),
+                        plots=plots)
+    if restart:
+        for task in tasks:
+            if task.marker.exists():
+                os.remove(task.marker)
+    print(f"{len(tasks)} tasks for {len(datanames)} data sets, on {cores} cores.")
+    # all the stages started here write their timings to the same file
+    run = instrumentation.new_run_id()
+    timings = instrumentation.timings_path(os.path.abspath(work_dir), run)
+    os.environ[instrumentation.RUN_ENV] = run
+    os.environ[instrumentation.TIMINGS_ENV] = timings
+    success = run_tasks(tasks, cores, work_dir=work_dir)
+    if os.path.exists(timings):
+        print(f"Timings in {timings}, summary with: python instrumentation.py {timings}")
+    return success
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(prog="python {}".format(os.path.basename(__file__)),
+                               description="Run the whole pipeline for all the lenses, sharing the cores.",
+                               formatter_class=ap.RawTextHelpFormatter)
+    help_datasets = "data sets to process, as lensname_dataname (e.g. J0924+0219_VST+WFI). Default: all the config files"
+    help_work_dir = "name of the working directory"
+    help_cores = "total number of cores to use. Default: all of them"
+    help_cores_per_task = "number of cores given to each of the stages that use a pool (2, 3a, 3b, 3c, 3d, 4a)"
+    help_per_lens = "do not split the stages 3a to 4a by grid cell"
+    help_restart = "ignore the markers of the previous runs and start again from scratch"
+    help_no_plots = "do not render the figures, for batch production runs"
+    parser.add_argument(dest='datasets', type=str, nargs='*',
+                        metavar='datasets', action='store',
+                        help=help_datasets)
+    parser.add_argument('--dir', dest='work_dir', type=str,
+                        metavar='', action='store', default='./',
+                        help=help_work_dir)
+    parser.add_argument('--cores', dest='cores', type=int, default=None,
+                        metavar='', action='store',
+                        help=help_cores)
+    parser.add_argument('--cores-per-task', dest='cores_per_task', type=int, default=8,
+                        metavar='', action='store',
+                        help=help_cores_per_task)
+    parser.add_argument('--per-lens', dest='per_lens', action='store_true',
+                        help=help_per_lens)
+    parser.add_argument('--restart', dest='restart', action='store_true',
+                        help=help_restart)
+    parser.add_argument('--no-plots', dest='no_plots', action='store_true',
+                        help=help_no_plots)
+    args = parser.parse_args()
+    datanames = [tuple(d.split('_', 1)) for d in args.datasets]
+    success = main(datanames, work_dir=args.work_dir, cores=args.cores, cores_per_task=args.cores_per_task,
+                   per_cell=not args.per_lens, restart=args.restart, plots=not args.no_plots)
+    sys.exit(0 if success else 1)
@@ -0,0 +1,152 @@
+"""
+Hands light curves to the workers of a pool through shared memory instead of pickling them into every job.
+The parent publishes the arrays of the curves (jds, mags, magerrs, mask, residuals) once in a shared memory block;
+the jobs only carry a small descriptor, from which the workers rebuild curves whose arrays are views on that block.
+The views are read-only: work on copies (lc.copy(), copy.deepcopy), as multidraw and multirun already do.
+
+    with SharedCurves(lcs) as shared:
+        pool.map(work, [(shared.descriptor, ...) for ...])
+
+    def work(descriptor, ...):
+        lcs = attach(descriptor)
+        ...
+        detach(descriptor)
+"""
+import copy
+import pickle
+import sys
+
+import numpy as np
+from multiprocess import shared_memory
+
+ARRAYS = [('jds', np.float64), ('mags', np.float64), ('magerrs', np.float64), ('mask', np.bool_),
+          ('residuals', np.float64), ('properties', np.int32)]
+
+# blocks attached in this process, by name, with the curves built on them, until detach().
+_attached = {}
+# blocks detached while some curves built on them were still in use, closed once these are freed.
+_detached = []
+
+
+def _per_point_codes(values):
+    """
+    The per point properties as integer codes, when they are plain strings (the telescope of each point).
+    """
+    if len(values) == 0 or not all(isinstance(v, str) for v in values):
+        return None, None
+    uniques, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return codes.astype(np.int32), uniques.tolist()
+
+
+class SharedCurves:
+    """
+    One shared memory block holding the arrays of a list of curves (a list of lists also works).
+    The parent owns the block: close it (or leave the with block) once the workers are done.
+    """
+    def __init__(self, lcs):
+        nested = len(lcs) > 0 and isinstance(lcs[0], (list, tuple))
+        flat = [l for sub in lcs for l in sub] if nested else list(lcs)
+
+        arrays, metas, layout = [], [], []
+        offset = 0
+        for l in flat:
+            codes, uniques = _per_point_codes(l.properties) if hasattr(l, 'properties') else (None, None)
+            values = {'jds': l.jds, 'mags': l.mags, 'magerrs': l.magerrs, 'mask': l.mask,
+                      'residuals': getattr(l, 'residuals', None), 'properties': codes}
+            curve_layout = {}
+            for name, dtype in ARRAYS:
+                if values[name] is None:
+                    continue
+                array = np.ascontiguousarray(values[name], dtype=dtype)
+                offset = -(-offset // 8) * 8  # aligned
+                curve_layout[name] = (offset, array.shape[0], np.dtype(dtype).str)
+                arrays.append((offset, array))
+                offset += array.nbytes
+            layout.append(curve_layout)
+
+            # everything else (names, shifts, microlensing) is small and travels pickled
+            meta = copy.copy(l)
+            for name in curve_layout:
+                setattr(meta, name, None)
+            if uniques is not None:
+                meta.properties = uniques
+            if all(label == '' for label in getattr(l, 'labels', [])):
+                meta.labels = None
+            metas.append(pickle.dumps(meta))
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for start, array in arrays:
+            self.shm.buf[start:start + array.nbytes] = array.tobytes()
+
+        self.descriptor = {'name': self.shm.name, 'layout': layout, 'metas': metas,
+                           'shape': [len(sub) for sub in lcs] if nested else None}
+
+    def close(self):
+        detach(self.descriptor)
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(descriptor):
+    """
+    The curves published by SharedCurves, with their arrays as read-only views on the shared block.
+    Attached once per process and block.
+    """
+    name = descriptor['name']
+    if name in _attached:
+        return _attached[name][2]
+    shm = shared_memory.SharedMemory(name=name)
+    # the arrays built on the block reference its mmap: the block can be closed once they are all freed
+    unused_refs = sys.getrefcount(shm.buf.obj)
+
+    flat = []
+    for blob, curve_layout in zip(descriptor['metas'], descriptor['layout']):
+        l = pickle.loads(blob)
+        for attr, (start, n, dtype) in curve_layout.items():
+            array = np.ndarray((n,), dtype=np.dtype(dtype), buffer=shm.buf, offset=start)
+            array.flags.writeable = False
+            if attr == 'properties':
+                uniques = l.properties
+                l.properties = [uniques[c] for c in array]
+            else:
+                setattr(l, attr, array)
+        if getattr(l, 'labels', '') is None:
+            l.labels = [''] * len(l.jds)
+        flat.append(l)
+
+    lcs = flat
+    if descriptor['shape'] is not None:
+        lcs, k = [], 0
+        for n in descriptor['shape']:
+            lcs.append(flat[k:k + n])
+            k += n
+    _attached[name] = (shm, unused_refs, lcs)
+    return lcs
+
+
+def _close_detached():
+    for entry in list(_detached):
+        shm, unused_refs = entry
+        # closing the block unmaps it, even under the arrays still using it
+        if sys.getrefcount(shm.buf.obj) > unused_refs:
+            continue
+        shm.close()
+        _detached.remove(entry)
+
+
+def detach(descriptor):
+    """
+    Forgets the curves attached from the block of descriptor in this process, once the work on them is done, and
+    unmaps the block. If some of these curves (or arrays) are still referenced, it is unmapped at a later detach.
+    """
+    entry = _attached.pop(descriptor['name'], None)
+    if entry is not None:
+        _detached.append(entry[:2])
+        del entry
+    _close_detached()
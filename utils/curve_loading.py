@@ -1,121 +1,335 @@
+import os
 import sqlite3
-import matplotlib.pyplot as plt
+import subprocess
+from pathlib import Path
+
 import numpy as np
-from collections import defaultdict
 
 from pycs3.gen.lc import LightCurve
 
-from utils.pycs3_utils import spl
+# detect_outliers is imported here as well, it used to live in this module.
+from utils.outlier_detection import OutlierDetector, detect_outliers
+from utils.photometry_cache import PhotometryCache
+
+
+# columns of the rows we hand over to the light curve builder, fetched directly into a structured array.
+PHOTOMETRY_DTYPE = np.dtype([('image', 'U16'), ('mjd', 'f8'), ('mag', 'f8'), ('mag_scatter', 'f8'),
+                             ('mag_fisher', 'f8'), ('telescope', 'U32')])
+
+PHOTOMETRY_BULK_DTYPE = np.dtype([('lens', 'U64')] + PHOTOMETRY_DTYPE.descr)
+
+# covering index: every lookup is `lens = ? (and telescope in (...))`, ordered by mjd,
+# and only reads the columns listed here, so sqlite never has to touch the table itself.
+PHOTOMETRY_INDEX = ("CREATE INDEX IF NOT EXISTS idx_photometry_lens_telescope_mjd ON photometry "
+                    "(lens, telescope, mjd, image, mag, mag_scatter, mag_fisher, seeing)")
+
+# one read-only connection per (database, process), shared by all the loaders.
+_connections = {}
+
+
+def _is_tracked(db_path):
+    """
+    True if the database is a file tracked by git, such as the data/photometry.db of this repository.
+    """
+    try:
+        result = subprocess.run(['git', 'ls-files', '--error-unmatch', db_path.name], cwd=db_path.parent,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:  # no git
+        return False
+    return result.returncode == 0
 
 
-def detect_outliers(lcs, sigma_threshold=2.5, debug=False, aesthetic_sigma=5):
+def _can_index(db_path):
+    """
+    Whether the loader may add its index to the database: not to a file tracked by git (it would leave the clone
+    dirty and change the hash of the data), nor to a read-only one. Without the index, the queries are just slower.
+    """
+    writable = os.access(db_path, os.W_OK) and os.access(db_path.parent, os.W_OK)
+    return writable and not _is_tracked(db_path)
 
-    outliers = []
-    for lc in lcs:
-        # fit a spline to the data
-        sp = spl([lc], nit=1, rough=1, knotstep=20)
 
-        # calculate the residuals of the spline fit
-        residuals = (lc.mags - sp.eval(lc.jds))
-        residuals_norm = residuals / lc.magerrs
+def _open_readonly_connection(photometry_db_path):
+    """
+    Returns the cached read-only connection to the database, creating the index on first use when the database can
+    be indexed (see _can_index).
+    Connections are keyed by pid as well, sqlite connections must not cross a fork.
+    """
+    db_path = Path(photometry_db_path).resolve()
+    key = (str(db_path), os.getpid())
+    if key in _connections:
+        return _connections[key]
 
-        sigma = np.std(residuals)
+    if _can_index(db_path):
+        try:
+            with sqlite3.connect(db_path) as conn:
+                conn.execute(PHOTOMETRY_INDEX)
+            conn.close()
+        except sqlite3.OperationalError as e:
+            # e.g. database locked or on a read-only filesystem: still works, just slower.
+            print(f"Could not create the photometry index on {db_path}: {e}")
 
-        # find points outside the envelope around the spline
-        outliers.extend(np.where(np.abs(residuals_norm) > sigma_threshold)[0])
-        # this one is for aesthetics:
-        outliers.extend(np.where(np.abs(residuals) > aesthetic_sigma * sigma)[0])
-        if debug:
-            plt.figure()
-            plt.plot(lc.jds, lc.mags, '.')
-            plt.plot(lc.jds, sp.eval(lc.jds), '-')
-            plt.waitforbuttonpress()
+    conn = sqlite3.connect(f"{db_path.as_uri()}?mode=ro", uri=True, check_same_thread=False)
+    _connections[key] = conn
+    return conn
 
-    return list(set(outliers))
+
+def build_conditions(lens, max_scatter=0.2, max_seeing=2.9, telescope=None):
+    """
+    Builds the WHERE clause selecting the photometry of a lens, with bound parameters.
+
+    Returns:
+    (str, list): the conditions with `?` placeholders, and the matching parameters.
+    """
+    conditions = "lens = ? and mag_scatter < ? and seeing < ?"
+    params = [lens, max_scatter, max_seeing]
+    if telescope is not None:
+        if type(telescope) is str:
+            telescope = [telescope]
+        conditions += f" and telescope in ({', '.join(len(telescope) * ['?'])})"
+        params += list(telescope)
+    return conditions, params
 
 
 class CurveLoader:
-    def __init__(self, photometry_db_path):
+    def __init__(self, photometry_db_path, cache_dir=None):
+        """
+        cache_dir: if given, the queried photometry is kept in cache_dir/photometry as memory-mappable column files
+                   (see utils.photometry_cache), and only re-read from the database when the database changes.
+                   Use one cache directory per database.
+                   The outlier masks are memoized in cache_dir/outlier_masks as well.
+        """
         self.photometry_db_path = photometry_db_path
+        self.cache = None
+        self.outlier_cache_dir = None
+        if cache_dir is not None:
+            self.cache = PhotometryCache(Path(cache_dir) / 'photometry', photometry_db_path)
+            self.outlier_cache_dir = Path(cache_dir) / 'outlier_masks'
 
-    def query_db(self, query):
+    @property
+    def connection(self):
+        return _open_readonly_connection(self.photometry_db_path)
+
+    def close(self):
         """
+        Closes the shared connection of this process to the database.
         """
-        conn = sqlite3.connect(self.photometry_db_path)
-        cursor = conn.cursor()
-        cursor.execute(query)
-        data = cursor.fetchall()
-        conn.close()
-        return data
+        key = (str(Path(self.photometry_db_path).resolve()), os.getpid())
+        conn = _connections.pop(key, None)
+        if conn is not None:
+            conn.close()
 
-    def query_photometry_by_image(self, conditions):
+    def query_db(self, query, params=()):
+        """
+        Executes a query with bound parameters on the persistent read-only connection,
+        returns the rows as a list of tuples.
+        """
+        return self.connection.execute(query, params).fetchall()
+
+    def query_array(self, query, params=(), dtype=PHOTOMETRY_DTYPE):
+        """
+        Same as query_db, but the rows are streamed straight into a numpy structured array of type dtype.
+        """
+        return np.fromiter(self.connection.execute(query, params), dtype=dtype)
+
+    def query_telescopes(self, lens):
+        """
+        Telescopes that observed this lens, in order of first observation.
+        """
+        query = "SELECT telescope FROM photometry WHERE lens = ? GROUP BY telescope ORDER BY min(mjd)"
+        return [t[0] for t in self.query_db(query, (lens,))]
+
+    def query_photometry_by_image(self, conditions, params=()):
         """
         Executes an SQLite query on a photometry database and returns the results grouped by 'image' column.
 
         Parameters:
-        photometry_db_path (str): Path to the SQLite database file.
-        conditions (str): Conditions to include in the WHERE clause of the SQL query.
+        conditions (str): Conditions to include in the WHERE clause of the SQL query, with `?` placeholders.
+        params (sequence): Values bound to the placeholders of `conditions`.
 
         Returns:
-        dict: A dictionary where each key is an 'image' label and each value is a tuple of three NumPy arrays (mjds, mags, mag_errs).
+        dict: A dictionary where each key is an 'image' label and each value is a tuple of four NumPy arrays
+              (mjds, mags, mag_errs, telescopes).
         """
-        query = f"SELECT image, mjd, mag, mag_scatter, mag_fisher, telescope FROM photometry WHERE {conditions} order by mjd"
-        data = self.query_db(query)
-
-        grouped_data = defaultdict(list)
-        for row in data:
-            grouped_data[row[0]].append(row[1:])
+        query = ("SELECT image, mjd, mag, mag_scatter, mag_fisher, telescope "
+                 f"FROM photometry WHERE {conditions} order by mjd")
+        data = self.query_array(query, params)
 
         result = {}
-        for image, values in grouped_data.items():
-            values = np.array(values)
-            mjds = np.array(values[:, 0], dtype=float)
-            mags = np.array(values[:, 1], dtype=float)
-            mag_scatter = np.array(values[:, 2], dtype=float)
-            mag_fisher = np.array(values[:, 3], dtype=float)
-            telescopes = values[:, 4]
-
-            # mag_scatter can be None
-            bad = np.where(np.isnan(mag_scatter))
-            if len(bad[0]) > 10:
-                print(f'wow, high fraction of None in mag scatter! for image {image} of query "{conditions}"')
-            mag_scatter[bad] = 0.2
-            mag_errs = 0.5 * (mag_scatter + mag_fisher)
-            result[image] = (mjds, mags, mag_errs, telescopes)
-
+        for (image,), values in group_rows(data, ['image']):
+            result[image] = curve_arrays(values, description=f'image {image} of query "{conditions}"')
         return result
 
-    def get_pycs3_curves(self, lens, max_scatter=0.2, max_seeing=2.9, cutmask=True, sigma_outlier=2.5, telescope=None):
-        conditions = f"lens='{lens}' and mag_scatter<{max_scatter} and seeing<{max_seeing}"
+    def query_photometry_by_lens_and_image(self, lenses, max_scatter=0.2, max_seeing=2.9, telescope=None):
+        """
+        Same as query_photometry_by_image, but for many lenses at once: a single ordered scan of the database.
+
+        Parameters:
+        lenses (list): names of the lenses to load.
+        max_scatter, max_seeing (float): same cuts as in get_pycs3_curves, applied to all lenses.
+        telescope (None, str, list or dict): telescope selection, either common to all lenses,
+                                             or a dictionary {lens: str or list} (lenses not in it keep all telescopes).
+
+        Returns:
+        dict: {lens: {image: (mjds, mags, mag_errs, telescopes)}}
+        """
+        lenses = list(lenses)
+        result = {lens: {} for lens in lenses}
+        if not lenses:
+            return result
+        query = ("SELECT lens, image, mjd, mag, mag_scatter, mag_fisher, telescope FROM photometry "
+                 f"WHERE lens in ({', '.join(len(lenses) * ['?'])}) and mag_scatter < ? and seeing < ? "
+                 "order by lens, mjd")
+        data = self.query_array(query, lenses + [max_scatter, max_seeing], dtype=PHOTOMETRY_BULK_DTYPE)
+
         if telescope is not None:
-            if type(telescope) is str:
-                conditions += f" and telescope='{telescope}'"
-            elif type(telescope) is list:
-                conditions += " and (" + ' or '.join([f"telescope='{tel}'" for tel in telescope]) + ')'
-        print(conditions)
-        res = self.query_photometry_by_image(conditions=conditions)
-        telescopes = self.query_db(f"select distinct(telescope) from photometry where lens='{lens}' order by mjd")
-        dataset_name = '+'.join([t[0] for t in telescopes])
-
-        CB_color_cycle = iter(['#377eb8', '#ff7f00', '#4daf4a',
-                               '#f781bf', '#a65628', '#984ea3',
-                               '#999999', '#e41a1c', '#dede00'])
-        lcs = []
-        for key, tupl in res.items():
-            lc = LightCurve(plotcolour=next(CB_color_cycle), object=key, telescopename=dataset_name)
-            lc.mags = tupl[1]
-            lc.jds = tupl[0]
-            lc.magerrs = tupl[2]
-            lc.labels = len(lc.jds) * ['']
-            tel_list = list(tupl[3])
-            tel_list = ['2p2' if e == 'WFI' else e for e in tel_list]
-            lc.properties = tel_list
-            outliers = detect_outliers([lc], sigma_threshold=sigma_outlier)
-            mask = np.ones_like(lc.mags, dtype=bool)
-            mask[(outliers,)] = False
-            lc.mask = mask
-            if cutmask:
-                lc.cutmask()
-            lcs.append(lc)
-        lcs = sorted(lcs, key=lambda lci: lci.object)
+            if type(telescope) is not dict:
+                telescope = {lens: telescope for lens in lenses}
+            keep = np.ones(len(data), dtype=bool)
+            for lens, tels in telescope.items():
+                if type(tels) is str:
+                    tels = [tels]
+                is_lens = data['lens'] == lens
+                keep[is_lens] = np.isin(data['telescope'][is_lens], tels)
+            data = data[keep]
+
+        for (lens, image), values in group_rows(data, ['lens', 'image']):
+            result[lens][image] = curve_arrays(values, description=f'image {image} of lens {lens}')
+        return result
+
+    def query_dataset_names(self, lenses):
+        """
+        Dataset names (telescopes joined by '+', in order of first observation) of many lenses, in one query.
+        """
+        lenses = list(lenses)
+        if not lenses:
+            return {}
+        query = (f"SELECT lens, telescope FROM photometry WHERE lens in ({', '.join(len(lenses) * ['?'])}) "
+                 "GROUP BY lens, telescope ORDER BY lens, min(mjd)")
+        telescopes = {lens: [] for lens in lenses}
+        for lens, tel in self.query_db(query, lenses):
+            telescopes[lens].append(tel)
+        return {lens: '+'.join(tels) for lens, tels in telescopes.items()}
+
+    def _load_cached(self, lens, max_scatter, max_seeing, telescope):
+        if self.cache is None:
+            return None
+        # opening the connection first: it may add the index to an untracked database, which changes its hash.
+        self.connection
+        return self.cache.load(lens, max_scatter, max_seeing, telescope)
+
+    def outlier_detector(self, sigma_outlier=2.5, processes=None):
+        return OutlierDetector(sigma_threshold=sigma_outlier, cache_dir=self.outlier_cache_dir, processes=processes)
+
+    def get_pycs3_curves(self, lens, max_scatter=0.2, max_seeing=2.9, cutmask=True, sigma_outlier=2.5, telescope=None,
+                         processes=1):
+        cached = self._load_cached(lens, max_scatter, max_seeing, telescope)
+        if cached is not None:
+            res, dataset_name = cached
+        else:
+            conditions, params = build_conditions(lens, max_scatter=max_scatter, max_seeing=max_seeing,
+                                                  telescope=telescope)
+            print(conditions, params)
+            res = self.query_photometry_by_image(conditions=conditions, params=params)
+            dataset_name = '+'.join(self.query_telescopes(lens))
+            if self.cache is not None:
+                self.cache.save(lens, max_scatter, max_seeing, telescope, res, dataset_name)
+
+        lcs = build_curves(res, dataset_name)
+        apply_outlier_masks(lcs, self.outlier_detector(sigma_outlier, processes).masks(lcs), cutmask)
         return lcs, dataset_name
+
+    def get_pycs3_curves_bulk(self, lenses, max_scatter=0.2, max_seeing=2.9, cutmask=True, sigma_outlier=2.5,
+                              telescope=None, processes=None):
+        """
+        Loads the curves of many lenses with one pass over the database, and runs the outlier detection
+        of all the curves in parallel.
+
+        telescope: see query_photometry_by_lens_and_image.
+        processes: number of workers for the outlier detection, None uses all the cores.
+
+        Returns:
+        dict: {lens: (lcs, dataset_name)}, the same as get_pycs3_curves for each lens.
+        """
+        lenses = list(lenses)
+        lens_telescopes = telescope if type(telescope) is dict else {lens: telescope for lens in lenses}
+        res, dataset_names = {}, {}
+        for lens in lenses:
+            cached = self._load_cached(lens, max_scatter, max_seeing, lens_telescopes.get(lens))
+            if cached is not None:
+                res[lens], dataset_names[lens] = cached
+
+        to_query = [lens for lens in lenses if lens not in res]
+        if to_query:
+            res.update(self.query_photometry_by_lens_and_image(to_query, max_scatter=max_scatter,
+                                                               max_seeing=max_seeing, telescope=telescope))
+            dataset_names.update(self.query_dataset_names(to_query))
+            if self.cache is not None:
+                for lens in to_query:
+                    self.cache.save(lens, max_scatter, max_seeing, lens_telescopes.get(lens),
+                                    res[lens], dataset_names[lens])
+
+        curves = {lens: build_curves(res[lens], dataset_names[lens]) for lens in lenses}
+        all_lcs = [lc for lcs in curves.values() for lc in lcs]
+        apply_outlier_masks(all_lcs, self.outlier_detector(sigma_outlier, processes).masks(all_lcs), cutmask)
+        return {lens: (lcs, dataset_names[lens]) for lens, lcs in curves.items()}
+
+
+def group_rows(data, keys):
+    """
+    Groups the rows of a structured array by the values of the `keys` columns, with a stable sort
+    so that the rows keep their original (mjd) order within each group.
+
+    Returns:
+    list: [(tuple of key values, rows of the group), ...], ordered by key values.
+    """
+    if len(data) == 0:
+        return []
+    data = data[np.lexsort([data[k] for k in reversed(keys)])]
+    new_group = np.zeros(len(data), dtype=bool)
+    for k in keys:
+        new_group[1:] |= data[k][1:] != data[k][:-1]
+    starts = np.flatnonzero(new_group)
+    return [(tuple(str(values[k][0]) for k in keys), values) for values in np.split(data, starts)]
+
+
+def curve_arrays(values, description=''):
+    """
+    From the database rows of one curve, returns the (mjds, mags, mag_errs, telescopes) arrays.
+    """
+    mag_scatter = values['mag_scatter'].copy()
+
+    # mag_scatter can be None
+    bad = np.where(np.isnan(mag_scatter))
+    if len(bad[0]) > 10:
+        print(f'wow, high fraction of None in mag scatter! for {description}')
+    mag_scatter[bad] = 0.2
+    mag_errs = 0.5 * (mag_scatter + values['mag_fisher'])
+    return values['mjd'].copy(), values['mag'].copy(), mag_errs, values['telescope']
+
+
+def build_curves(res, dataset_name):
+    """
+    PyCS3 light curves (sorted by image) from the output of query_photometry_by_image.
+    """
+    CB_color_cycle = iter(['#377eb8', '#ff7f00', '#4daf4a',
+                           '#f781bf', '#a65628', '#984ea3',
+                           '#999999', '#e41a1c', '#dede00'])
+    lcs = []
+    for key, tupl in res.items():
+        lc = LightCurve(plotcolour=next(CB_color_cycle), object=key, telescopename=dataset_name)
+        lc.mags = tupl[1]
+        lc.jds = tupl[0]
+        lc.magerrs = tupl[2]
+        lc.labels = len(lc.jds) * ['']
+        tel_list = list(tupl[3])
+        tel_list = ['2p2' if e == 'WFI' else str(e) for e in tel_list]
+        lc.properties = tel_list
+        lcs.append(lc)
+    return sorted(lcs, key=lambda lci: lci.object)
+
+
+def apply_outlier_masks(lcs, masks, cutmask=True):
+    for lc, mask in zip(lcs, masks):
+        lc.mask = mask
+        if cutmask:
+            lc.cutmask()
@@ -1,28 +1,82 @@
 from pathlib import Path
 
+import numpy as np
+
+
+def format_column(values):
+    """
+    The values as strings, all at once: the shortest text that reads back to the same float, as str(value) writes it.
+    """
+    return np.asarray(values).astype(str)
+
+
+def write_csv(path, header, columns):
+    with open(path, 'w') as f:
+        f.write(header + '\n')
+        f.writelines(','.join(row) + '\n' for row in zip(*columns))
+
 
 def to_d3cs_csv(out_dir, lcs, lens_name, dataset_name):
     template = f"{lens_name}_{dataset_name}_{{im}}.csv"
     for lc in lcs:
         ff = Path(out_dir) / template.format(im=lc.object)
-        with open(ff, 'w') as f:
-            f.write('mhjd,mag,magerr\n')
-            for jd, mag, mag_err in zip(lc.jds,lc.mags,lc.magerrs):
-                f.write(f"{jd},{mag},{mag_err}\n")
+        write_csv(ff, 'mhjd,mag,magerr', [format_column(lc.jds), format_column(lc.mags), format_column(lc.magerrs)])
+
 
+def to_d3cs_combined_csv(out_dir, lcs, lens_name, dataset_name):
+    """
+    Same as to_d3cs_csv, but all the curves of the lens go to a single file with an additional image column.
+    """
+    ff = Path(out_dir) / f"{lens_name}_{dataset_name}.csv"
+    images = np.concatenate([np.full(len(lc.jds), lc.object) for lc in lcs])
+    write_csv(ff, 'image,mhjd,mag,magerr', [images,
+                                            format_column(np.concatenate([lc.jds for lc in lcs])),
+                                            format_column(np.concatenate([lc.mags for lc in lcs])),
+                                            format_column(np.concatenate([lc.magerrs for lc in lcs]))])
 
-def all_pickles_to_d3cs(pkl_dir, out_dir_csv):
+
+def pickle_to_d3cs(pkl_file, out_dir_csv, combined=False):
     import pickle
-    pkl_files = list(Path(pkl_dir).glob('*.pkl'))
-    for pkl_file in pkl_files:
-        data_name = pkl_file.stem
-        lens_name, dataset_name = data_name.split('_')
-        with open(pkl_file, 'rb') as f:
-            lcs = pickle.load(f)
+    pkl_file = Path(pkl_file)
+    data_name = pkl_file.stem
+    lens_name, dataset_name = data_name.split('_')
+    with open(pkl_file, 'rb') as f:
+        lcs = pickle.load(f)
+    if combined:
+        to_d3cs_combined_csv(out_dir_csv, lcs, lens_name, dataset_name)
+    else:
         to_d3cs_csv(out_dir_csv, lcs, lens_name, dataset_name)
 
 
+def _pickle_to_d3cs_aux(args):
+    return pickle_to_d3cs(*args)
+
+
+def all_pickles_to_d3cs(pkl_dir, out_dir_csv, combined=False, processes=None):
+    """
+    Exports every pickle of pkl_dir, in parallel over `processes` workers (None: all the cores).
+    combined: one csv per lens (with an image column) instead of one per curve.
+    """
+    from multiprocess import Pool, cpu_count
+    pkl_files = list(Path(pkl_dir).glob('*.pkl'))
+    job_args = [(pkl_file, out_dir_csv, combined) for pkl_file in pkl_files]
+    if processes is None:
+        processes = cpu_count()
+    processes = min(processes, len(job_args))
+    if processes <= 1:
+        for args in job_args:
+            _pickle_to_d3cs_aux(args)
+    else:
+        with Pool(processes) as p:
+            p.map(_pickle_to_d3cs_aux, job_args)
+
 
 if __name__ == "__main__":
-    import sys
-    all_pickles_to_d3cs(sys.argv[1], sys.argv[2])
+    import argparse as ap
+    parser = ap.ArgumentParser(description="Export the pickled light curves to d3cs csv files.")
+    parser.add_argument('pkl_dir', type=str, help="directory containing the pickled light curves")
+    parser.add_argument('out_dir_csv', type=str, help="where to write the csv files")
+    parser.add_argument('--combined', action='store_true', help="one csv per lens, with an image column")
+    parser.add_argument('--processes', type=int, default=None, help="number of workers, default: all the cores")
+    args = parser.parse_args()
+    all_pickles_to_d3cs(args.pkl_dir, args.out_dir_csv, combined=args.combined, processes=args.processes)
@@ -1,18 +1,96 @@
 import json
+import os
 import pickle
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # windows: no locking
+    fcntl = None
+
 
 # this is a stupid json database to store our initial guesses and
 # what knotsteps / microlensing we deem appropriate for each object.
+# Many updates can be grouped in a transaction: the file is read once, locked, and written once at the end:
+#     with db.transaction():
+#         db.update(...)
+#         db.update(...)
+# and many reads can share a single load of the file:
+#     with db.read_cache():
+#         db.get(...)
 class Database:
     def __init__(self, file_path, pickled_curves_dir):
         self.file_path = file_path
         self.pickled_curves_dir = Path(pickled_curves_dir)
         self.pickled_curves_dir.mkdir(parents=True, exist_ok=True)
+        # data held in memory during a transaction or a read cache.
+        self._data = None
+        self._in_transaction = False
+
+    @contextmanager
+    def _lock(self, exclusive):
+        """
+        Advisory lock on a sidecar file, so that concurrent sessions do not clobber each other.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.file_path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Loads the data once, applies all the updates made within the block in memory,
+        and writes the file once (atomically) when leaving the block. Nothing is written if the block raises.
+        The file stays locked for the whole block.
+        """
+        if self._in_transaction:
+            # nested: the outer transaction commits.
+            yield self
+            return
+        with self._lock(exclusive=True):
+            # within a read cache, the cache is kept and reflects the committed data.
+            cached = self._data is not None
+            self._data = self._load_data()
+            self._in_transaction = True
+            try:
+                yield self
+                self._save_data(self._data)
+            except BaseException:
+                if cached:
+                    self._data = self._load_data()
+                raise
+            finally:
+                self._in_transaction = False
+                if not cached:
+                    self._data = None
+
+    @contextmanager
+    def read_cache(self):
+        """
+        Within this block, every `get` is served from a single load of the file.
+        """
+        if self._data is not None:
+            yield self
+            return
+        self._data = self._read_locked()
+        try:
+            yield self
+        finally:
+            self._data = None
+
+    def _read_locked(self):
+        with self._lock(exclusive=False):
+            return self._load_data()
 
     def get(self, field_path=None):
-        data = self._load_data()
+        data = self._data if self._data is not None else self._read_locked()
         if not field_path:
             return data
         current_node = data
@@ -25,8 +103,12 @@ class Database:
             return None
 
     def update(self, field_path, value):
-        data = self._load_data()
-        current_node = data
+        if not self._in_transaction:
+            # a transaction of one update
+            with self.transaction():
+                return self.update(field_path, value)
+
+        current_node = self._data
 
         for subfield in field_path[:-1]:
             if subfield not in current_node:
@@ -34,7 +116,6 @@ class Database:
             current_node = current_node[subfield]
 
         current_node[field_path[-1]] = value
-        self._save_data(data)
 
     def _load_data(self):
         try:
@@ -45,12 +126,19 @@ class Database:
             return {}
 
     def _save_data(self, data):
+        # write to a temporary file and rename it: a crash can never leave a truncated database.
+        tmp_path = f"{self.file_path}.{os.getpid()}.tmp"
         try:
             serialized_data = json.dumps(data)
-            with open(self.file_path, 'w') as file:
+            with open(tmp_path, 'w') as file:
                 file.write(serialized_data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.file_path)
         except Exception as e:
             print(f"An error occurred while saving the data: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     def save_for_pycs3_run(self, lens_name, dataset_name, lcs, mltouse, knotstouse, tsrand=None):
         # update when we're satisfied of our initial guess
@@ -64,15 +152,16 @@ class Database:
         ts0 = lcs[0].timeshift
         for lc in lcs:
             lc.timeshift -= ts0
-        # write down all that joyful information
-        for lc in lcs:
-            self.update([set_name, 'curves', lc.object, 'magshift'], lc.magshift)
-            self.update([set_name, 'curves', lc.object, 'timeshift'], lc.timeshift)
-        self.update([set_name, 'mltouse'], mltouse)
-        self.update([set_name, 'knotstouse'], knotstouse)
-        if tsrand is not None:
-            # if None, taken to be max(0.2 * largest delay, 10) in downstream steps
-            self.update([set_name, 'tsrand'], tsrand)
+        # write down all that joyful information, in one go
+        with self.transaction():
+            for lc in lcs:
+                self.update([set_name, 'curves', lc.object, 'magshift'], lc.magshift)
+                self.update([set_name, 'curves', lc.object, 'timeshift'], lc.timeshift)
+            self.update([set_name, 'mltouse'], mltouse)
+            self.update([set_name, 'knotstouse'], knotstouse)
+            if tsrand is not None:
+                # if None, taken to be max(0.2 * largest delay, 10) in downstream steps
+                self.update([set_name, 'tsrand'], tsrand)
 
         # save the lcs into a pickle file that PyCS3 can later load.
         # before saving, resetting the lcs as the pycs3 scripts will read this info from the config file
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 """
 swaps delays:
@@ -10,6 +11,9 @@ covariance: delay pair names both as index and column names.
 
 call remap_delays_and_covariance on the dataframes, with a dictionary defining the remapping, e.g.:
 {'A':'B', 'B':'A'} to exchange A and B.
+
+For many matrices at once (e.g. all the marginalisation products), use remap_delays / remap_covariances
+on numpy arrays, and remap_tsarray on the mock time shifts.
 """
 
 def validate_remapping(remap_dict):
@@ -31,6 +35,47 @@ def validate_remapping(remap_dict):
         return False
     return True
 
+def get_original_pair_and_sign(label, remap_dict):
+    """
+    For a (new) delay label, the original delay pair it corresponds to, and the sign of the delay.
+    """
+    c1, c2 = list(label)
+    # of course, remap_dict is bijective so we can also
+    # transform a new label into an original label.
+    # but we'll use this function to do the opposite.
+    nc1 = remap_dict.get(c1, c1)
+    nc2 = remap_dict.get(c2, c2)
+    reversed_order = nc1 > nc2  # because input is assumed to be ordered
+
+    original_pair = ''.join(sorted([nc1, nc2]))
+    sign = -1 if reversed_order else 1
+    return original_pair, sign
+
+
+def signed_permutation(new_labels, original_labels, remap_dict):
+    """
+    Signed permutation taking delays ordered as original_labels to delays ordered as new_labels:
+    new_delays = sign * original_delays[index].
+
+    Args:
+        new_labels (list): delay labels of the output (e.g., ['AB', 'AC', 'BC']).
+        original_labels (list): delay labels of the input, usually the same as new_labels.
+        remap_dict (dict): Mapping from original to new labels (e.g., {'B': 'C', 'C': 'B'}).
+
+    Returns:
+        (np.ndarray, np.ndarray): index into original_labels and sign (+/-1) of each new label.
+    """
+    if not validate_remapping(remap_dict):
+        raise ValueError("Invalid remapping dictionary.")
+    original_index = {label: j for j, label in enumerate(original_labels)}
+    index = np.zeros(len(new_labels), dtype=int)
+    sign = np.ones(len(new_labels), dtype=int)
+    for i, label in enumerate(new_labels):
+        original_pair, sign[i] = get_original_pair_and_sign(label, remap_dict)
+        index[i] = original_index[original_pair]
+    return index, sign
+
+
 def remap_delays_and_covariance(delays_df, cov_df, remap_dict):
     """
     Re-map delays and covariance matrix when changing the labelling of the
@@ -49,42 +94,52 @@ def remap_delays_and_covariance(delays_df, cov_df, remap_dict):
     if not validate_remapping(remap_dict):
         raise ValueError("Invalid remapping dictionary.")
 
-
-    def get_original_pair_and_sign(label):
-        # utility to compute original pair and sign for a given label
-        c1, c2 = list(label)
-        # of course, remap_dict is bijective so we can also
-        # transform a new label into an original label.
-        # but we'll use this function to do the opposite.
-        nc1 = remap_dict.get(c1, c1)
-        nc2 = remap_dict.get(c2, c2)
-        reversed_order = nc1 > nc2  # because input is assumed to be ordered
-
-        original_pair = ''.join(sorted([nc1, nc2]))
-        sign = -1 if reversed_order else 1
-        return original_pair, sign
-
     # remap delays.
     # because we were listing all possible delay pairs, the remapping
-    # is indeed only a remapping, with sign chance when the order changes.
-    new_delays = pd.DataFrame(index=delays_df.index, columns=delays_df.columns)
-    for label in delays_df.index:
-        # label is the "new label".
-        original_pair, sign = get_original_pair_and_sign(label)
-        new_delays.loc[label] = delays_df.loc[original_pair].values * sign
+    # is indeed only a remapping, with sign chance when the order changes: a signed permutation.
+    # The rows are taken as they are, so that the columns keep their dtypes, and only the numeric ones change sign.
+    index, sign = signed_permutation(delays_df.index, delays_df.index, remap_dict)
+    new_delays = delays_df.iloc[index].set_axis(delays_df.index, axis=0)
+    for column in new_delays.columns:
+        if pd.api.types.is_numeric_dtype(new_delays[column]):
+            new_delays[column] = new_delays[column] * sign
 
     # remap covariance matrix -- again assumed to list all possible delay pairs
-    # initially, so just a remapping.
-    # We iterate over label-label pairs by row and column.
-    new_cov = pd.DataFrame(index=cov_df.index, columns=cov_df.columns)
-    for row_label in cov_df.index:
-        original_row_pair, row_sign = get_original_pair_and_sign(row_label)
-        for col_label in cov_df.columns:
-            original_col_pair, col_sign = get_original_pair_and_sign(col_label)
-            # simply read original covariance value and apply sign
-            original_cov_value = cov_df.loc[original_row_pair, original_col_pair]
-            # that is, if both labels moved, no sign change
-            # if twice same label (diagonal), no sign change automatically
-            new_cov.loc[row_label, col_label] = original_cov_value * row_sign * col_sign
+    # initially, so just a remapping: cov'[i, j] = sign[i] * cov[index[i], index[j]] * sign[j].
+    # (if both labels moved, no sign change; if twice same label (diagonal), no sign change automatically)
+    row_index, row_sign = signed_permutation(cov_df.index, cov_df.index, remap_dict)
+    col_index, col_sign = signed_permutation(cov_df.columns, cov_df.columns, remap_dict)
+    new_cov = pd.DataFrame(row_sign[:, None] * cov_df.values[np.ix_(row_index, col_index)] * col_sign[None, :],
+                           index=cov_df.index, columns=cov_df.columns)
 
     return new_delays, new_cov
+
+
+def remap_delays(delays, labels, remap_dict):
+    """
+    Batch version for arrays: delays of shape (..., n_labels), ordered as labels, e.g. a stack of
+    delay estimates or mock delays. Returns an array of the same shape.
+    """
+    index, sign = signed_permutation(labels, labels, remap_dict)
+    return np.asarray(delays)[..., index] * sign
+
+
+def remap_covariances(covs, labels, remap_dict):
+    """
+    Batch version for arrays: covariance matrices of shape (..., n_labels, n_labels), rows and columns
+    ordered as labels. All the matrices are remapped with a single fancy indexing.
+    """
+    index, sign = signed_permutation(labels, labels, remap_dict)
+    return np.asarray(covs)[..., index[:, None], index[None, :]] * (sign[:, None] * sign[None, :])
+
+
+def remap_tsarray(tsarray, images, remap_dict):
+    """
+    Remaps time shifts (e.g. the tsarray / truetsarray of the mocks, shape (..., n_images)),
+    whose columns are the lensed images ordered as `images`: time shifts have no sign, it is a column permutation.
+    """
+    if not validate_remapping(remap_dict):
+        raise ValueError("Invalid remapping dictionary.")
+    images = list(images)
+    order = [images.index(remap_dict.get(im, im)) for im in images]
+    return np.asarray(tsarray)[..., order]
@@ -0,0 +1,122 @@
+import hashlib
+import os
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+from multiprocess import Pool, cpu_count
+
+from utils.pycs3_utils import spl
+
+# masks already computed in this process, keyed by OutlierDetector.key
+_mask_cache = {}
+
+
+def detect_outliers(lcs, sigma_threshold=2.5, debug=False, aesthetic_sigma=5, knotstep=20):
+
+    outliers = []
+    for lc in lcs:
+        # fit a spline to the data
+        sp = spl([lc], nit=1, rough=1, knotstep=knotstep)
+
+        # calculate the residuals of the spline fit
+        residuals = (lc.mags - sp.eval(lc.jds))
+        residuals_norm = residuals / lc.magerrs
+
+        sigma = np.std(residuals)
+
+        # find points outside the envelope around the spline
+        outliers.extend(np.where(np.abs(residuals_norm) > sigma_threshold)[0])
+        # this one is for aesthetics:
+        outliers.extend(np.where(np.abs(residuals) > aesthetic_sigma * sigma)[0])
+        if debug:
+            plt.figure()
+            plt.plot(lc.jds, lc.mags, '.')
+            plt.plot(lc.jds, sp.eval(lc.jds), '-')
+            plt.waitforbuttonpress()
+
+    return list(set(outliers))
+
+
+def _outlier_mask(args):
+    lc, sigma_threshold, aesthetic_sigma, knotstep = args
+    outliers = detect_outliers([lc], sigma_threshold=sigma_threshold, aesthetic_sigma=aesthetic_sigma,
+                               knotstep=knotstep)
+    mask = np.ones_like(lc.mags, dtype=bool)
+    mask[(outliers,)] = False
+    return mask
+
+
+class OutlierDetector:
+    """
+    Runs detect_outliers on many curves at once (any number of lenses), in a process pool,
+    and memoizes the resulting masks by curve content and detection parameters.
+    The masks are kept in memory for the lifetime of the process, and in cache_dir (one .npy per curve) if given.
+    """
+    def __init__(self, sigma_threshold=2.5, aesthetic_sigma=5, knotstep=20, cache_dir=None, processes=None):
+        """
+        processes: number of workers, None uses all the cores.
+        """
+        self.sigma_threshold = sigma_threshold
+        self.aesthetic_sigma = aesthetic_sigma
+        self.knotstep = knotstep
+        self.processes = processes
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = Path(cache_dir)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, lc):
+        """
+        Hash of the data of the curve and of the detection parameters.
+        """
+        sha = hashlib.sha1()
+        for array in (lc.jds, lc.mags, lc.magerrs):
+            sha.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        sha.update(f"{self.sigma_threshold}_{self.aesthetic_sigma}_{self.knotstep}".encode())
+        return sha.hexdigest()
+
+    def _load(self, key):
+        if key in _mask_cache:
+            return _mask_cache[key]
+        if self.cache_dir is None:
+            return None
+        try:
+            mask = np.load(self.cache_dir / f"{key}.npy")
+        except (FileNotFoundError, ValueError):
+            return None
+        _mask_cache[key] = mask
+        return mask
+
+    def _save(self, key, mask):
+        _mask_cache[key] = mask
+        if self.cache_dir is None:
+            return
+        tmp_file = self.cache_dir / f"{key}.{os.getpid()}.tmp.npy"
+        np.save(tmp_file, mask)
+        os.replace(tmp_file, self.cache_dir / f"{key}.npy")
+
+    def masks(self, lcs):
+        """
+        Returns one boolean mask per curve, False for the outliers. Only the curves without
+        a memoized mask are fitted.
+        """
+        keys = [self.key(lc) for lc in lcs]
+        masks = [self._load(key) for key in keys]
+        todo = [k for k, mask in enumerate(masks) if mask is None]
+        if not todo:
+            return [mask.copy() for mask in masks]
+
+        job_args = [(lcs[k], self.sigma_threshold, self.aesthetic_sigma, self.knotstep) for k in todo]
+        processes = cpu_count() if self.processes is None else self.processes
+        processes = min(processes, len(job_args))
+        if processes <= 1:
+            new_masks = [_outlier_mask(args) for args in job_args]
+        else:
+            with Pool(processes) as p:
+                new_masks = p.map(_outlier_mask, job_args)
+
+        for k, mask in zip(todo, new_masks):
+            self._save(keys[k], mask)
+            masks[k] = mask
+        return [mask.copy() for mask in masks]
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+# the columns served to the light curve builder, one .npy file each.
+COLUMNS = ['mjd', 'mag', 'mag_errs', 'telescope']
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cuts_hash(lens, max_scatter, max_seeing, telescope):
+    """
+    Short hash identifying a query (lens and cuts). The telescope selection is order independent.
+    """
+    if type(telescope) is str:
+        telescope = [telescope]
+    if telescope is not None:
+        telescope = sorted(telescope)
+    key = json.dumps({'lens': lens, 'max_scatter': max_scatter, 'max_seeing': max_seeing, 'telescope': telescope},
+                     sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+class PhotometryCache:
+    """
+    Columnar on-disk cache of the photometry, one directory per (database content, lens, cuts):
+
+        cache_dir/<database sha1>/<lens>_<cuts hash>/{mjd,mag,mag_errs,telescope}.npy + meta.json
+
+    The columns are memory-mapped copy-on-write when loading, so the curves are views on the files.
+    When the database changes, its sha1 changes and the entries built from the old database are deleted.
+    """
+    def __init__(self, cache_dir, photometry_db_path):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.photometry_db_path = Path(photometry_db_path).resolve()
+
+    def db_hash(self):
+        """
+        sha1 of the database file. Only recomputed when the size or modification time of the file changed.
+        """
+        stat = self.photometry_db_path.stat()
+        fingerprint = {'path': str(self.photometry_db_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        fingerprint_file = self.cache_dir / 'db_fingerprint.json'
+        try:
+            with open(fingerprint_file, 'r') as f:
+                stored = json.load(f)
+            if all(stored.get(k) == v for k, v in fingerprint.items()):
+                return stored['sha1']
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        fingerprint['sha1'] = file_sha1(self.photometry_db_path)
+        tmp_file = fingerprint_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(fingerprint, f)
+        os.replace(tmp_file, fingerprint_file)
+        self.prune(fingerprint['sha1'])
+        return fingerprint['sha1']
+
+    def prune(self, current_hash):
+        """
+        Deletes the entries built from another version of the database.
+        """
+        for d in self.cache_dir.iterdir():
+            if d.is_dir() and d.name != current_hash:
+                shutil.rmtree(d, ignore_errors=True)
+
+    def entry_dir(self, lens, max_scatter, max_seeing, telescope):
+        return self.cache_dir / self.db_hash() / f"{lens}_{cuts_hash(lens, max_scatter, max_seeing, telescope)}"
+
+    def load(self, lens, max_scatter, max_seeing, telescope):
+        """
+        Returns (res, dataset_name) as CurveLoader.query_photometry_by_image and query_telescopes would give,
+        or None if this query is not cached.
+        """
+        entry = self.entry_dir(lens, max_scatter, max_seeing, telescope)
+        try:
+            with open(entry / 'meta.json', 'r') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta['offsets'][-1] == 0:
+            # nothing to map, no data for this query
+            return {}, meta['dataset_name']
+
+        columns = {c: np.load(entry / f'{c}.npy', mmap_mode='c') for c in COLUMNS}
+        res = {}
+        for image, start, stop in zip(meta['images'], meta['offsets'][:-1], meta['offsets'][1:]):
+            res[image] = tuple(columns[c][start:stop] for c in COLUMNS)
+        return res, meta['dataset_name']
+
+    def save(self, lens, max_scatter, max_seeing, telescope, res, dataset_name):
+        """
+        Stores the output of a query. Written to a temporary directory first then renamed,
+        so concurrent jobs never see half-written entries.
+        """
+        entry = self.entry_dir(lens, max_scatter, max_seeing, telescope)
+        if entry.exists():
+            return
+        images = sorted(res.keys())
+        offsets = np.cumsum([0] + [len(res[image][0]) for image in images]).tolist()
+
+        tmp_entry = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+        tmp_entry.mkdir(parents=True, exist_ok=True)
+        for k, c in enumerate(COLUMNS):
+            if images:
+                column = np.concatenate([np.asarray(res[image][k]) for image in images])
+            else:
+                column = np.array([])
+            np.save(tmp_entry / f'{c}.npy', column)
+        with open(tmp_entry / 'meta.json', 'w') as f:
+            json.dump({'lens': lens, 'images': images, 'offsets': offsets, 'dataset_name': dataset_name,
+                       'max_scatter': max_scatter, 'max_seeing': max_seeing, 'telescope': telescope}, f)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another process wrote the same entry in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)